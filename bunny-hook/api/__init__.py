@@ -1,10 +1,40 @@
-from flask import Flask, g
+# __init__.py -- build the API server
+#
+# Nothing is imported here at module level, so that processes that only use
+# the queue (like `runqueue.py`) don't pay for Flask and the routes.
 
-app = Flask('api')
 
-from api import routes
-from api.secrets import TOKENS
+def create_app(config=None):
+    '''
+    Build the Flask app for the API server, e.g. with
+    `gunicorn 'api:create_app()'`.
 
-with app.app_context():
-    # Bind secret tokens to the application context
-    g.tokens = TOKENS
+    Args:
+        - config (dict): Optional Flask config to set on top of the server
+                         config, e.g. `TOKENS`, `QUEUE_TOKEN` or
+                         `JOBS_TOKEN` for tests.
+    '''
+    from flask import Flask
+
+    from api.settings import load_settings
+    from api.routes import blueprint
+
+    app = Flask('api')
+
+    settings = load_settings()
+
+    # Token that builders on other hosts use to consume the queue
+    app.config['QUEUE_TOKEN'] = settings.get('queue_token')
+
+    # Token that clients use to look up jobs and follow their logs
+    app.config['JOBS_TOKEN'] = settings.get('jobs_token')
+
+    if 'TOKENS' not in (config or {}):
+        # Secret tokens that webhooks can be signed with
+        from api.secrets import TOKENS
+        app.config['TOKENS'] = TOKENS
+
+    app.config.update(config or {})
+    app.register_blueprint(blueprint)
+
+    return app
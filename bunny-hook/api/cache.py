@@ -0,0 +1,276 @@
+# cache.py -- keep the outputs of build scripts, keyed on their inputs
+import os
+import sys
+import glob
+import json
+import shutil
+import fnmatch
+import hashlib
+import logging
+import tempfile
+
+
+def hash_file(path):
+    '''
+    Return the SHA-256 of a file's contents.
+    '''
+    sha = hashlib.sha256()
+
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha.update(chunk)
+
+    return sha.hexdigest()
+
+
+def input_key(step, manifest, needs_keys=()):
+    '''
+    Return a key for everything that a script reads: its own contents, the
+    files in the repo that match its `paths`, and the keys of the scripts it
+    needs. Returns None if the script doesn't declare its `paths`.
+
+    Args:
+        - step (Step):          The script, from `parse_steps`.
+        - manifest (dict):      Files in the repo, mapping each path to its
+                                git mode and blob SHA (see
+                                `api.releases.list_files`).
+        - needs_keys (list):    Input keys of the scripts that the step needs.
+    '''
+    if step.paths is None or None in needs_keys:
+        return None
+
+    sha = hashlib.sha256()
+    sha.update(json.dumps([step.script, step.paths, step.outputs]).encode('utf-8'))
+
+    # Globs match across directories, so `assets/*` covers everything under
+    # assets/
+    for path in sorted(manifest):
+        if path == step.script or any(fnmatch.fnmatchcase(path, pattern)
+                                      for pattern in step.paths):
+            sha.update(json.dumps([path] + manifest[path]).encode('utf-8'))
+
+    for key in sorted(needs_keys):
+        sha.update(key.encode('utf-8'))
+
+    return sha.hexdigest()
+
+
+def dependency_key(dependency, manifest):
+    '''
+    Return a key for a directory of installed dependencies: its path, and
+    the lockfiles in the repo that match its `lockfiles` globs.
+
+    Args:
+        - dependency (Dependency):  The directory, from `parse_dependencies`.
+        - manifest (dict):          Files in the repo, as for `input_key`.
+    '''
+    sha = hashlib.sha256()
+    sha.update(json.dumps([dependency.path, dependency.lockfiles]).encode('utf-8'))
+
+    for path in sorted(manifest):
+        if any(fnmatch.fnmatchcase(path, pattern) for pattern in dependency.lockfiles):
+            sha.update(json.dumps([path] + manifest[path]).encode('utf-8'))
+
+    return sha.hexdigest()
+
+
+def reflink(src, dst, mode):
+    '''
+    Make a copy-on-write copy of a file, which shares its blocks with the
+    original until one of them is written to. Returns False if the platform
+    or filesystem doesn't support it.
+    '''
+    if not sys.platform.startswith('linux'):
+        return False
+
+    import fcntl
+
+    # `FICLONE` from linux/fs.h; only exported by fcntl from Python 3.12
+    ficlone = getattr(fcntl, 'FICLONE', 0x40049409)
+
+    with open(src, 'rb') as s, open(dst, 'wb') as d:
+        try:
+            fcntl.ioctl(d.fileno(), ficlone, s.fileno())
+        except OSError:
+            cloned = False
+        else:
+            cloned = True
+
+    if not cloned:
+        os.remove(dst)
+        return False
+
+    os.chmod(dst, mode)
+    return True
+
+
+class ContentCache(object):
+    '''
+    Store the outputs of build scripts under a directory:
+
+        <root>/entries/<key>.json     Output files of a script run, mapping each
+                                      path to its SHA-256 and mode, or to
+                                      ['link', target] for a symlink
+        <root>/objects/<sha[:2]>/<sha>-<mode>
+                                      Contents of each output file
+
+    Files are stored by their contents, so outputs that don't change between
+    builds are only stored once. Restored files are copy-on-write clones of
+    the stored copies where the filesystem supports it (btrfs, XFS), and
+    hardlinks to them otherwise, so build scripts should replace files
+    rather than edit them in place.
+    '''
+    def __init__(self, root):
+        '''
+        Args:
+            - root (str): Directory to keep the cache in.
+        '''
+        self.root = root
+        self.entries_path = os.path.join(root, 'entries')
+        self.objects_path = os.path.join(root, 'objects')
+
+        # Whether the filesystem supports reflinks; stops trying after the
+        # first one fails
+        self.reflinks = True
+
+    def object_path(self, sha, mode):
+        return os.path.join(self.objects_path, sha[:2], '%s-%o' % (sha, mode))
+
+    def get(self, key):
+        '''
+        Return the outputs recorded for a key, or None if the key has never
+        been built.
+        '''
+        try:
+            with open(os.path.join(self.entries_path, key + '.json')) as entry:
+                return json.load(entry)
+        except (OSError, ValueError):
+            return None
+
+    def put(self, key, source, outputs):
+        '''
+        Record the outputs of a script run under a key.
+
+        Args:
+            - key (str):        Input key of the script, from `input_key`.
+            - source (str):     Directory that the script ran in.
+            - outputs (list):   Globs of the files that the script wrote,
+                                relative to `source`. Directories that match
+                                are stored with everything under them.
+        '''
+        entry = {}
+
+        for pattern in outputs or []:
+            for match in glob.glob(pattern, root_dir=source, recursive=True):
+                for path in self.walk(source, match):
+                    src = os.path.join(source, path)
+
+                    # Virtualenvs link to the interpreter they were made with
+                    if os.path.islink(src):
+                        entry[path] = ['link', os.readlink(src)]
+                        continue
+
+                    sha = hash_file(src)
+                    mode = os.stat(src).st_mode & 0o777
+                    self.store(src, sha, mode)
+                    entry[path] = [sha, mode]
+
+        os.makedirs(self.entries_path, exist_ok=True)
+
+        entry_file = os.path.join(self.entries_path, key + '.json')
+
+        # Scripts running side by side can store the same entry at once, so
+        # each one writes to a temp file of its own
+        fd, tmp_file = tempfile.mkstemp(dir=self.entries_path, suffix='.tmp')
+
+        with os.fdopen(fd, 'w') as f:
+            json.dump(entry, f)
+
+        os.replace(tmp_file, entry_file)
+
+        return entry
+
+    def walk(self, source, match):
+        '''
+        Return the files at a path that matched an output glob: the path
+        itself, or every file and symlink under it if it's a directory.
+        Symlinks to directories aren't followed.
+        '''
+        full_path = os.path.join(source, match)
+
+        if os.path.islink(full_path) or os.path.isfile(full_path):
+            return [match]
+
+        files = []
+        for dirpath, dirnames, filenames in os.walk(full_path):
+            links = [name for name in dirnames if os.path.islink(os.path.join(dirpath, name))]
+            for filename in filenames + links:
+                files.append(os.path.relpath(os.path.join(dirpath, filename), source))
+
+        return files
+
+    def store(self, src, sha, mode):
+        '''
+        Copy a file into the object store, unless it's there already. Objects
+        are stored with the file's mode, since hardlinks share it.
+        '''
+        object_path = self.object_path(sha, mode)
+
+        if os.path.exists(object_path):
+            return
+
+        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+
+        fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(object_path), suffix='.tmp')
+        os.close(fd)
+        shutil.copyfile(src, tmp_file)
+        os.chmod(tmp_file, mode)
+        os.replace(tmp_file, object_path)
+
+    def restore(self, entry, dest):
+        '''
+        Put the outputs from a cache entry in place under a directory.
+        Returns False if any of the stored files have gone missing, in which
+        case the script has to run again.
+
+        Args:
+            - entry (dict): Outputs of a script run, as returned by `get`.
+            - dest (str):   Directory to put them in.
+        '''
+        for path, stored in entry.items():
+            target = os.path.join(dest, path)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+
+            if os.path.lexists(target):
+                os.remove(target)
+
+            if stored[0] == 'link':
+                os.symlink(stored[1], target)
+                continue
+
+            sha, mode = stored
+            object_path = self.object_path(sha, mode)
+
+            if not os.path.isfile(object_path):
+                logging.warning('Cached output %s is missing from %s' % (path, self.root))
+                return False
+
+            self.link(object_path, target, mode)
+
+        return True
+
+    def link(self, object_path, target, mode):
+        '''
+        Put a stored file in place: as a reflink if possible, since writes to
+        it then can't reach the cache, and otherwise as a hardlink.
+        '''
+        if self.reflinks:
+            if reflink(object_path, target, mode):
+                return
+            self.reflinks = False
+
+        try:
+            os.link(object_path, target)
+        except OSError:
+            # The cache lives on another filesystem
+            shutil.copy2(object_path, target)
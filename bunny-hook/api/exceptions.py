@@ -15,8 +15,50 @@ class WorkerException(Exception):
     pass
 
 
+class JobCancelled(WorkerException):
+    '''
+    The job was cancelled before it finished, because a newer push
+    superseded it.
+    '''
+    pass
+
+
+class CheckoutFailed(WorkerException):
+    '''
+    The repo couldn't be fetched or checked out. This usually passes (e.g.
+    GitHub or the network was down), so the job is worth retrying.
+    '''
+    pass
+
+
+class CommandFailed(WorkerException):
+    '''
+    A command run by the worker exited with an error.
+    '''
+    def __init__(self, message, returncode=None):
+        super().__init__(message)
+        self.returncode = returncode
+
+
+class CommandTimeout(WorkerException):
+    '''
+    A command run by the worker took too long, and was killed.
+    '''
+    pass
+
+
 class QueueException(Exception):
     '''
     Something went wrong in the queue process.
     '''
     pass
+
+
+class QueueFull(QueueException):
+    '''
+    The queue has hit one of its depth limits, and won't take more work
+    until some jobs finish.
+    '''
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
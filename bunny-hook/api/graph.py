@@ -0,0 +1,170 @@
+# graph.py -- run the scripts in a stage as a dependency graph
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from api.exceptions import WorkerException
+
+
+class Step(object):
+    '''
+    A script in a stage of the deploy, and the scripts that it has to wait
+    for.
+
+    Scripts can also declare the files in the repo that they read (`paths`)
+    and the files that they produce (`outputs`), as lists of globs. Scripts
+    that declare `paths` get skipped when those files haven't changed.
+    '''
+    def __init__(self, script, needs, paths=None, outputs=None):
+        self.script = script
+        self.needs = set(needs)
+        self.paths = paths
+        self.outputs = outputs
+
+    def __repr__(self):
+        return 'Step(%r, needs=%r)' % (self.script, sorted(self.needs))
+
+
+def parse_steps(entries):
+    '''
+    Turn the list of scripts for a stage in `deploy.yml` into Steps. Each
+    entry can be:
+
+        - a path to a script, which runs after the entry before it
+        - {'parallel': [paths]}, a group of scripts that run side by side
+          after the entry before it
+        - {'script': path, 'needs': [paths]}, a script that runs once the
+          listed scripts from the same stage have finished. These entries can
+          also list the `paths` that the script reads and the `outputs` that
+          it writes.
+
+    A plain list of paths runs one script at a time, in order.
+    '''
+    steps = []
+
+    # Scripts that the next plain entry has to wait for
+    previous = []
+
+    for entry in entries or []:
+        if isinstance(entry, str):
+            group = [Step(entry, previous)]
+
+        elif isinstance(entry, dict) and 'parallel' in entry:
+            if not isinstance(entry['parallel'], list):
+                raise WorkerException('`parallel` must be a list of scripts: %r' % entry)
+            group = [Step(script, previous) for script in entry['parallel']]
+
+        elif isinstance(entry, dict) and 'script' in entry:
+            needs = entry.get('needs', previous)
+            if isinstance(needs, str):
+                needs = [needs]
+            group = [Step(entry['script'], needs,
+                          paths=parse_globs(entry, 'paths'),
+                          outputs=parse_globs(entry, 'outputs'))]
+
+        else:
+            raise WorkerException('Unrecognized script entry: %r' % (entry,))
+
+        steps.extend(group)
+        previous = [step.script for step in group]
+
+    scripts = [step.script for step in steps]
+
+    for step in steps:
+        if scripts.count(step.script) > 1:
+            raise WorkerException('Script %s is listed more than once' % step.script)
+
+        unknown = step.needs - set(scripts)
+        if unknown:
+            raise WorkerException('Script {script} needs unknown scripts: {unknown}'.format(
+                script=step.script, unknown=', '.join(sorted(unknown))))
+
+    check_cycles(steps)
+
+    return steps
+
+
+def parse_globs(entry, key):
+    '''
+    Return a list of globs from a script entry, or None if it doesn't have
+    any.
+    '''
+    globs = entry.get(key)
+
+    if globs is None:
+        return None
+
+    if isinstance(globs, str):
+        globs = [globs]
+
+    if not isinstance(globs, list) or not all(isinstance(glob, str) for glob in globs):
+        raise WorkerException('`{key}` must be a list of globs: {entry!r}'.format(key=key,
+                                                                                entry=entry))
+
+    return globs
+
+
+def check_cycles(steps):
+    '''
+    Raise an error if the steps can't all run because some of them wait on
+    each other.
+    '''
+    done = set()
+    remaining = list(steps)
+
+    while remaining:
+        ready = [step for step in remaining if step.needs <= done]
+
+        if not ready:
+            raise WorkerException('Scripts depend on each other in a cycle: %s' %
+                                  ', '.join(step.script for step in remaining))
+
+        done.update(step.script for step in ready)
+        remaining = [step for step in remaining if step.script not in done]
+
+
+def run_steps(steps, run, max_workers, abort=None):
+    '''
+    Run steps on a pool of threads, starting each one as soon as the steps
+    that it needs have finished. On the first failure, no more steps are
+    started, `abort` is called to stop the ones that are running, and the
+    error is raised.
+
+    Args:
+        - steps (list):         Steps, as returned by `parse_steps`.
+        - run (callable):       Function that runs a step.
+        - max_workers (int):    Maximum number of steps to run at once.
+        - abort (callable):     Optional function that stops running steps.
+    '''
+    done = set()
+    started = set()
+    running = {}
+    error = None
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while True:
+            if error is None:
+                for step in steps:
+                    if step.script not in started and step.needs <= done:
+                        started.add(step.script)
+                        running[executor.submit(run, step)] = step
+
+            if not running:
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+
+            for future in finished:
+                step = running.pop(future)
+
+                try:
+                    future.result()
+                    done.add(step.script)
+                except Exception as e:
+                    if error is None:
+                        error = e
+                        if running and abort:
+                            logging.info('Stopping %d running scripts' % len(running))
+                            abort()
+
+    if error is not None:
+        raise error
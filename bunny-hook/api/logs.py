@@ -0,0 +1,203 @@
+# logs.py -- log requests without slowing down responses, and follow job logs
+import os
+import sys
+import json
+import time
+import queue
+import atexit
+import random
+import logging
+import threading
+import logging.handlers
+
+
+class RequestRecord(object):
+    '''
+    A request/response cycle to be logged. It only gets formatted if a
+    handler actually emits it, on the logging thread rather than in the
+    request.
+    '''
+    def __init__(self, fields, payload=None, max_payload_chars=None):
+        self.fields = fields
+        self.payload = payload
+        self.max_payload_chars = max_payload_chars
+
+    def __str__(self):
+        fields = dict(self.fields)
+
+        if self.payload is not None:
+            payload = json.dumps(self.payload)
+
+            if self.max_payload_chars and len(payload) > self.max_payload_chars:
+                payload = '{start}... ({more} more characters)'.format(
+                    start=payload[:self.max_payload_chars],
+                    more=len(payload) - self.max_payload_chars)
+
+            fields['payload'] = payload
+
+        return json.dumps(fields, default=str)
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    '''
+    Hand log records to a background thread without formatting them first.
+    The stock QueueHandler formats each record up front, so that records can
+    be sent to other processes; ours stay in this process.
+    '''
+    def prepare(self, record):
+        return record
+
+
+class RequestLogger(object):
+    '''
+    Log one structured (JSON) line per request. Records are handed to a
+    background thread for formatting and writing, so logging never blocks a
+    response. Responses other than 2xx (bad signatures, unregistered branches)
+    are sampled, and request payloads are truncated and only logged at the
+    DEBUG level.
+    '''
+    # Fraction of non-2xx responses to log
+    sample_rate = 0.1
+
+    # Longest request payload to log, in characters
+    max_payload_chars = 2048
+
+    # Request headers worth keeping
+    headers = ('User-Agent', 'X-GitHub-Event', 'X-GitHub-Delivery', 'Content-Length')
+
+    def __init__(self, name='api.requests', handlers=None):
+        '''
+        Args:
+            - name (str):       Name of the logger to use.
+            - handlers (list):  Handlers that the background thread writes
+                                records to. Defaults to stderr.
+        '''
+        self.logger = logging.getLogger(name)
+        self.handlers = handlers
+        self.listener = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        '''
+        Start the background thread that writes records, if it isn't running.
+        '''
+        with self.lock:
+            if self.listener:
+                return
+
+            handlers = self.handlers
+            if handlers is None:
+                handler = logging.StreamHandler(sys.stderr)
+                handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+                handlers = [handler]
+
+            records = queue.Queue()
+            self.logger.addHandler(DeferredQueueHandler(records))
+            self.logger.propagate = False
+
+            if self.logger.level == logging.NOTSET:
+                self.logger.setLevel(logging.INFO)
+
+            self.listener = logging.handlers.QueueListener(records, *handlers,
+                                                           respect_handler_level=True)
+            self.listener.start()
+            atexit.register(self.stop)
+
+    def stop(self):
+        '''
+        Write out any records that are waiting, and stop the background thread.
+        '''
+        with self.lock:
+            if self.listener:
+                self.listener.stop()
+                self.listener = None
+
+    def log(self, request, resp, status_code, payload=None):
+        '''
+        Log a request/response cycle.
+
+        Arguments:
+            - request (Request) -> Flask Request object
+            - resp (dict)       -> JSON that was returned
+            - status_code (int) -> HTTP status code
+            - payload (dict)    -> Parsed request payload, if there was one
+        '''
+        if not self.listener:
+            self.start()
+
+        if not self.logger.isEnabledFor(logging.INFO):
+            return
+
+        if not 200 <= status_code < 300 and random.random() >= self.sample_rate:
+            return
+
+        fields = {
+            'method': request.method,
+            'path': request.path,
+            'remote_addr': request.remote_addr,
+            'status_code': status_code,
+            'response': resp,
+            'headers': {header: request.headers.get(header) for header in self.headers
+                        if header in request.headers},
+        }
+
+        if not 200 <= status_code < 300:
+            fields['sample_rate'] = self.sample_rate
+
+        # The payload can be hundreds of KB, so only log it when debugging
+        if not self.logger.isEnabledFor(logging.DEBUG):
+            payload = None
+
+        self.logger.info('%s', RequestRecord(fields, payload, self.max_payload_chars))
+
+
+# Logger shared by all routes
+request_logger = RequestLogger()
+
+
+def tail(log_file, offset=0, is_finished=None, poll_interval=0.5, max_line_length=64 * 1024):
+    '''
+    Yield the lines of a log file from a byte offset onwards, as tuples of the
+    offset after the line and the line itself. The file is read a line at a
+    time, so logs of any size can be followed.
+
+    Args:
+        - log_file (str):           Path to the log file.
+        - offset (int):             Byte offset to start from, e.g. the last
+                                    offset that a client saw.
+        - is_finished (callable):   Returns True once nothing more will be
+                                    written to the log. Until then, wait for
+                                    the file to appear and for new lines to
+                                    be written to it. Without it, stop at the
+                                    end of the file.
+        - poll_interval (float):    Seconds to wait between checks for new
+                                    lines.
+        - max_line_length (int):    Longest line to yield; longer lines are
+                                    split up.
+    '''
+    while not os.path.exists(log_file):
+        if is_finished is None or is_finished():
+            return
+        time.sleep(poll_interval)
+
+    with open(log_file, 'rb') as f:
+        f.seek(offset)
+
+        while True:
+            # Check before reading, so that lines written just before the job
+            # finished aren't missed
+            finished = is_finished is None or is_finished()
+
+            for line in iter(lambda: f.readline(max_line_length), b''):
+                if not finished and not line.endswith(b'\n') and len(line) < max_line_length:
+                    # Wait for the rest of the line
+                    f.seek(offset)
+                    break
+
+                offset += len(line)
+                yield offset, line.decode('utf-8', errors='replace').rstrip('\n')
+
+            if finished:
+                return
+
+            time.sleep(poll_interval)
@@ -0,0 +1,64 @@
+# metrics.py -- expose monitoring data in the Prometheus text format
+# Format docs: https://prometheus.io/docs/instrumenting/exposition_formats/
+
+# Content type of the exposition format
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Counters kept by the queue, and what they count
+COUNTERS = [
+    ('jobs_enqueued', 'Jobs added to the queue.'),
+    ('jobs_coalesced', 'Pushes that replaced a job already waiting in the queue.'),
+    ('jobs_rejected', 'Pushes that were turned away because the queue was full.'),
+    ('requests_rate_limited', 'Webhooks that were turned away for going over the rate limit.'),
+    ('jobs_succeeded', 'Jobs that deployed successfully.'),
+    ('jobs_failed', 'Jobs that failed.'),
+    ('jobs_cancelled', 'Jobs that were cancelled by a newer push.'),
+    ('jobs_retried', 'Failed attempts at jobs that went back on the queue to be retried.'),
+    ('jobs_dead', 'Jobs that were set aside after using up their attempts.'),
+    ('jobs_popped', 'Jobs that were taken off the queue without being tracked.'),
+    ('leases_expired', 'Claimed jobs whose consumer stopped renewing the lease.'),
+]
+
+
+def format_value(value):
+    '''
+    Format a number the way Prometheus expects.
+    '''
+    if value == float('inf'):
+        return '+Inf'
+
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render(metrics):
+    '''
+    Render a snapshot of monitoring data, as returned by `Queue.get_metrics`.
+    '''
+    lines = [
+        '# HELP bunny_hook_queue_depth Jobs in the queue, by status.',
+        '# TYPE bunny_hook_queue_depth gauge',
+    ]
+
+    for status in ('pending', 'running', 'dead'):
+        lines.append('bunny_hook_queue_depth{status="%s"} %d' % (status,
+                                                                metrics['depth'].get(status, 0)))
+
+    for name, description in COUNTERS:
+        metric = 'bunny_hook_%s_total' % name
+        lines.append('# HELP %s %s' % (metric, description))
+        lines.append('# TYPE %s counter' % metric)
+        lines.append('%s %d' % (metric, metrics['counters'].get(name, 0)))
+
+    metric = 'bunny_hook_stage_duration_seconds'
+    lines.append('# HELP %s Time spent in each stage of a job.' % metric)
+    lines.append('# TYPE %s histogram' % metric)
+
+    for stage, histogram in sorted(metrics['histograms'].items()):
+        for le, count in histogram['buckets']:
+            lines.append('%s_bucket{stage="%s",le="%s"} %d' % (metric, stage,
+                                                               format_value(le), count))
+
+        lines.append('%s_sum{stage="%s"} %s' % (metric, stage, format_value(histogram['sum'])))
+        lines.append('%s_count{stage="%s"} %d' % (metric, stage, histogram['count']))
+
+    return '\n'.join(lines) + '\n'
@@ -1,12 +1,265 @@
+# parse_configs.py -- load deploy configs into plans for the Worker
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+
+import yaml
+
+from api.exceptions import WorkerException
+from api.graph import parse_steps, parse_globs
+from api.settings import DEFAULTS
+
+# Use the C parser when PyYAML was built with libyaml
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+
+# Names that the deploy config can have, in the root of the repo
+CONFIG_FILES = ('deploy.yml', 'deploy.yaml')
+
+# Stages of the deploy, in the order they run
+STAGES = ('prebuild', 'build', 'deploy')
+
+# Server settings that a repo can lower for its own deploys, but never raise
+REPO_LIMITS = ('script_timeout', 'job_timeout', 'max_parallel_scripts')
+
+
+def blob_sha(data):
+    '''
+    Return the SHA that git uses for a file with the given contents, so that
+    configs can be matched without hashing them a second way.
+    '''
+    sha = hashlib.sha1(b'blob %d\0' % len(data))
+    sha.update(data)
+    return sha.hexdigest()
+
+
+def parse_count(config, name, default=None):
+    '''
+    Return a directive from `deploy.yml` that has to be a whole number above
+    zero, like a time limit or a number of releases, or `default` if it
+    isn't set.
+    '''
+    value = config.get(name)
+    if value is None:
+        return default
+
+    # YAML reads `yes` as True, which Python would count as 1
+    if isinstance(value, bool) or not isinstance(value, int) or value < 1:
+        raise WorkerException('`%s` must be a whole number above zero: %r' % (name, value))
+
+    return value
+
+
+class Dependency(object):
+    '''
+    A directory of installed dependencies, like a virtualenv or
+    `node_modules`, that can be kept between deploys for as long as the
+    lockfiles it was installed from (`lockfiles`, as a list of globs) don't
+    change.
+    '''
+    def __init__(self, path, lockfiles):
+        self.path = path
+        self.lockfiles = lockfiles
+
+    def __repr__(self):
+        return 'Dependency(%r, lockfiles=%r)' % (self.path, self.lockfiles)
+
+
+def parse_dependencies(entries):
+    '''
+    Turn the `dependencies` directive in `deploy.yml` into Dependencies. Each
+    entry is {'path': directory, 'lockfiles': [globs]}, with both relative
+    to the root of the repo.
+    '''
+    if entries is None:
+        return []
+
+    if not isinstance(entries, list):
+        raise WorkerException('`dependencies` must be a list of directories: %r' % (entries,))
+
+    dependencies = []
+
+    for entry in entries:
+        if not isinstance(entry, dict) or not isinstance(entry.get('path'), str):
+            raise WorkerException('Unrecognized dependencies entry: %r' % (entry,))
+
+        path = os.path.normpath(entry['path'])
+        if os.path.isabs(path) or path == '.' or path.split(os.sep)[0] == '..':
+            raise WorkerException('Dependencies %s must be inside of the repo' % entry['path'])
+
+        lockfiles = parse_globs(entry, 'lockfiles')
+        if not lockfiles:
+            raise WorkerException('Dependencies %s must list their `lockfiles`' % entry['path'])
+
+        dependencies.append(Dependency(path, lockfiles))
+
+    return dependencies
+
+
+class Plan(object):
+    '''
+    Everything a Worker needs to know to run a deploy, worked out from the
+    repo's deploy config and the server config before any scripts run.
+    '''
+    def __init__(self, config_file, home, stages, releases=False, keep_releases=5,
+                 settings=None, dependencies=None):
+        self.config_file = config_file
+        self.home = home
+        self.stages = stages
+        self.dependencies = dependencies or []
+        self.releases = releases
+        self.keep_releases = keep_releases
+        self.settings = settings or {}
+
+    def scripts(self):
+        '''
+        Return the paths of all the scripts in the plan, relative to the root
+        of the repo.
+        '''
+        return [step.script for stage in STAGES for step in self.stages[stage]]
+
+
 class Parse(object):
+    '''
+    Load the deploy config from a repo and merge it with the server config.
+
+    Configs only change when someone commits to them, so parsed configs are
+    kept in memory, keyed on the git blob SHA of the file.
+    '''
+    # Most parsed configs to keep in memory
+    max_cached = 128
+
+    _cache = OrderedDict()
+    _cache_lock = threading.Lock()
+
+    def __init__(self, settings=None):
+        '''
+        Args:
+            - settings (dict): Optional server settings, as returned by
+                               `api.settings.load_settings`.
+        '''
+        self.settings = dict(DEFAULTS, **(settings or {}))
+
+    def find_config(self, repo_path):
+        '''
+        Return the path to the deploy config in the root of a repo.
+        '''
+        found = [os.path.join(repo_path, name) for name in CONFIG_FILES
+                 if os.path.isfile(os.path.join(repo_path, name))]
+
+        if not found:
+            raise WorkerException('Could not locate a `deploy.yml` file in your repo.')
+
+        if len(found) > 1:
+            raise WorkerException('Found two config files in this repo! Delete one and try again.')
+
+        return found[0]
+
+    def load(self, config_file, data):
+        '''
+        Parse and validate the contents of a deploy config. Returns a dict of
+        the arguments for a Plan, apart from `config_file` and `settings`.
+        '''
+        try:
+            config = yaml.load(data, Loader=SafeLoader)
+        except yaml.YAMLError as e:
+            raise WorkerException('Could not parse deployment file %s: %s' % (config_file, e))
+
+        if not config:
+            raise WorkerException('Deployment file %s appears to be empty' % config_file)
+
+        if not isinstance(config, dict):
+            raise WorkerException('Deployment file %s must be a mapping of directives' %
+                                  config_file)
+
+        # Enforce required directives
+        if not config.get('home'):
+            raise WorkerException('Deployment file %s is missing `home` directive' % config_file)
+
+        return {
+            'home': config['home'],
+            # Work out the order of the scripts before running any of them
+            'stages': {stage: parse_steps(config.get(stage, [])) for stage in STAGES},
+            'dependencies': parse_dependencies(config.get('dependencies')),
+            'releases': bool(config.get('releases')),
+            'keep_releases': parse_count(config, 'keep_releases', 5),
+            'limits': {name: parse_count(config, name) for name in REPO_LIMITS
+                       if config.get(name) is not None},
+        }
+
+    def merge(self, limits):
+        '''
+        Return the server settings, with any limits that the repo lowers.
+        '''
+        settings = dict(self.settings)
+
+        for name, value in limits.items():
+            if not settings.get(name) or value < settings[name]:
+                settings[name] = value
+
+        return settings
+
+    def check_scripts(self, plan, repo_path):
+        '''
+        Make sure that every script in the plan exists in the repo, so that a
+        typo fails the deploy before anything has been changed.
+        '''
+        root = os.path.realpath(repo_path)
+        missing = []
+
+        for script in plan.scripts():
+            script_path = os.path.realpath(os.path.join(repo_path, script))
+
+            if os.path.commonpath([root, script_path]) != root:
+                raise WorkerException('Script %s is outside of the repo' % script)
+
+            if not os.path.isfile(script_path):
+                missing.append(script)
+
+        if missing:
+            raise WorkerException('Deployment file {config_file} lists scripts that '
+                                  'don\'t exist: {missing}'.format(config_file=plan.config_file,
+                                                                   missing=', '.join(missing)))
+
+    def parse(self, repo_path):
+        '''
+        Return the Plan for a deploy of a checked out repo.
+
+        Args:
+            - repo_path (str): Root of the checked out repo.
+        '''
+        config_file = self.find_config(repo_path)
+
+        with open(config_file, 'rb') as cf:
+            data = cf.read()
+
+        # Identical configs in different repos give the same plan, apart from
+        # where they were found
+        key = blob_sha(data)
+
+        with self._cache_lock:
+            parsed = self._cache.get(key)
+            if parsed:
+                self._cache.move_to_end(key)
+
+        if not parsed:
+            parsed = self.load(config_file, data)
+
+            with self._cache_lock:
+                self._cache[key] = parsed
+                if len(self._cache) > self.max_cached:
+                    self._cache.popitem(last=False)
 
-    def __init__(self):
-        # Parse first file
-        #
-        # Parse second file
-        #
-        # Merge
+        plan = Plan(config_file, parsed['home'], parsed['stages'],
+                    releases=parsed['releases'],
+                    keep_releases=parsed['keep_releases'],
+                    settings=self.merge(parsed['limits']),
+                    dependencies=parsed['dependencies'])
 
-    def parse():
-        pass
+        self.check_scripts(plan, repo_path)
 
+        return plan
@@ -39,7 +39,15 @@ class Payload(object):
         '''
         Return the URL that the repo can be cloned from.
         '''
-        return self.get('clone_url')
+        repository = self.get('repository') or {}
+        return self.get('clone_url') or repository.get('clone_url')
+
+    def get_sha(self):
+        '''
+        Return the SHA of the commit that the push moved the branch to, or None
+        if the payload doesn't record one.
+        '''
+        return self.get('after')
 
     def get_name(self):
         '''
@@ -48,6 +56,28 @@ class Payload(object):
         repository = self.get('repository')
         return repository.get('name')
 
+    def project(self):
+        '''
+        Return the parts of the payload that a deploy needs, in the same shape
+        as the payload itself. Push payloads list every commit and file that
+        changed, so the full payload can be hundreds of KB.
+        '''
+        job = {}
+
+        for attr in ('ref', 'after'):
+            if self.get(attr) is not None:
+                job[attr] = self.get(attr)
+
+        origin = self.get_origin()
+        if origin:
+            job['clone_url'] = origin
+
+        repository = self.get('repository') or {}
+        if repository.get('name') is not None:
+            job['repository'] = {'name': repository['name']}
+
+        return job
+
     @property
     def as_dict(self):
         '''
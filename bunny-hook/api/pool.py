@@ -0,0 +1,236 @@
+# pool.py -- run work from the queue on a pool of worker processes
+import time
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from api.worker import Worker
+from api.queue import is_retryable
+from api.exceptions import JobCancelled, QueueException
+
+
+def deploy(payload, **options):
+    '''
+    Deploy a payload from the queue, and return the timings of its stages and
+    the home that it deployed to. Runs in a worker process.
+    '''
+    worker = Worker(payload, **options)
+    worker.deploy()
+    return {'timings': worker.timings, 'home': worker.home}
+
+
+class WorkerPool(object):
+    '''
+    Run jobs from a Queue on a pool of worker processes, so that a long build
+    of one repo or branch doesn't hold up deploys of the others. Jobs for the
+    same branch never overlap, since the queue won't hand them out while one
+    is running.
+    '''
+    def __init__(self, queue, workers, target=deploy):
+        '''
+        Args:
+            - queue (Queue):      The queue to consume.
+            - workers (int):      Maximum number of jobs to run at once.
+            - target (callable):  Picklable function that runs a job, given
+                                  its payload and the keyword arguments from
+                                  `Queue.worker_options`. It can return a list
+                                  of timings to record, like `Worker.timings`,
+                                  or a dict of those `timings` and the `home`
+                                  that the job deployed to.
+        '''
+        self.queue = queue
+        self.workers = workers
+        self.target = target
+
+        self.executor = ProcessPoolExecutor(max_workers=workers)
+
+        # Map futures for running jobs to their IDs in the queue
+        self.running = {}
+
+        # Results of finished jobs that the queue couldn't be told about yet
+        # (e.g. a remote queue was down), by future. Their jobs stay in
+        # `running` until `finish` gets through.
+        self.unreported = {}
+
+        # When (on the monotonic clock) to next renew the leases on running
+        # jobs
+        self.next_heartbeat = 0
+
+    def fill(self):
+        '''
+        Claim jobs from the queue until every worker is busy. Returns the
+        number of jobs that were started.
+        '''
+        started = 0
+
+        free = self.workers - len(self.running)
+        if not free:
+            return started
+
+        # Claim a job for every free worker in one transaction
+        claimed = self.queue.claim_many(free)
+
+        for i, (work_id, payload) in enumerate(claimed):
+            try:
+                future = self.submit(work_id, payload)
+            except Exception as e:
+                # Put back the jobs that never started, rather than leaving
+                # them leased until the leases run out
+                try:
+                    for unstarted_id, _ in claimed[i:]:
+                        self.queue.finish(unstarted_id, 'failed', retry=True,
+                                          error='Could not start job: %s' % e)
+                except QueueException as error:
+                    logging.warning('Could not put back jobs: %s' % error)
+                raise
+
+            self.running[future] = work_id
+            started += 1
+
+            # Wake up the pool when the job finishes, so that it can start
+            # another one
+            future.add_done_callback(lambda future: self.queue.notify())
+
+        return started
+
+    def submit(self, work_id, payload):
+        '''
+        Start a job on a worker process, and return its future. If a worker
+        process has died since the last job was started, the pool is
+        restarted first. The jobs that were running when it died fail with
+        BrokenProcessPool, and `reap` puts them back on the queue.
+        '''
+        options = self.queue.worker_options(work_id)
+
+        try:
+            return self.executor.submit(self.target, payload, **options)
+        except BrokenProcessPool:
+            self.restart()
+            return self.executor.submit(self.target, payload, **options)
+
+    def restart(self):
+        '''
+        Replace the worker processes after one of them died (e.g. a build
+        got it killed), which leaves the executor unable to run anything.
+        '''
+        logging.warning('A worker process died; restarting the pool')
+        self.executor.shutdown(wait=False)
+        self.executor = ProcessPoolExecutor(max_workers=self.workers)
+
+    def reap(self):
+        '''
+        Remove finished jobs from the queue. Returns the number of jobs that
+        were removed. Results that can't be reported because the queue can't
+        be reached are kept, and reported on a later call.
+        '''
+        for future in self.running:
+            if future.done() and future not in self.unreported:
+                self.unreported[future] = self.get_result(self.running[future], future)
+
+        reaped = 0
+
+        for future, result in list(self.unreported.items()):
+            work_id = self.running[future]
+
+            try:
+                self.queue.finish(work_id, **result)
+            except QueueException as e:
+                # The queue is most likely down for the rest of them too
+                logging.warning('Could not report the result of job %s: %s' % (work_id, e))
+                break
+
+            del self.unreported[future]
+            del self.running[future]
+            reaped += 1
+
+        return reaped
+
+    def get_result(self, work_id, future):
+        '''
+        Return the keyword arguments to `finish` a job with, given the future
+        that ran it.
+        '''
+        status, timings, error, home = 'failed', None, None, None
+
+        try:
+            timings = future.result()
+            status = 'succeeded'
+            if isinstance(timings, dict):
+                timings, home = timings.get('timings'), timings.get('home')
+        except JobCancelled as e:
+            logging.info(str(e))
+            status, timings = 'cancelled', getattr(e, 'timings', None)
+            home = getattr(e, 'home', None)
+        except Exception as e:
+            logging.error('Job %s failed: %s' % (work_id, e))
+            timings, error = getattr(e, 'timings', None), e
+            home = getattr(e, 'home', None)
+
+        return {'status': status, 'timings': timings if isinstance(timings, list) else None,
+                'retry': is_retryable(error), 'error': str(error) if error else None,
+                'exit_code': getattr(error, 'returncode', None), 'home': home}
+
+    def heartbeat(self):
+        '''
+        Renew the leases on running jobs, if they're due. Leases get renewed
+        three times per lease, and `run_forever` wakes up in time for each
+        renewal. If the queue can't be reached, renewals are tried again a
+        quarter of that interval later, until they get through.
+        '''
+        now = time.monotonic()
+        if now < self.next_heartbeat:
+            return
+
+        interval = self.queue.lease_time / 3
+
+        for work_id in self.running.values():
+            try:
+                if not self.queue.heartbeat(work_id):
+                    logging.warning('Lost the lease on job %s; it may run twice' % work_id)
+            except QueueException as e:
+                logging.warning('Could not renew the lease on job %s: %s' % (work_id, e))
+                self.next_heartbeat = now + interval / 4
+                return
+
+        self.next_heartbeat = now + interval
+
+    def run_forever(self, until_empty=False):
+        '''
+        Keep the workers busy with jobs from the queue. When there's nothing
+        to do, block until work arrives or a job finishes.
+
+        Args:
+            - until_empty (bool): Return once the queue has no work left,
+                                  instead of running forever.
+        '''
+        self.queue.listen()
+
+        wait = self.queue.min_wait
+
+        while True:
+            self.heartbeat()
+
+            if self.reap() + self.fill():
+                wait = self.queue.min_wait
+                continue
+
+            if until_empty and not self.running:
+                return
+
+            # Wake up in time to renew the leases on running jobs, however
+            # long the backoff has grown
+            timeout = wait
+            if self.running:
+                timeout = min(wait, max(self.next_heartbeat - time.monotonic(), 0))
+
+            if self.queue.wait(timeout):
+                wait = self.queue.min_wait
+            else:
+                wait = min(wait * 2, self.queue.max_wait)
+
+    def shutdown(self):
+        '''
+        Wait for running jobs to finish and stop the worker processes.
+        '''
+        self.executor.shutdown()
+        self.reap()
@@ -1,13 +1,492 @@
 # queue.py -- run tasks from a queue
+import os
 import sqlite3
 import time
 import json
-from uuid import uuid4
+import gzip
+import math
+import fcntl
+import select
+import socket
+import logging
+import threading
+from contextlib import contextmanager
 
-from api.worker import Worker
+from api.payload import Payload
+from api.settings import load_settings
+from api.exceptions import JobCancelled, CheckoutFailed, QueueException, QueueFull
 
 
-class Queue(object):
+# Schema migrations, in order. Each one is a list of statements, and the
+# database's `user_version` records how many of them have been applied.
+MIGRATIONS = [
+    # 1: Key jobs on an integer ID, track their status, and index them in the
+    # order that they get claimed. Databases from before migrations existed
+    # store jobs under a UUID; copy those jobs over in their original order.
+    [
+        '''
+            CREATE TABLE IF NOT EXISTS queue
+                (id TEXT, payload TEXT, date_added NUMERIC)
+        ''',
+        'ALTER TABLE queue RENAME TO queue_v0',
+        '''
+            CREATE TABLE queue
+                (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                 payload TEXT NOT NULL,
+                 status TEXT NOT NULL DEFAULT 'pending',
+                 date_added REAL NOT NULL,
+                 date_claimed REAL)
+        ''',
+        '''
+            INSERT INTO queue (payload, date_added)
+                 SELECT payload, date_added
+                   FROM queue_v0
+               ORDER BY date_added
+        ''',
+        'DROP TABLE queue_v0',
+        'CREATE INDEX queue_claim ON queue (status, date_added, id)',
+    ],
+    # 2: Jobs that share a lock key (the name of the repo) must never run at
+    # the same time, since they build in the same directories
+    [
+        'ALTER TABLE queue ADD COLUMN lock_key TEXT',
+        "UPDATE queue SET lock_key = json_extract(payload, '$.repository.name')",
+        'CREATE INDEX queue_lock_key ON queue (status, lock_key)',
+    ],
+    # 3: Pushes to the same ref of a repo replace each other while they wait
+    # in the queue, and mark a running deploy of that ref as superseded
+    [
+        'ALTER TABLE queue ADD COLUMN ref TEXT',
+        'ALTER TABLE queue ADD COLUMN superseded INTEGER NOT NULL DEFAULT 0',
+        "UPDATE queue SET ref = json_extract(payload, '$.ref')",
+        'CREATE INDEX queue_coalesce ON queue (lock_key, ref, status)',
+    ],
+    # 4: Counters and timing histograms for monitoring, and a record of how
+    # long each stage of each job took
+    [
+        '''
+            CREATE TABLE counters
+                (name TEXT PRIMARY KEY,
+                 value INTEGER NOT NULL DEFAULT 0)
+        ''',
+        '''
+            CREATE TABLE timings
+                (job_id INTEGER NOT NULL,
+                 stage TEXT NOT NULL,
+                 name TEXT,
+                 start REAL,
+                 duration REAL NOT NULL)
+        ''',
+        'CREATE INDEX timings_job_id ON timings (job_id)',
+        '''
+            CREATE TABLE histogram_buckets
+                (stage TEXT NOT NULL,
+                 le REAL NOT NULL,
+                 count INTEGER NOT NULL DEFAULT 0,
+                 PRIMARY KEY (stage, le))
+        ''',
+        '''
+            CREATE TABLE histogram_totals
+                (stage TEXT PRIMARY KEY,
+                 sum REAL NOT NULL DEFAULT 0,
+                 count INTEGER NOT NULL DEFAULT 0)
+        ''',
+    ],
+    # 5: Only store the parts of a payload that a deploy needs (see
+    # `Payload.project`). Merging into an empty object drops missing values.
+    [
+        '''
+            UPDATE queue
+               SET payload = json_patch('{}', json_object(
+                       'ref', json_extract(payload, '$.ref'),
+                       'after', json_extract(payload, '$.after'),
+                       'clone_url', coalesce(json_extract(payload, '$.clone_url'),
+                                             json_extract(payload, '$.repository.clone_url')),
+                       'repository', json_patch('{}', json_object(
+                           'name', json_extract(payload, '$.repository.name')))))
+        ''',
+    ],
+    # 6: Claimed jobs are leased to a consumer for a while, and go back on the
+    # queue if the lease runs out. Jobs that fail for passing reasons are
+    # retried after a delay, up to a limit, and then set aside as dead.
+    [
+        'ALTER TABLE queue ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0',
+        'ALTER TABLE queue ADD COLUMN lease_expires REAL',
+        'ALTER TABLE queue ADD COLUMN available_at REAL NOT NULL DEFAULT 0',
+        'ALTER TABLE queue ADD COLUMN last_error TEXT',
+        'CREATE INDEX queue_lease ON queue (status, lease_expires)',
+        '''
+            CREATE TABLE dead_letter
+                (id INTEGER PRIMARY KEY,
+                 payload TEXT NOT NULL,
+                 lock_key TEXT,
+                 ref TEXT,
+                 attempts INTEGER NOT NULL,
+                 date_added REAL NOT NULL,
+                 date_failed REAL NOT NULL,
+                 last_error TEXT)
+        ''',
+    ],
+    # 7: Keep a record of each job once it leaves the queue, so that clients
+    # can look up how it went
+    [
+        '''
+            CREATE TABLE jobs
+                (id INTEGER PRIMARY KEY,
+                 lock_key TEXT,
+                 ref TEXT,
+                 sha TEXT,
+                 status TEXT NOT NULL,
+                 attempts INTEGER NOT NULL,
+                 date_added REAL NOT NULL,
+                 date_claimed REAL,
+                 date_finished REAL NOT NULL,
+                 exit_code INTEGER,
+                 error TEXT)
+        ''',
+        'CREATE INDEX jobs_lock_key ON jobs (lock_key, id)',
+    ],
+    # 8: Jobs are claimed in order of a virtual start time that accounts for
+    # their priority and their repo's share of the builders, rather than
+    # first come, first served
+    [
+        'ALTER TABLE queue ADD COLUMN priority INTEGER NOT NULL DEFAULT 0',
+        'ALTER TABLE queue ADD COLUMN vtime REAL NOT NULL DEFAULT 0',
+        'UPDATE queue SET vtime = date_added',
+        'CREATE INDEX queue_schedule ON queue (status, vtime, id)',
+        '''
+            CREATE TABLE repo_clocks
+                (lock_key TEXT PRIMARY KEY,
+                 vtime REAL NOT NULL)
+        ''',
+    ],
+    # 9: The home directory that each branch of a repo last deployed to, so
+    # that branches which share a home aren't claimed at the same time
+    [
+        '''
+            CREATE TABLE homes
+                (lock_key TEXT NOT NULL,
+                 ref TEXT NOT NULL,
+                 home TEXT NOT NULL,
+                 PRIMARY KEY (lock_key, ref))
+        ''',
+    ],
+]
+
+# Upper bounds (in seconds) of the buckets in timing histograms
+BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600, 1200, 1800, 3600, float('inf'))
+
+# Query for the ID of the next job to claim: the pending job with the earliest
+# virtual start time (see `Queue.schedule`) that isn't waiting to be retried,
+# and whose lock key and ref aren't held by a running job. Other branches of
+# the same repo build in their own directories, so they can run alongside it,
+# but only once both are known to deploy to different homes; otherwise the
+# second one would only sit in a worker waiting for the first to finish.
+NEXT_JOB = '''
+    SELECT id
+      FROM queue
+     WHERE status = 'pending'
+       AND available_at <= :now
+       AND (lock_key IS NULL
+            OR NOT EXISTS (SELECT 1
+                             FROM queue AS running
+                        LEFT JOIN homes AS pending_home
+                               ON pending_home.lock_key = queue.lock_key
+                              AND pending_home.ref = queue.ref
+                        LEFT JOIN homes AS running_home
+                               ON running_home.lock_key = running.lock_key
+                              AND running_home.ref = running.ref
+                            WHERE running.lock_key = queue.lock_key
+                              AND running.status = 'running'
+                              AND (running.ref IS queue.ref
+                                   OR pending_home.home IS NULL
+                                   OR running_home.home IS NULL
+                                   OR running_home.home = pending_home.home)))
+  ORDER BY vtime, id
+     LIMIT 1
+'''
+
+# Columns of a job record, as returned by `Queue.get_job`, and how to select
+# them from jobs that are still in the queue and from the history of jobs that
+# have left it
+JOB_COLUMNS = ('id', 'repo', 'ref', 'sha', 'status', 'attempts', 'date_added',
+               'date_claimed', 'date_finished', 'exit_code', 'error')
+
+QUEUED_JOB = '''
+    SELECT id, lock_key, ref, json_extract(payload, '$.after'), status, attempts,
+           date_added, date_claimed, NULL, NULL, last_error
+      FROM queue
+'''
+
+FINISHED_JOB = '''
+    SELECT id, lock_key, ref, sha, status, attempts, date_added, date_claimed,
+           date_finished, exit_code, error
+      FROM jobs
+'''
+
+# Statuses of jobs that have left the queue
+FINISHED = ('succeeded', 'failed', 'cancelled', 'dead', 'popped')
+
+
+def is_retryable(error):
+    '''
+    Check whether a job that failed with an error is worth running again.
+    Failures to fetch the repo usually pass (e.g. GitHub or the network was
+    down), but a build script that fails will fail the same way next time.
+
+    Args:
+        - error (Exception): What the job failed with, or None.
+    '''
+    from concurrent.futures.process import BrokenProcessPool
+
+    return isinstance(error, (CheckoutFailed, BrokenProcessPool))
+
+
+def get_lock_key(payload):
+    '''
+    Return the key that serializes a job against other jobs for the same
+    ref, or None if the job can run alongside anything. Jobs for different
+    refs of the same repo only wait for each other if they deploy to the
+    same `home`, which the Worker checks for itself.
+
+    Args:
+        - payload (dict): An event from the GitHub API.
+    '''
+    repository = payload.get('repository') or {}
+    return repository.get('name')
+
+
+class BaseQueue(object):
+    '''
+    Interface for queues of deployment jobs, and the consumer loop that runs
+    them. `Queue` keeps jobs in a local SQLite database; `api.remote.RemoteQueue`
+    consumes a Queue on another host over HTTP.
+    '''
+    # Bounds (in seconds) on how long an idle consumer waits between checks of
+    # the queue. The wait starts at `min_wait` and doubles up to `max_wait`
+    # while the queue stays empty; a wakeup from `add` cuts it short.
+    min_wait = 0.05
+    max_wait = 5.0
+
+    # Whether a running deploy should stop early once a newer push for the
+    # same repo and ref arrives
+    cancel_superseded = False
+
+    # How long (in seconds) a consumer holds a claimed job before it goes back
+    # on the queue. Consumers renew the lease while the job runs, three times
+    # per lease, so only jobs whose consumer died get handed out again.
+    lease_time = 60
+
+    # Where the queue lives, as passed to `get_queue`
+    db_conn = None
+
+    def add(self, payload, raw=None, priority=None):
+        '''
+        Drop a work payload into the queue, and return the ID of the job.
+        '''
+        raise NotImplementedError
+
+    def pop(self):
+        '''
+        Return the oldest payload and remove it from the queue.
+        '''
+        raise NotImplementedError
+
+    def add_many(self, payloads, raws=None, priority=None):
+        '''
+        Drop a batch of work payloads into the queue, and return the ID of the
+        job for each one, or None where the queue was full.
+        '''
+        raise NotImplementedError
+
+    def claim(self):
+        '''
+        Mark the oldest job that can run as running, and return a tuple of its
+        ID and payload, or None if there's no work.
+        '''
+        raise NotImplementedError
+
+    def claim_many(self, limit):
+        '''
+        Claim up to `limit` jobs at once, and return a list of tuples of their
+        IDs and payloads.
+        '''
+        raise NotImplementedError
+
+    def finish(self, work_id, status='succeeded', timings=None, retry=False, error=None,
+               exit_code=None, home=None):
+        '''
+        Remove a claimed job from the queue, and record how it went. Failed
+        jobs can be put back on the queue to be retried.
+        '''
+        raise NotImplementedError
+
+    def heartbeat(self, work_id):
+        '''
+        Renew the lease on a claimed job. Returns False if the job is no
+        longer leased to this consumer.
+        '''
+        raise NotImplementedError
+
+    def lease(self, work_id):
+        '''
+        Return a picklable callable that renews the lease on a claimed job,
+        from any thread or process.
+        '''
+        raise NotImplementedError
+
+    def is_superseded(self, work_id):
+        '''
+        Check whether a newer push has arrived for the same repo and ref as a
+        running job.
+        '''
+        raise NotImplementedError
+
+    def get_metrics(self):
+        '''
+        Return a snapshot of the monitoring data for the queue.
+        '''
+        raise NotImplementedError
+
+    def notify(self):
+        '''
+        Wake up a consumer that is waiting on the queue.
+        '''
+        raise NotImplementedError
+
+    def listen(self):
+        '''
+        Start listening for wakeups.
+        '''
+        raise NotImplementedError
+
+    def wait(self, timeout):
+        '''
+        Block until there might be new work or `timeout` seconds pass. Returns
+        True if the wait was cut short.
+        '''
+        raise NotImplementedError
+
+    def close(self):
+        '''
+        Release the queue's connections.
+        '''
+        raise NotImplementedError
+
+    def worker_options(self, work_id):
+        '''
+        Return keyword arguments for the Worker that runs a job. These can be
+        sent to worker processes.
+
+        Args:
+            - work_id (int): ID of the job, as returned by `claim`.
+        '''
+        options = {'settings': self.settings}
+
+        log_file = self.get_log_file(work_id)
+        if log_file:
+            os.makedirs(os.path.dirname(log_file), exist_ok=True)
+            options['log_file'] = log_file
+
+        if self.cancel_superseded:
+            options['is_cancelled'] = self.cancellation(work_id)
+
+        return options
+
+    def get_log_file(self, work_id):
+        '''
+        Return the path of a job's log file, or None if the server config
+        doesn't set a `log_path`.
+        '''
+        log_path = self.settings.get('log_path')
+        if not log_path:
+            return None
+
+        return os.path.join(log_path, '%d.log' % work_id)
+
+    def cancellation(self, work_id):
+        '''
+        Return a picklable callable that checks whether a job has been
+        superseded, from any process.
+        '''
+        return Cancellation(self.db_conn, work_id)
+
+    def run(self):
+        '''
+        Check for work on the queue, and if it exists, deploy it. Returns True
+        if any work was found.
+        '''
+        work = self.claim()
+        if not work:
+            return False
+
+        # Only consumers run jobs, so the API server never imports the Worker
+        from api.worker import Worker
+
+        work_id, payload = work
+        worker = None
+        status, error = 'failed', None
+
+        # If the consumer gets interrupted, the job is left to go back on the
+        # queue once its lease runs out
+        with Heartbeat(self.lease(work_id), self.lease_time / 3):
+            try:
+                worker = Worker(payload, **self.worker_options(work_id))
+                worker.deploy()
+                status = 'succeeded'
+            except JobCancelled as e:
+                logging.info(str(e))
+                status = 'cancelled'
+            except Exception as e:
+                logging.error('Job %s failed: %s' % (work_id, e))
+                error = e
+
+            self.report(work_id, status, worker.timings if worker else None,
+                        retry=is_retryable(error), error=str(error) if error else None,
+                        exit_code=getattr(error, 'returncode', None),
+                        home=worker.home if worker else None)
+
+        return True
+
+    def report(self, work_id, *args, **kwargs):
+        '''
+        Finish a job, like `finish`, but if the queue can't be reached (e.g.
+        the API server of a remote queue is restarting), keep trying with
+        backoff instead of losing the result.
+        '''
+        wait = self.min_wait
+
+        while True:
+            try:
+                return self.finish(work_id, *args, **kwargs)
+            except QueueException as e:
+                logging.warning('Could not report the result of job %s: %s' % (work_id, e))
+
+            time.sleep(wait)
+            wait = min(wait * 2, self.max_wait)
+
+    def run_forever(self):
+        '''
+        Consume the queue in an endless loop. When the queue is empty, block
+        until a producer signals new work, polling with exponential backoff in
+        case a wakeup is missed.
+        '''
+        self.listen()
+
+        wait = self.min_wait
+
+        while True:
+            if self.run():
+                wait = self.min_wait
+                continue
+
+            if self.wait(wait):
+                wait = self.min_wait
+            else:
+                wait = min(wait * 2, self.max_wait)
+
+
+class Queue(BaseQueue):
     '''
     Create and manage a queue of deployment jobs. This class bridges the API
     and the Worker, so that deployment doesn't have to be attached to the
@@ -16,77 +495,1152 @@ class Queue(object):
     # Default SQLite connection string
     db_conn = 'hook.db'
 
-    def __init__(self, db_conn=None):
+    # Whether a new push replaces a pending job for the same repo and ref,
+    # rather than queueing another deploy
+    coalesce = True
+
+    # How long (in seconds) a connection waits on a lock held by another
+    # connection before giving up
+    busy_timeout = 10
+
+    # How long (in seconds) to tell producers to wait when the queue is full,
+    # until it knows how long jobs take
+    retry_after = 30
+
+    # Most times a job is claimed before it's set aside as dead, and the
+    # delays (in seconds) before retrying it: `retry_backoff` after the first
+    # attempt, doubling after each one, up to `max_backoff`
+    max_attempts = 3
+    retry_backoff = 30
+    max_backoff = 900
+
+    # Scheduling: each priority level is worth `priority_aging` seconds of
+    # waiting, so a job can only be overtaken by higher-priority jobs for a
+    # bounded time. Each repo's jobs are spaced out by the average job time
+    # divided by the repo's weight, but a busy repo's new jobs are never put
+    # more than `fair_share_window` seconds behind other repos' new jobs.
+    max_priority = 100
+    priority_aging = 60
+    fair_share_window = 600
+
+    # Durability setting for the connection. In WAL mode, NORMAL only syncs
+    # at checkpoints, and can't corrupt the database on a crash
+    synchronous = 'NORMAL'
+
+    # Paths of datastores whose schema has already been set up by this
+    # process, so that new connections can skip it
+    _ready = set()
+    _ready_lock = threading.Lock()
+
+    def __init__(self, db_conn=None, settings=None):
         '''
         Initialize a connection to the datastore.
 
         Args:
             - db_conn (string): Optional SQLite connection string, if the class
                                 should use a different datastore.
+            - settings (dict):  Optional server settings to pass on to
+                                Workers, as returned by
+                                `api.settings.load_settings`.
         '''
         if db_conn:
             self.db_conn = db_conn
 
-        self.conn = sqlite3.connect(self.db_conn)
+        self.settings = settings or {}
+        self.archive_path = self.settings.get('archive_path')
+        self.max_depth = self.settings.get('max_queue_depth')
+        self.max_repo_depth = self.settings.get('max_repo_depth')
+        self.retry_after = self.settings.get('retry_after') or self.retry_after
+        self.lease_time = self.settings.get('lease_time') or self.lease_time
+        self.max_attempts = self.settings.get('max_attempts') or self.max_attempts
+        self.retry_backoff = self.settings.get('retry_backoff') or self.retry_backoff
+        self.priorities = self.settings.get('priorities') or {}
+        self.repo_weights = self.settings.get('repo_weights') or {}
+        self.priority_aging = self.settings.get('priority_aging') or self.priority_aging
+        self.fair_share_window = self.settings.get('fair_share_window') or self.fair_share_window
+
+        # Map jobs claimed through this queue to their attempt numbers, so
+        # that a consumer whose lease ran out can't finish a later attempt
+        self.attempts = {}
+
+        # Run in autocommit mode, and manage transactions explicitly
+        self.conn = sqlite3.connect(self.db_conn, timeout=self.busy_timeout,
+                                    isolation_level=None)
         self.cursor = self.conn.cursor()
+        self.cursor.execute('PRAGMA synchronous = %s' % self.synchronous)
 
-        # Create a table for the queue if it doesn't exist
-        create_table = '''
-            CREATE TABLE IF NOT EXISTS queue
-                (id TEXT, payload TEXT, date_added NUMERIC)
+        # Consumers listen for wakeups from producers on a Unix datagram
+        # socket that lives next to the database file
+        self.sock_path = os.path.abspath(self.db_conn) + '.sock'
+        self.listener = None
+        self.listener_lock = None
+        self.sender = None
+        self.sender_lock = threading.Lock()
+
+        self.setup()
+
+    def setup(self):
         '''
-        self.cursor.execute(create_table)
+        Set up the datastore, if this process hasn't done so already.
+        '''
+        # Key on the file's inode as well as its path, so that a database that
+        # gets deleted and recreated is set up again
+        try:
+            key = (os.path.abspath(self.db_conn), os.stat(self.db_conn).st_ino)
+        except OSError:
+            key = None
+
+        with self._ready_lock:
+            if key and key in self._ready:
+                return
+
+            # The journal mode is stored in the database file, so it only needs
+            # to be set once
+            self.cursor.execute('PRAGMA journal_mode = WAL')
 
-    def add(self, payload):
+            self.migrate()
+
+            if key:
+                self._ready.add(key)
+
+    @contextmanager
+    def transaction(self):
+        '''
+        Run a block of statements in a single write transaction, rolling it
+        back if anything goes wrong.
+        '''
+        self.cursor.execute('BEGIN IMMEDIATE')
+
+        try:
+            yield
+        except BaseException:
+            self.cursor.execute('ROLLBACK')
+            raise
+
+        self.cursor.execute('COMMIT')
+
+    def migrate(self):
+        '''
+        Bring the schema of the datastore up to date, including databases
+        created by older versions of this module.
+        '''
+        with self.transaction():
+            version = self.cursor.execute('PRAGMA user_version').fetchone()[0]
+
+            for migration in MIGRATIONS[version:]:
+                for statement in migration:
+                    self.cursor.execute(statement)
+
+            self.cursor.execute('PRAGMA user_version = %d' % len(MIGRATIONS))
+
+    def add(self, payload, raw=None, priority=None):
         '''
         Package up a work payload and drop it into the queue. Returns the ID
         of the queued work.
 
+        Only the parts of the payload that a deploy needs get queued. If the
+        queue has an `archive_path`, the full payload is kept there as well,
+        compressed, under the ID of the job.
+
+        If a job for the same repo and ref is already waiting in the queue, its
+        payload is replaced with this one, so that only the newest push gets
+        deployed, and the ID of that job is returned.
+
+        Raises QueueFull if a new job would put the queue over `max_depth` jobs
+        waiting, or its repo over `max_repo_depth`. Replacing a waiting job is
+        always allowed.
+
         Args:
-            - payload (dict): An event from the GitHub API.
+            - payload (dict):   An event from the GitHub API.
+            - raw (bytes):      Optional JSON that the payload was parsed from,
+                                to archive as-is instead of serializing it
+                                again.
+            - priority (int):   Optional priority for the job, from -100 to
+                                100; higher runs sooner. Defaults to the
+                                priority that the server config gives its
+                                branch (see `get_priority`).
         '''
-        work_id = str(uuid4())
+        with self.transaction():
+            work_id, full = self.enqueue(payload, priority)
+
+            if full:
+                retry_after = self.get_retry_after()
+
+        # The count of rejected jobs is committed before raising
+        if full:
+            raise QueueFull(full, retry_after)
+
+        if self.archive_path:
+            self.archive(work_id, raw if raw else json.dumps(payload).encode('utf-8'))
+
+        self.notify()
+
+        return work_id
+
+    def add_many(self, payloads, raws=None, priority=None):
+        '''
+        Drop a batch of work payloads into the queue in a single transaction,
+        e.g. to replay a backlog, so that the whole batch costs one commit.
+        Returns the ID of the job for each payload, in order, with None for
+        payloads that were turned away because the queue was full.
+
+        Each payload is queued as if by `add`, so pushes to the same ref
+        later in the batch replace earlier ones.
+
+        Args:
+            - payloads (list):  Events from the GitHub API.
+            - raws (list):      Optional JSON that each payload was parsed
+                                from, as for `add`.
+            - priority (int):   Optional priority for every job in the
+                                batch, as for `add`.
+        '''
+        with self.transaction():
+            work_ids = [self.enqueue(payload, priority)[0] for payload in payloads]
+
+        if self.archive_path:
+            for work_id, payload, raw in zip(work_ids, payloads, raws or [None] * len(payloads)):
+                if work_id is not None:
+                    self.archive(work_id, raw if raw else json.dumps(payload).encode('utf-8'))
+
+        if any(work_id is not None for work_id in work_ids):
+            self.notify()
+
+        return work_ids
+
+    def enqueue(self, payload, priority=None, work_id=None):
+        '''
+        Queue a payload, replacing a waiting job for the same ref. Returns a
+        tuple of the job's ID and None, or of None and a message saying which
+        depth limit was hit. Call this inside a transaction.
+
+        A dead job that's redelivered keeps its ID (`work_id`). It's older
+        than any job waiting for the same ref, so it gives way to that job
+        instead of replacing it.
+        '''
+        lock_key = get_lock_key(payload)
+        ref = payload.get('ref')
+        serialized = json.dumps(Payload(payload).project(), separators=(',', ':'))
+        now = time.time()
+
+        if priority is None:
+            priority = self.get_priority(payload)
+
+        priority = max(-self.max_priority, min(priority, self.max_priority))
+
+        if self.coalesce and lock_key and ref and work_id is not None:
+            select = '''
+                SELECT id
+                  FROM queue
+                 WHERE lock_key = ?
+                   AND ref = ?
+                   AND status = 'pending'
+            '''
+            pending = self.cursor.execute(select, (lock_key, ref)).fetchone()
+            if pending:
+                self.increment('jobs_coalesced')
+                return pending[0], None
+
+        elif self.coalesce and lock_key and ref:
+            # A job waiting to be retried gets a fresh start. The job keeps
+            # its place, unless the new push is more urgent.
+            update = '''
+                UPDATE queue
+                   SET payload = :payload,
+                       attempts = 0,
+                       available_at = 0,
+                       last_error = NULL,
+                       priority = max(priority, :priority),
+                       vtime = min(vtime, :vtime)
+                 WHERE lock_key = :lock_key
+                   AND ref = :ref
+                   AND status = 'pending'
+             RETURNING id
+            '''
+            pending = self.cursor.execute(update, {
+                'payload': serialized, 'priority': priority,
+                'vtime': now - priority * self.priority_aging,
+                'lock_key': lock_key, 'ref': ref,
+            }).fetchall()
+            if pending:
+                self.increment('jobs_coalesced')
+                return pending[0][0], None
+
+        full = self.check_depth(lock_key)
+        if full:
+            self.increment('jobs_rejected')
+            return None, full
 
         insert = '''
             INSERT INTO queue
-                     (id, payload, date_added)
-              VALUES (?, ?, ?)
+                     (id, payload, date_added, lock_key, ref, priority, vtime)
+              VALUES (?, ?, ?, ?, ?, ?, ?)
         '''
-        self.cursor.execute(insert, (work_id, json.dumps(payload), time.time()))
+        vtime = self.schedule(lock_key, priority, now)
+        self.cursor.execute(insert, (work_id, serialized, now, lock_key, ref, priority, vtime))
+        work_id = self.cursor.lastrowid
+        self.increment('jobs_enqueued')
 
-        self.conn.commit()
+        # Any deploy of this ref that's still running is now out of date
+        if lock_key and ref:
+            supersede = '''
+                UPDATE queue
+                   SET superseded = 1
+                 WHERE lock_key = ?
+                   AND ref = ?
+                   AND status = 'running'
+            '''
+            self.cursor.execute(supersede, (lock_key, ref))
 
-        return work_id
+        return work_id, None
+
+    def get_priority(self, payload):
+        '''
+        Return the priority that the server config's `priorities` gives a
+        push, keyed on `<repo>/<branch>` or on the branch alone, or 0.
+        '''
+        if not self.priorities or not payload.get('ref'):
+            return 0
+
+        payload = Payload(payload)
+        branch = payload.get_branch()
+        repository = payload.get('repository') or {}
+
+        name = '{repo}/{branch}'.format(repo=repository.get('name'), branch=branch)
+        return self.priorities.get(name, self.priorities.get(branch, 0))
+
+    def schedule(self, lock_key, priority, now):
+        '''
+        Return the virtual start time of a new job, which jobs are claimed in
+        order of, and move its repo's clock on. Call this inside a
+        transaction.
+
+        Each repo has a clock that runs ahead of real time by the work it has
+        queued: the average job time for each job, divided by the repo's
+        weight in `repo_weights`. A new job starts from its repo's clock, so
+        a repo that floods the queue waits its turn behind the others, but
+        never more than `fair_share_window` seconds behind them. The job is
+        then moved earlier by `priority_aging` seconds for each level of
+        priority. Since a job's virtual start time never changes, a waiting
+        job can't be overtaken forever: new jobs start from the present.
+
+        Args:
+            - lock_key (str):   Lock key of the job, as returned by
+                                `get_lock_key`.
+            - priority (int):   Priority of the job.
+            - now (float):      Time the job was added.
+        '''
+        start = now
+
+        if lock_key:
+            select = 'SELECT vtime FROM repo_clocks WHERE lock_key = ?'
+            clock = self.cursor.execute(select, (lock_key,)).fetchone()
+
+            if clock:
+                start = min(max(clock[0], now), now + self.fair_share_window)
+
+            # Jobs take as long as they usually do (see `get_retry_after`)
+            weight = self.repo_weights.get(lock_key) or 1
+            upsert = '''
+                INSERT INTO repo_clocks (lock_key, vtime)
+                     VALUES (?, ?)
+                ON CONFLICT (lock_key) DO UPDATE
+                        SET vtime = excluded.vtime
+            '''
+            self.cursor.execute(upsert, (lock_key, start + self.get_retry_after() / weight))
+
+        return start - priority * self.priority_aging
+
+    def check_depth(self, lock_key):
+        '''
+        Check whether there's room in the queue for another job. Returns None
+        if there is, or else a message saying which limit was hit.
+
+        Args:
+            - lock_key (str): Lock key of the new job, as returned by
+                              `get_lock_key`.
+        '''
+        if self.max_depth:
+            select = "SELECT COUNT(*) FROM queue WHERE status = 'pending'"
+            depth = self.cursor.execute(select).fetchone()[0]
+
+            if depth >= self.max_depth:
+                return 'Queue is full ({depth} jobs waiting)'.format(depth=depth)
+
+        if self.max_repo_depth and lock_key:
+            select = '''
+                SELECT COUNT(*)
+                  FROM queue
+                 WHERE status = 'pending'
+                   AND lock_key = ?
+            '''
+            depth = self.cursor.execute(select, (lock_key,)).fetchone()[0]
+
+            if depth >= self.max_repo_depth:
+                return 'Queue is full for repo {repo} ({depth} jobs waiting)'.format(
+                    repo=lock_key, depth=depth)
+
+        return None
+
+    def get_retry_after(self):
+        '''
+        Return how long (in whole seconds) a producer that hit a depth limit
+        should wait before trying again: the average time it takes to run a
+        job, which is how long it takes for a job to leave the queue.
+        '''
+        select = "SELECT sum, count FROM histogram_totals WHERE stage = 'job'"
+        row = self.cursor.execute(select).fetchone()
+
+        if not row or not row[1]:
+            return self.retry_after
+
+        return max(math.ceil(row[0] / row[1]), 1)
+
+    def get_archive_file(self, work_id):
+        '''
+        Return the path where the full payload of a job gets archived.
+        '''
+        return os.path.join(self.archive_path, '%d.json.gz' % work_id)
+
+    def archive(self, work_id, raw):
+        '''
+        Write the full payload of a job to the archive, replacing the payload
+        of any push that it was coalesced with.
+
+        Args:
+            - work_id (int):    ID of the job, as returned by `add`.
+            - raw (bytes):      JSON of the payload.
+        '''
+        os.makedirs(self.archive_path, exist_ok=True)
+
+        archive_file = self.get_archive_file(work_id)
+        tmp_file = '%s.%d.tmp' % (archive_file, os.getpid())
+
+        # Payloads are mostly repeated names and URLs, so a fast compression
+        # level gets most of the savings
+        with gzip.open(tmp_file, 'wb', compresslevel=1) as f:
+            f.write(raw)
+
+        os.replace(tmp_file, archive_file)
+
+    def get_archived(self, work_id):
+        '''
+        Return the full payload of a job from the archive, or None if it
+        wasn't archived.
+
+        Args:
+            - work_id (int): ID of the job, as returned by `add`.
+        '''
+        if not self.archive_path:
+            return None
+
+        try:
+            with gzip.open(self.get_archive_file(work_id), 'rb') as f:
+                return json.loads(f.read().decode('utf-8'))
+        except FileNotFoundError:
+            return None
 
     def pop(self):
         '''
-        Return the most recent payload and remove it from the queue.
+        Remove the job that `claim` would hand out next from the queue, and
+        return its payload, or None if there's no work.
+        '''
+        work = self.pop_many(1)
+        return work[0] if work else None
+
+    def pop_many(self, limit):
+        '''
+        Remove up to `limit` jobs from the queue in a single transaction, in
+        the order that `claim` would hand them out, and return their payloads.
+        Popped jobs aren't tracked after that; their record in the `jobs`
+        table has the status 'popped'.
+        '''
+        now = time.time()
+
+        with self.transaction():
+            popped = self.take(limit, now)
+
+            for work_id, _, _ in popped:
+                self.retire(work_id, 'popped', now=now)
+
+        return [json.loads(payload) for _, payload, _ in popped]
+
+    def claim(self):
         '''
-        # Start a transaction for the duration of the write
-        self.cursor.execute('BEGIN TRANSACTION')
+        Lease the oldest pending job and return a tuple of its ID and payload,
+        or None if there's no pending work. Jobs are skipped while another job
+        for the same lock key and ref is running, or while they wait to be
+        retried. Call `heartbeat` with the ID to keep the lease while the job
+        runs, and `finish` once it's done.
 
-        self.cursor.execute('SELECT * FROM queue ORDER BY date_added LIMIT 1')
-        work = self.cursor.fetchone()
+        Jobs whose lease has run out go back on the queue first.
+        '''
+        work = self.claim_many(1)
+        return work[0] if work else None
+
+    def claim_many(self, limit):
+        '''
+        Lease up to `limit` jobs in a single transaction, as if by calling
+        `claim` that many times, and return a list of tuples of their IDs and
+        payloads.
+        '''
+        with self.transaction():
+            claimed = self.take(limit, time.time())
+
+        for work_id, _, attempt in claimed:
+            self.attempts[work_id] = attempt
+
+        return [(work_id, json.loads(payload)) for work_id, payload, _ in claimed]
+
+    def take(self, limit, now):
+        '''
+        Mark up to `limit` of the next jobs as running, and return a list of
+        tuples of their IDs, serialized payloads and attempt numbers. Jobs
+        whose lease has run out go back on the queue first. Call this inside
+        a transaction.
+        '''
+        update = '''
+            UPDATE queue
+               SET status = 'running',
+                   date_claimed = :now,
+                   lease_expires = :lease_expires,
+                   attempts = attempts + 1
+             WHERE id = ({next_job})
+         RETURNING id, payload, attempts
+        '''.format(next_job=NEXT_JOB)
+
+        params = {'now': now, 'lease_expires': now + self.lease_time}
+        taken = []
+
+        self.expire_leases(now)
+
+        # Each job holds its lock key and ref against the ones after it
+        while len(taken) < limit:
+            work = self.cursor.execute(update, params).fetchall()
+            if not work:
+                break
+            taken.append(work[0])
+
+        return taken
+
+    def has_work(self):
+        '''
+        Check whether there's a job that `claim` would hand out.
+        '''
+        return self.cursor.execute(NEXT_JOB, {'now': time.time()}).fetchone() is not None
+
+    def expire_leases(self, now):
+        '''
+        Put running jobs whose lease has run out back on the queue, since
+        their consumer must have died. Call this inside a transaction.
+        '''
+        select = '''
+            SELECT id, attempts
+              FROM queue
+             WHERE status = 'running'
+               AND (lease_expires IS NULL OR lease_expires < ?)
+        '''
+        for work_id, attempts in self.cursor.execute(select, (now,)).fetchall():
+            logging.warning('Lease on job %d ran out during attempt %d' % (work_id, attempts))
+            self.increment('leases_expired')
+            # The lease itself was the wait, so the job can run again at once
+            self.reschedule(work_id, attempts, 'Lease ran out', now, backoff=False)
+
+    def reschedule(self, work_id, attempts, error, now, backoff=True, exit_code=None):
+        '''
+        Put a job that didn't finish back on the queue, to be retried after a
+        delay that doubles with each attempt. Jobs that have used up their
+        attempts are moved to the `dead_letter` table instead, and jobs that a
+        newer push has superseded are dropped. Call this inside a transaction.
+
+        Args:
+            - work_id (int):    ID of the job, as returned by `claim`.
+            - attempts (int):   Number of times the job has been claimed.
+            - error (str):      Why the last attempt didn't finish.
+            - now (float):      Current time.
+            - backoff (bool):   Whether to wait before retrying the job.
+            - exit_code (int):  Exit code of the command that failed, if any.
+        '''
+        select = 'SELECT superseded FROM queue WHERE id = ?'
+        superseded = self.cursor.execute(select, (work_id,)).fetchone()[0]
 
-        if work:
-            work_id = work[0]
-            payload = json.loads(work[1])
+        if superseded:
+            self.retire(work_id, 'cancelled', error, exit_code, now)
+
+        elif attempts < self.max_attempts:
+            delay = 0
+            if backoff:
+                delay = min(self.retry_backoff * 2 ** (attempts - 1), self.max_backoff)
+            update = '''
+                UPDATE queue
+                   SET status = 'pending',
+                       lease_expires = NULL,
+                       available_at = ?,
+                       last_error = ?
+                 WHERE id = ?
+            '''
+            self.cursor.execute(update, (now + delay, error, work_id))
+            self.increment('jobs_retried')
 
-            # Delete the job from the queue
-            self.cursor.execute('DELETE FROM queue WHERE id = ?', (work_id,))
         else:
-            # No work was found in the queue
-            payload = None
+            insert = '''
+                INSERT OR REPLACE INTO dead_letter
+                         (id, payload, lock_key, ref, attempts, date_added, date_failed,
+                          last_error)
+                  SELECT id, payload, lock_key, ref, attempts, date_added, ?, ?
+                    FROM queue
+                   WHERE id = ?
+            '''
+            self.cursor.execute(insert, (now, error, work_id))
+            self.retire(work_id, 'dead', error, exit_code, now)
 
-        self.conn.commit()
+    def retire(self, work_id, status, error=None, exit_code=None, now=None):
+        '''
+        Remove a job from the queue, keeping a record of how it went in the
+        `jobs` table. Call this inside a transaction.
 
-        return payload
+        Args:
+            - work_id (int):    ID of the job, as returned by `claim`.
+            - status (str):     How the job ended: one of `FINISHED`.
+            - error (str):      Optional reason that the job failed.
+            - exit_code (int):  Exit code of the command that failed, if any.
+            - now (float):      Optional time that the job finished.
+        '''
+        insert = '''
+            INSERT OR REPLACE INTO jobs
+                     (id, lock_key, ref, sha, status, attempts, date_added, date_claimed,
+                      date_finished, exit_code, error)
+              SELECT id, lock_key, ref, json_extract(payload, '$.after'), ?, attempts,
+                     date_added, date_claimed, ?, ?, ?
+                FROM queue
+               WHERE id = ?
+        '''
+        self.cursor.execute(insert, (status, now or time.time(), exit_code, error, work_id))
+        self.cursor.execute('DELETE FROM queue WHERE id = ?', (work_id,))
+        self.increment('jobs_' + status)
 
-    def run(self):
+    def heartbeat(self, work_id, attempt=None, lease_time=None):
+        '''
+        Renew the lease on a claimed job. Returns False if the job is no
+        longer leased to this consumer, e.g. because the lease ran out and
+        another consumer claimed it.
+
+        Args:
+            - work_id (int):        ID of the job, as returned by `claim`.
+            - attempt (int):        Attempt that the lease was granted for.
+                                    Defaults to the attempt that this queue
+                                    claimed.
+            - lease_time (float):   Optional length of the new lease, in
+                                    seconds.
+        '''
+        if attempt is None:
+            attempt = self.attempts.get(work_id)
+
+        update = '''
+            UPDATE queue
+               SET lease_expires = ?
+             WHERE id = ?
+               AND status = 'running'
+               AND (? IS NULL OR attempts = ?)
+         RETURNING id
+        '''
+        lease_expires = time.time() + (lease_time or self.lease_time)
+        renewed = self.cursor.execute(update, (lease_expires, work_id, attempt, attempt))
+
+        return bool(renewed.fetchall())
+
+    def lease(self, work_id):
+        '''
+        Return a picklable callable that renews the lease on a job claimed by
+        this queue, from any thread or process.
+        '''
+        return Lease(self.db_conn, work_id, self.attempts.get(work_id), self.lease_time)
+
+    def finish(self, work_id, status='succeeded', timings=None, retry=False, error=None,
+               attempt=None, exit_code=None, home=None):
+        '''
+        Remove a claimed job from the queue, and record how it went. Returns
+        False, and records nothing, if the job isn't in the queue (e.g. it was
+        already finished), or the attempt is no longer leased.
+
+        Args:
+            - work_id (int):    ID of the job, as returned by `claim`.
+            - status (str):     How the job ended: 'succeeded', 'failed' or
+                                'cancelled'.
+            - timings (list):   Optional stages of the job and how long they
+                                took, as recorded by `Worker.timings`.
+            - retry (bool):     Whether a failed job should go back on the
+                                queue to be tried again (see `reschedule`).
+            - error (str):      Optional reason that the job failed.
+            - attempt (int):    Attempt that is finishing. Defaults to the
+                                attempt that this queue claimed.
+            - exit_code (int):  Exit code of the command that failed, if any.
+            - home (str):       Home directory that the job deployed to, if
+                                it got that far, so that later jobs for
+                                other branches of the repo know whether
+                                they can run alongside this branch.
+        '''
+        claimed = self.attempts.pop(work_id, None)
+        if attempt is None:
+            attempt = claimed
+
+        timings = list(timings or [])
+
+        with self.transaction():
+            select = '''
+                SELECT date_added, date_claimed, status, attempts, lock_key, ref
+                  FROM queue
+                 WHERE id = ?
+            '''
+            job = self.cursor.execute(select, (work_id,)).fetchone()
+
+            if not job:
+                return False
+
+            date_added, date_claimed, current, attempts, lock_key, ref = job
+
+            # The lease ran out, and the job went back on the queue
+            if attempt is not None and (current != 'running' or attempts != attempt):
+                return False
+
+            if date_claimed:
+                timings.insert(0, {'stage': 'queue_wait', 'name': None,
+                                   'start': date_added, 'duration': date_claimed - date_added})
+
+            for timing in timings:
+                insert = '''
+                    INSERT INTO timings
+                             (job_id, stage, name, start, duration)
+                      VALUES (?, ?, ?, ?, ?)
+                '''
+                self.cursor.execute(insert, (work_id, timing['stage'], timing.get('name'),
+                                             timing.get('start'), timing['duration']))
+                self.observe(timing['stage'], timing['duration'])
+
+            if home and lock_key and ref:
+                upsert = '''
+                    INSERT INTO homes (lock_key, ref, home)
+                         VALUES (?, ?, ?)
+                    ON CONFLICT (lock_key, ref) DO UPDATE
+                            SET home = excluded.home
+                '''
+                self.cursor.execute(upsert, (lock_key, ref, home))
+
+            if status == 'failed' and retry:
+                self.reschedule(work_id, attempts, error, time.time(), exit_code=exit_code)
+            else:
+                self.retire(work_id, status, error, exit_code)
+
+        if status == 'failed' and retry:
+            # Wake up a consumer in time to retry the job
+            self.notify()
+
+        return True
+
+    def get_dead_letters(self):
+        '''
+        Return the jobs that were set aside after using up their attempts, as
+        dicts, newest first.
+        '''
+        select = '''
+            SELECT id, payload, lock_key, ref, attempts, date_added, date_failed, last_error
+              FROM dead_letter
+          ORDER BY date_failed DESC
+        '''
+        columns = ('id', 'payload', 'lock_key', 'ref', 'attempts', 'date_added',
+                   'date_failed', 'last_error')
+
+        dead = []
+        for row in self.cursor.execute(select).fetchall():
+            job = dict(zip(columns, row))
+            job['payload'] = json.loads(job['payload'])
+            dead.append(job)
+
+        return dead
+
+    def redeliver(self, work_id):
+        '''
+        Put a dead job back on the queue with a fresh set of attempts, e.g.
+        once whatever made it fail has been fixed. Returns False if there's no
+        dead job with that ID.
+
+        Args:
+            - work_id (int): ID of the job, as returned by `claim`.
+        '''
+        return bool(self.redeliver_many([work_id]))
+
+    def redeliver_many(self, work_ids):
+        '''
+        Put a batch of dead jobs back on the queue in a single transaction.
+        Returns the IDs of the ones that were redelivered. The rest weren't
+        dead jobs, or their repo's queue was full, in which case they stay
+        dead. A dead job for a ref that already has a job waiting is folded
+        into that job, since it's the newer push; its record in the `jobs`
+        table says that it was cancelled.
+
+        Args:
+            - work_ids (list): IDs of the jobs, as returned by `claim`.
+        '''
+        redelivered = []
+
+        with self.transaction():
+            for work_id in work_ids:
+                select = 'SELECT payload FROM dead_letter WHERE id = ?'
+                dead = self.cursor.execute(select, (work_id,)).fetchone()
+                if not dead:
+                    continue
+
+                queued_id, full = self.enqueue(json.loads(dead[0]), work_id=work_id)
+                if full:
+                    logging.warning('Could not redeliver job %d: %s' % (work_id, full))
+                    continue
+
+                self.cursor.execute('DELETE FROM dead_letter WHERE id = ?', (work_id,))
+
+                if queued_id == work_id:
+                    self.cursor.execute('DELETE FROM jobs WHERE id = ?', (work_id,))
+                else:
+                    update = '''
+                        UPDATE jobs
+                           SET status = 'cancelled',
+                               error = ?
+                         WHERE id = ?
+                    '''
+                    self.cursor.execute(update, ('Superseded by job %d' % queued_id, work_id))
+
+                redelivered.append(work_id)
+
+        if redelivered:
+            self.notify()
+
+        return redelivered
+
+    def get_job(self, work_id):
+        '''
+        Return the record of a job, whether it's still in the queue or has
+        left it, as a dict of `JOB_COLUMNS` plus the timings of its stages.
+        Returns None if there's no job with that ID.
+
+        Args:
+            - work_id (int): ID of the job, as returned by `add`.
+        '''
+        select = '''
+            {queued} WHERE id = :id
+            UNION ALL
+            {finished} WHERE id = :id
+        '''.format(queued=QUEUED_JOB, finished=FINISHED_JOB)
+        row = self.cursor.execute(select, {'id': work_id}).fetchone()
+
+        if not row:
+            return None
+
+        job = dict(zip(JOB_COLUMNS, row))
+
+        select = '''
+            SELECT stage, name, start, duration
+              FROM timings
+             WHERE job_id = ?
+          ORDER BY rowid
+        '''
+        job['timings'] = [dict(zip(('stage', 'name', 'start', 'duration'), timing))
+                          for timing in self.cursor.execute(select, (work_id,)).fetchall()]
+
+        return job
+
+    def is_finished(self, work_id):
         '''
-        Check for work on the queue, and if it exists, deploy it.
+        Check whether a job has left the queue.
         '''
-        payload = self.pop()
-        if payload:
-            worker = Worker(payload)
-            worker.deploy()
+        select = 'SELECT 1 FROM queue WHERE id = ?'
+        return self.cursor.execute(select, (work_id,)).fetchone() is None
+
+    def get_jobs(self, repo=None, before=None, limit=50):
+        '''
+        Return the records of the newest jobs, whether they're still in the
+        queue or have left it, newest first. Pages are keyed on job IDs, so
+        each page is a range scan of an index however deep it goes.
+
+        Args:
+            - repo (str):   Optional name of the repo to list jobs for.
+            - before (int): Optional job ID to list the jobs before, i.e. the
+                            ID of the last job on the previous page.
+            - limit (int):  Most jobs to return.
+        '''
+        conditions = []
+        if repo is not None:
+            conditions.append('lock_key = :repo')
+        if before is not None:
+            conditions.append('id < :before')
+
+        where = 'WHERE ' + ' AND '.join(conditions) if conditions else ''
+
+        # Each table only needs to give up a page of jobs
+        select = '''
+            SELECT * FROM ({queued} {where} ORDER BY id DESC LIMIT :limit)
+            UNION ALL
+            SELECT * FROM ({finished} {where} ORDER BY id DESC LIMIT :limit)
+            ORDER BY 1 DESC
+            LIMIT :limit
+        '''.format(queued=QUEUED_JOB, finished=FINISHED_JOB, where=where)
+        rows = self.cursor.execute(select, {'repo': repo, 'before': before,
+                                            'limit': limit}).fetchall()
+
+        return [dict(zip(JOB_COLUMNS, row)) for row in rows]
+
+    def increment(self, name, amount=1):
+        '''
+        Add to a monitoring counter.
+        '''
+        upsert = '''
+            INSERT INTO counters (name, value) VALUES (?, ?)
+                ON CONFLICT (name) DO UPDATE SET value = value + excluded.value
+        '''
+        self.cursor.execute(upsert, (name, amount))
+
+    def observe(self, stage, duration):
+        '''
+        Record how long a stage took in its timing histogram.
+        '''
+        self.cursor.executemany('''
+            INSERT OR IGNORE INTO histogram_buckets (stage, le) VALUES (?, ?)
+        ''', [(stage, le) for le in BUCKETS])
+
+        self.cursor.execute('''
+            UPDATE histogram_buckets
+               SET count = count + 1
+             WHERE stage = ?
+               AND le >= ?
+        ''', (stage, duration))
+
+        self.cursor.execute('''
+            INSERT INTO histogram_totals (stage, sum, count) VALUES (?, ?, 1)
+                ON CONFLICT (stage) DO UPDATE SET sum = sum + excluded.sum,
+                                                  count = count + 1
+        ''', (stage, duration))
+
+    def get_metrics(self):
+        '''
+        Return a snapshot of the monitoring data for the queue: the number of
+        jobs in each status, the counters, and the timing histograms.
+        '''
+        depth = dict(self.cursor.execute('''
+            SELECT status, COUNT(*) FROM queue GROUP BY status
+        ''').fetchall())
+
+        dead = self.cursor.execute('SELECT COUNT(*) FROM dead_letter').fetchone()[0]
+        if dead:
+            depth['dead'] = dead
+
+        counters = dict(self.cursor.execute('SELECT name, value FROM counters').fetchall())
+
+        histograms = {}
+        for stage, total, count in self.cursor.execute('''
+            SELECT stage, sum, count FROM histogram_totals ORDER BY stage
+        ''').fetchall():
+            histograms[stage] = {'sum': total, 'count': count, 'buckets': []}
+
+        for stage, le, count in self.cursor.execute('''
+            SELECT stage, le, count FROM histogram_buckets ORDER BY stage, le
+        ''').fetchall():
+            if stage in histograms:
+                histograms[stage]['buckets'].append((le, count))
+
+        return {'depth': depth, 'counters': counters, 'histograms': histograms}
+
+    def is_superseded(self, work_id):
+        '''
+        Check whether a newer push has arrived for the same repo and ref as a
+        running job.
+
+        Args:
+            - work_id (int): ID of the job, as returned by `claim`.
+        '''
+        select = 'SELECT superseded FROM queue WHERE id = ?'
+        row = self.cursor.execute(select, (work_id,)).fetchone()
+        return bool(row and row[0])
+
+    def notify(self):
+        '''
+        Wake up a consumer that is waiting on the queue. This is best-effort:
+        if no consumer is listening, it will find the work on its next poll.
+        '''
+        # Worker pools send wakeups from their own threads
+        with self.sender_lock:
+            if not self.sender:
+                self.sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+                self.sender.setblocking(False)
+
+        try:
+            self.sender.sendto(b'1', self.sock_path)
+        except OSError:
+            # No consumer is listening, or its socket buffer is already full
+            # of wakeups -- either way there's nothing more to do
+            pass
+
+    def listen(self):
+        '''
+        Start listening for wakeups from producers. Only one consumer can
+        listen on a given database, and it holds a lock on `<socket>.lock`
+        while it does; any other consumer leaves its socket alone, and `wait`
+        falls back to polling.
+        '''
+        if self.listener:
+            return
+
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        lock = None
+        try:
+            lock = os.open(self.sock_path + '.lock', os.O_RDWR | os.O_CREAT, 0o644)
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+            # Nobody holds the lock, so a socket that's already there was left
+            # behind by a consumer that didn't exit cleanly
+            if os.path.exists(self.sock_path):
+                os.remove(self.sock_path)
+            listener.bind(self.sock_path)
+        except OSError as e:
+            reason = 'another consumer is listening' if isinstance(e, BlockingIOError) else e
+            logging.warning('Could not listen for queue wakeups on %s (%s); '
+                            'falling back to polling' % (self.sock_path, reason))
+            listener.close()
+            if lock is not None:
+                os.close(lock)
+            return
+
+        listener.setblocking(False)
+        self.listener = listener
+        self.listener_lock = lock
+
+    def close(self):
+        '''
+        Stop listening for wakeups and close the connection to the datastore.
+        '''
+        if self.listener:
+            self.listener.close()
+            self.listener = None
+            try:
+                os.remove(self.sock_path)
+            except OSError:
+                pass
+
+            # Let the next consumer take over the socket
+            os.close(self.listener_lock)
+            self.listener_lock = None
+
+        if self.sender:
+            self.sender.close()
+            self.sender = None
+
+        self.conn.close()
+
+    def wait(self, timeout):
+        '''
+        Block until a producer signals new work or `timeout` seconds pass.
+        Returns True if the wait was cut short by a wakeup.
+        '''
+        if not self.listener:
+            time.sleep(timeout)
+            return False
+
+        readable, _, _ = select.select([self.listener], [], [], timeout)
+
+        if not readable:
+            return False
+
+        # Drain all pending wakeups, since one check of the queue covers them
+        while True:
+            try:
+                self.listener.recv(64)
+            except BlockingIOError:
+                break
+
+        return True
+
+
+class Cancellation(object):
+    '''
+    Check whether a running job has been superseded. Instances can be sent to
+    worker processes, where they open their own connection to the datastore.
+    '''
+    def __init__(self, db_conn, work_id):
+        self.db_conn = db_conn
+        self.work_id = work_id
+
+    def __call__(self):
+        return get_queue(self.db_conn).is_superseded(self.work_id)
+
+
+class Lease(object):
+    '''
+    Renew the lease on a claimed job. Instances can be sent to worker
+    processes, where they open their own connection to the datastore.
+    '''
+    def __init__(self, db_conn, work_id, attempt, lease_time=None):
+        self.db_conn = db_conn
+        self.work_id = work_id
+        self.attempt = attempt
+        self.lease_time = lease_time
+
+    def __call__(self):
+        return get_queue(self.db_conn).heartbeat(self.work_id, self.attempt, self.lease_time)
+
+
+class Heartbeat(object):
+    '''
+    Renew the lease on a job from a background thread while it runs, so that
+    it doesn't get handed to another consumer.
+    '''
+    def __init__(self, lease, interval):
+        '''
+        Args:
+            - lease (callable): Renews the lease, as returned by
+                                `BaseQueue.lease`.
+            - interval (float): Seconds between renewals.
+        '''
+        self.lease = lease
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                if not self.lease():
+                    logging.warning('Lost the lease on job %s; it may run twice' %
+                                    getattr(self.lease, 'work_id', None))
+            except Exception as e:
+                logging.warning('Could not renew the lease on a job: %s' % e)
+
+
+# Long-lived queue connections, one per thread
+_local = threading.local()
+
+
+def get_queue(db_conn=None):
+    '''
+    Return a Queue for the current thread, reusing its connection across calls
+    so that producers don't pay for a new connection on every job. Queues use
+    the settings from the server config.
+
+    Args:
+        - db_conn (string): Optional SQLite connection string, if the queue
+                            should use a different datastore.
+    '''
+    db_conn = db_conn or Queue.db_conn
+    queues = getattr(_local, 'queues', None)
+
+    if queues is None:
+        queues = _local.queues = {}
+
+    if db_conn not in queues:
+        queues[db_conn] = Queue(db_conn, settings=load_settings())
+
+    return queues[db_conn]
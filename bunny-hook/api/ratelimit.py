@@ -0,0 +1,78 @@
+# ratelimit.py -- limit how fast each source can send webhooks
+import time
+import math
+import threading
+from collections import OrderedDict
+
+
+class TokenBucket(object):
+    '''
+    Allow `rate` requests per second on average, with bursts of up to `burst`
+    requests.
+    '''
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def take(self, now):
+        '''
+        Take a token from the bucket. Returns 0 if there was one, or else how
+        long (in seconds) until there will be.
+        '''
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+
+        return (1 - self.tokens) / self.rate
+
+
+class RateLimiter(object):
+    '''
+    Keep a token bucket for each source of requests. Buckets live in memory,
+    so each API server process limits its own requests.
+    '''
+    # Most sources to keep buckets for. The least recently seen sources are
+    # forgotten first, which only ever lets them send more.
+    max_sources = 1024
+
+    def __init__(self, rate, burst=None):
+        '''
+        Args:
+            - rate (float): Requests per second to allow from each source.
+            - burst (int):  Requests that a source can send at once, after
+                            being idle. Defaults to one second's worth of
+                            requests, and is always at least 1.
+        '''
+        self.rate = rate
+        self.burst = max(burst or math.ceil(rate), 1)
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def check(self, source):
+        '''
+        Count a request from a source. Returns 0 if the request is allowed,
+        or else the number of seconds the source should wait before trying
+        again.
+
+        Args:
+            - source (str): Key identifying where the request came from.
+        '''
+        now = time.monotonic()
+
+        with self.lock:
+            bucket = self.buckets.get(source)
+
+            if bucket:
+                self.buckets.move_to_end(source)
+            else:
+                bucket = self.buckets[source] = TokenBucket(self.rate, self.burst, now)
+
+                if len(self.buckets) > self.max_sources:
+                    self.buckets.popitem(last=False)
+
+            return bucket.take(now)
@@ -0,0 +1,202 @@
+# releases.py -- manage release directories that get swapped in atomically
+import os
+import json
+import time
+import shutil
+import logging
+import subprocess
+
+from api.exceptions import WorkerException
+
+
+def list_files(source):
+    '''
+    Return the manifest of a git checkout, and the SHA of its HEAD commit.
+    '''
+    try:
+        sha = subprocess.run(['git', '-C', source, 'rev-parse', 'HEAD'], check=True,
+                             stdout=subprocess.PIPE, universal_newlines=True).stdout.strip()
+        files = subprocess.run(['git', '-C', source, 'ls-files', '--stage', '-z'], check=True,
+                               stdout=subprocess.PIPE, universal_newlines=True).stdout
+    except subprocess.CalledProcessError as e:
+        raise WorkerException(str(e))
+
+    manifest = {}
+
+    # Each entry looks like `<mode> <blob> <stage>\t<path>`
+    for entry in files.split('\0'):
+        if entry:
+            info, path = entry.split('\t', 1)
+            mode, blob, _ = info.split(' ')
+            manifest[path] = [mode, blob]
+
+    return manifest, sha
+
+
+class Releases(object):
+    '''
+    Manage the releases of a repo under its home directory:
+
+        <home>/releases/<sha>/         One directory per deployed commit
+        <home>/releases/<sha>.json     Manifest of the files in each release
+        <home>/current -> releases/<sha>
+
+    Each release is built from a git checkout. Files that are unchanged since
+    the previous release are hardlinked rather than copied, so a new release
+    costs little more than the files that changed. Since those files are
+    shared between releases, build scripts should replace files rather than
+    edit them in place.
+    '''
+    def __init__(self, home):
+        '''
+        Args:
+            - home (str): Home directory of the repo, from `deploy.yml`.
+        '''
+        self.home = os.path.abspath(home)
+        self.releases_path = os.path.join(self.home, 'releases')
+        self.current_path = os.path.join(self.home, 'current')
+
+    def path(self, name):
+        '''
+        Return the directory of a release.
+        '''
+        return os.path.join(self.releases_path, name)
+
+    def current(self):
+        '''
+        Return the name of the live release, or None if there isn't one.
+        '''
+        if not os.path.islink(self.current_path):
+            return None
+
+        return os.path.basename(os.readlink(self.current_path))
+
+    def list(self):
+        '''
+        Return the names of all releases, oldest first.
+        '''
+        if not os.path.isdir(self.releases_path):
+            return []
+
+        manifests = [entry for entry in os.listdir(self.releases_path)
+                     if entry.endswith('.json')]
+
+        # Manifests are written once, when the release is created
+        manifests.sort(key=lambda entry: os.path.getmtime(self.path(entry)))
+
+        return [entry[:-len('.json')] for entry in manifests
+                if os.path.isdir(self.path(entry[:-len('.json')]))]
+
+    def read_manifest(self, name):
+        '''
+        Return the manifest of a release, mapping each path to its git mode and
+        blob SHA.
+        '''
+        try:
+            with open(self.path(name) + '.json') as manifest:
+                return json.load(manifest)
+        except (OSError, ValueError):
+            return {}
+
+    def create(self, source):
+        '''
+        Build a new release from a git checkout, and return its name. The
+        release doesn't go live until it's activated.
+
+        Args:
+            - source (str): Path to the checkout.
+        '''
+        manifest, name = list_files(source)
+
+        if os.path.exists(self.path(name)):
+            if name == self.current():
+                # Redeploying the live commit; build alongside it
+                name = '{sha}-{time}'.format(sha=name, time=int(time.time()))
+            else:
+                shutil.rmtree(self.path(name))
+
+        previous = self.current()
+        previous_manifest = self.read_manifest(previous) if previous else {}
+
+        release_path = self.path(name)
+        os.makedirs(release_path)
+
+        linked = 0
+
+        for path, (mode, blob) in manifest.items():
+            src = os.path.join(source, path)
+            dest = os.path.join(release_path, path)
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+
+            if mode == '160000':
+                # Submodules aren't checked out
+                os.makedirs(dest, exist_ok=True)
+
+            elif mode == '120000':
+                os.symlink(os.readlink(src), dest)
+
+            elif previous_manifest.get(path) == [mode, blob]:
+                try:
+                    os.link(os.path.join(self.path(previous), path), dest)
+                    linked += 1
+                except OSError:
+                    # The previous copy has gone missing, or lives on another
+                    # filesystem
+                    shutil.copy2(src, dest)
+
+            else:
+                shutil.copy2(src, dest)
+
+        with open(release_path + '.json', 'w') as manifest_file:
+            json.dump(manifest, manifest_file)
+
+        logging.info('Created release {name} ({linked} of {total} files unchanged)'.format(
+            name=name, linked=linked, total=len(manifest)))
+
+        return name
+
+    def activate(self, name):
+        '''
+        Point the `current` symlink at a release. The swap is atomic, so the
+        live directory is never partially updated.
+        '''
+        if not os.path.isdir(self.path(name)):
+            raise WorkerException('Release %s does not exist' % name)
+
+        tmp_link = self.current_path + '.tmp'
+
+        if os.path.lexists(tmp_link):
+            os.remove(tmp_link)
+
+        os.symlink(os.path.join('releases', name), tmp_link)
+        os.replace(tmp_link, self.current_path)
+
+        logging.info('Activated release %s' % name)
+
+    def rollback(self):
+        '''
+        Point the `current` symlink back at the release before the live one.
+        Returns the name of that release.
+        '''
+        releases = self.list()
+        current = self.current()
+
+        if current not in releases or releases.index(current) == 0:
+            raise WorkerException('No earlier release to roll back to')
+
+        previous = releases[releases.index(current) - 1]
+        self.activate(previous)
+
+        return previous
+
+    def prune(self, keep):
+        '''
+        Delete all but the `keep` newest releases. The live release is never
+        deleted.
+        '''
+        current = self.current()
+
+        for name in self.list()[:-keep]:
+            if name != current:
+                shutil.rmtree(self.path(name))
+                os.remove(self.path(name) + '.json')
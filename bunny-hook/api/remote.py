@@ -0,0 +1,352 @@
+# remote.py -- consume a queue that lives on another host
+import json
+import time
+import logging
+import threading
+import http.client
+from urllib.parse import urlsplit
+
+from api.queue import BaseQueue
+from api.exceptions import QueueException, QueueFull
+
+
+class RemoteQueue(BaseQueue):
+    '''
+    Consume the Queue of an API server over HTTP, so that builders can run on
+    other hosts than the webhook, and several of them can share one queue.
+
+    The API server keeps the queue in its SQLite database, and claims jobs for
+    builders in a single statement, so no two builders ever get the same job
+    and jobs for one repo still run one at a time across all of them.
+    '''
+    # Longest time (in seconds) that the server holds a request open while
+    # waiting for work. Waits are split up so that local wakeups (from a
+    # worker pool finishing a job) aren't missed for long.
+    max_poll = 1.0
+
+    # Time limit (in seconds) for each request, on top of any wait
+    request_timeout = 10
+
+    # Attempts at requests that are safe to retry, and the first wait (in
+    # seconds) between them
+    retries = 5
+    retry_wait = 0.5
+
+    def __init__(self, url, token=None, settings=None):
+        '''
+        Args:
+            - url (str):        Base URL of the queue API on the server, e.g.
+                                `http://hooks.example.com/queue`.
+            - token (str):      Token that the server expects in the
+                                `Authorization` header (its `queue_token`
+                                setting).
+            - settings (dict):  Optional server settings to pass on to
+                                Workers, as returned by
+                                `api.settings.load_settings`.
+        '''
+        self.db_conn = url
+        self.token = token
+        self.settings = settings or {}
+        self.lease_time = self.settings.get('lease_time') or self.lease_time
+
+        # Map jobs claimed by this builder to their attempt numbers, which
+        # the server checks when the builder renews or finishes them
+        self.attempts = {}
+
+        parts = urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            raise QueueException('Queue URL must be http or https: %s' % url)
+
+        self.scheme = parts.scheme
+        self.netloc = parts.netloc
+        self.path = parts.path.rstrip('/')
+
+        self.conn = None
+        self.wakeup = threading.Event()
+
+    def connect(self):
+        if self.scheme == 'https':
+            return http.client.HTTPSConnection(self.netloc, timeout=self.request_timeout)
+
+        return http.client.HTTPConnection(self.netloc, timeout=self.request_timeout)
+
+    def request(self, method, path, body=None, timeout=None, retry=True):
+        '''
+        Make a request to the queue API, and return the status code and the
+        parsed JSON response. The connection is kept open between requests.
+
+        Args:
+            - method (str):     HTTP method.
+            - path (str):       Path under the queue URL.
+            - body (dict):      Optional JSON to send.
+            - timeout (float):  Extra time to allow for the response, for
+                                requests that the server holds open.
+            - retry (bool):     Whether the request is safe to send again if
+                                it fails.
+        '''
+        headers = {'Content-Type': 'application/json'}
+        if self.token:
+            headers['Authorization'] = 'Bearer ' + self.token
+
+        data = json.dumps(body).encode('utf-8') if body is not None else None
+        wait = self.retry_wait
+
+        for attempt in range(self.retries if retry else 1):
+            try:
+                if not self.conn:
+                    self.conn = self.connect()
+
+                self.conn.timeout = self.request_timeout + (timeout or 0)
+                if self.conn.sock:
+                    self.conn.sock.settimeout(self.conn.timeout)
+
+                self.conn.request(method, self.path + path, body=data, headers=headers)
+                response = self.conn.getresponse()
+                content = response.read()
+
+            except (OSError, http.client.HTTPException) as e:
+                # Start over with a new connection
+                self.close()
+                error = e
+
+                if retry and attempt + 1 < self.retries:
+                    logging.warning('Queue request %s %s failed (%s); retrying' % (method, path, e))
+                    time.sleep(wait)
+                    wait *= 2
+
+                continue
+
+            if response.status == 204:
+                return response.status, None
+
+            try:
+                result = json.loads(content.decode('utf-8'))
+            except ValueError:
+                result = None
+
+            if response.status >= 400:
+                status = (result or {}).get('status') if isinstance(result, dict) else None
+                message = 'Queue request {method} {path} failed with {code}: {status}'.format(
+                    method=method, path=path, code=response.status, status=status)
+
+                if response.status == 503:
+                    retry_after = response.getheader('Retry-After')
+                    raise QueueFull(message, int(retry_after) if retry_after else None)
+
+                raise QueueException(message)
+
+            return response.status, result
+
+        raise QueueException('Could not reach the queue at {url}: {error}'.format(url=self.db_conn,
+                                                                                 error=error))
+
+    def add(self, payload, raw=None, priority=None):
+        '''
+        Drop a work payload into the queue, and return the ID of the job.
+        '''
+        body = {'payload': payload, 'priority': priority}
+        _, result = self.request('POST', '/jobs', body, retry=False)
+        return result['id']
+
+    def add_many(self, payloads, raws=None, priority=None):
+        '''
+        Drop a batch of work payloads into the queue in one request, and
+        return the ID of the job for each one, or None where the queue was
+        full.
+        '''
+        body = {'payloads': payloads, 'priority': priority}
+        _, result = self.request('POST', '/jobs/batch', body, retry=False)
+        return result['ids']
+
+    def pop(self):
+        '''
+        Return the oldest payload and remove it from the queue.
+        '''
+        _, result = self.request('POST', '/pop', retry=False)
+        return result
+
+    def claim(self):
+        '''
+        Claim the next job that can run from the server. Returns a tuple of its
+        ID and payload, or None if there's no work or the server can't be
+        reached, so that consumers back off and try again.
+        '''
+        try:
+            _, result = self.request('POST', '/claim', retry=False)
+        except QueueException as e:
+            logging.warning(str(e))
+            return None
+
+        if not result:
+            return None
+
+        self.attempts[result['id']] = result.get('attempt')
+
+        return result['id'], result['payload']
+
+    def claim_many(self, limit):
+        '''
+        Claim up to `limit` jobs from the server in one request. Returns an
+        empty list if the server can't be reached, as for `claim`.
+        '''
+        try:
+            _, result = self.request('POST', '/claim/batch', {'limit': limit}, retry=False)
+        except QueueException as e:
+            logging.warning(str(e))
+            return []
+
+        for job in result['jobs']:
+            self.attempts[job['id']] = job.get('attempt')
+
+        return [(job['id'], job['payload']) for job in result['jobs']]
+
+    def finish(self, work_id, status='succeeded', timings=None, retry=False, error=None,
+               exit_code=None, home=None):
+        '''
+        Tell the server that a claimed job is done, and how it went. Failed
+        requests are retried, since the job stays claimed until this gets
+        through or its lease runs out.
+        '''
+        _, result = self.request('POST', '/jobs/%d/finish' % work_id,
+                                 {'status': status, 'timings': timings or [],
+                                  'retry': retry, 'error': error, 'exit_code': exit_code,
+                                  'home': home, 'attempt': self.attempts.pop(work_id, None)})
+        return bool(result and result.get('finished'))
+
+    def heartbeat(self, work_id, attempt=None):
+        '''
+        Renew the lease on a claimed job. Returns False if the job is no
+        longer leased to this builder.
+        '''
+        if attempt is None:
+            attempt = self.attempts.get(work_id)
+
+        _, result = self.request('POST', '/jobs/%d/heartbeat' % work_id, {'attempt': attempt})
+        return bool(result and result.get('renewed'))
+
+    def lease(self, work_id):
+        '''
+        Return a picklable callable that renews the lease on a job claimed by
+        this builder, from any thread or process.
+        '''
+        return RemoteLease(self.db_conn, self.token, work_id, self.attempts.get(work_id))
+
+    def is_superseded(self, work_id):
+        '''
+        Check whether a newer push has arrived for the same repo and ref as a
+        running job.
+        '''
+        _, result = self.request('GET', '/jobs/%d' % work_id)
+        return bool(result and result.get('superseded'))
+
+    def cancellation(self, work_id):
+        '''
+        Return a picklable callable that checks whether a job has been
+        superseded, from any process.
+        '''
+        return RemoteCancellation(self.db_conn, self.token, work_id)
+
+    def get_metrics(self):
+        '''
+        Return a snapshot of the monitoring data for the queue on the server.
+        '''
+        _, result = self.request('GET', '/metrics')
+        return result
+
+    def notify(self):
+        '''
+        Wake up this consumer, if it's waiting. Producers on other hosts wake
+        it through the server instead.
+        '''
+        self.wakeup.set()
+
+    def listen(self):
+        pass
+
+    def wait(self, timeout):
+        '''
+        Block until the server has a job that could be claimed, a local
+        wakeup arrives, or `timeout` seconds pass. Returns True if the wait
+        was cut short.
+        '''
+        deadline = time.monotonic() + timeout
+
+        while True:
+            if self.wakeup.is_set():
+                self.wakeup.clear()
+                return True
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+
+            poll = min(remaining, self.max_poll)
+
+            try:
+                _, result = self.request('GET', '/wait?timeout=%.3f' % poll, timeout=poll,
+                                         retry=False)
+            except QueueException as e:
+                logging.warning(str(e))
+                time.sleep(poll)
+                continue
+
+            if result and result.get('ready'):
+                return True
+
+    def close(self):
+        '''
+        Close the connection to the server.
+        '''
+        if self.conn:
+            self.conn.close()
+            self.conn = None
+
+
+class RemoteCancellation(object):
+    '''
+    Check whether a running job has been superseded, by asking the server.
+    Instances can be sent to worker processes, where they open their own
+    connection.
+    '''
+    def __init__(self, url, token, work_id):
+        self.url = url
+        self.token = token
+        self.work_id = work_id
+
+    def __call__(self):
+        return get_remote_queue(self.url, self.token).is_superseded(self.work_id)
+
+
+class RemoteLease(object):
+    '''
+    Renew the lease on a claimed job, through the server. Instances can be
+    sent to worker processes, where they open their own connection.
+    '''
+    def __init__(self, url, token, work_id, attempt):
+        self.url = url
+        self.token = token
+        self.work_id = work_id
+        self.attempt = attempt
+
+    def __call__(self):
+        return get_remote_queue(self.url, self.token).heartbeat(self.work_id, self.attempt)
+
+
+# Long-lived connections to remote queues, one per thread
+_local = threading.local()
+
+
+def get_remote_queue(url, token=None):
+    '''
+    Return a RemoteQueue for the current thread, reusing its connection across
+    calls.
+    '''
+    queues = getattr(_local, 'queues', None)
+
+    if queues is None:
+        queues = _local.queues = {}
+
+    if (url, token) not in queues:
+        queues[(url, token)] = RemoteQueue(url, token)
+
+    return queues[(url, token)]
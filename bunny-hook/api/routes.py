@@ -1,60 +1,117 @@
-# app.py -- routes for the app
+# routes.py -- routes for the app
+import hmac
 import json
-import logging
-from hmac import new as hmac_new
-from datetime import datetime
+import math
+import time
+from functools import lru_cache, wraps
 
-from flask import request, make_response, g
+from flask import Blueprint, Response, request, make_response, abort, url_for, current_app
 
-from api import app
-from api.queue import Queue
+from api.queue import Queue, get_queue
 from api.payload import Payload
+from api.signatures import Verifier
+from api.ratelimit import RateLimiter
+from api.settings import load_settings
+from api.exceptions import QueueFull
+from api.logs import request_logger, tail
+from api import metrics
 
 
-def prep_response(request, resp, status_code):
+# Routes of the API server, registered on the app by `api.create_app`
+blueprint = Blueprint('api', __name__)
+
+# Most jobs that one request to a batch endpoint can add, claim or redeliver
+MAX_BATCH = 1000
+
+
+def prep_response(request, resp, status_code, payload=None, retry_after=None):
     '''
     Utility function for logging and returning HTTP responses.
 
     Arguments:
-        - request (Request) -> Flask Request object
-        - resp (dict)       -> JSON to return
-        - status_code (int) -> HTTP status code
+        - request (Request)  -> Flask Request object
+        - resp (dict)        -> JSON to return
+        - status_code (int)  -> HTTP status code
+        - payload (dict)     -> Parsed request payload, if there was one
+        - retry_after (int)  -> Seconds that the client should wait before
+                                sending the request again, if any
     '''
     # Log data on this request/response cycle
-    curr = str(datetime.now())
-    metadata = '''
-        Time: {curr}
-        Response code: {status_code}
-        Response body: {resp}
-        Request headers: {headers}
-        Request payload: {payload}
-    '''.format(curr=curr,
-               headers=request.headers,
-               payload=request.get_json(),
-               status_code=status_code,
-               resp=resp)
-
-    logging.debug(metadata)
+    request_logger.log(request, resp, status_code, payload)
 
+    return json_response(resp, status_code, retry_after)
+
+
+def json_response(resp, status_code, retry_after=None):
+    '''
+    Return a JSON response, without logging it.
+
+    Arguments:
+        - resp (dict)        -> JSON to return
+        - status_code (int)  -> HTTP status code
+        - retry_after (int)  -> Seconds that the client should wait before
+                                sending the request again, if any
+    '''
     response = make_response(json.dumps(resp), status_code)
     response.headers['Content-Type'] = 'application/json'
+
+    if retry_after is not None:
+        response.headers['Retry-After'] = str(retry_after)
+
     return response
 
 
-def queue(payload_json, branch_name):
+def parse_priority(value):
+    '''
+    Return the priority that a client sent for a job as an integer, or None if
+    it didn't send one. Raises ValueError if it isn't an integer within
+    `Queue.max_priority` of 0.
+    '''
+    if value is None:
+        return None
+
+    try:
+        if isinstance(value, (bool, float)):
+            raise TypeError
+        priority = int(value)
+    except (TypeError, ValueError):
+        raise ValueError('Priority must be an integer: %s' % value)
+
+    if abs(priority) > Queue.max_priority:
+        raise ValueError('Priority must be between -{max} and {max}'.format(
+            max=Queue.max_priority))
+
+    return priority
+
+
+def queue(payload_json, branch_name, body=None):
     '''
     Drop new work into the queue to prepare builds.
 
     Arguments:
         - payload_json (dict):      -> POST request information received from GitHub
         - branch_name (string) -> Name of the branch that was POSTed to
+        - body (bytes)         -> Raw request body, to store as-is
     '''
     payload = Payload(payload_json)
+    resp = {}
+
+    try:
+        # Senders other than GitHub can ask for a job to jump the queue
+        priority = parse_priority(request.headers.get('X-Hook-Priority'))
+    except ValueError as e:
+        return prep_response(request, {'status': str(e)}, 400, payload_json)
 
     if payload.validate(branch_name):
         # This branch is approved for builds, so queue up work
-        queue = Queue()
-        queue.add(payload_json)
+        queue = get_queue()
+
+        try:
+            # Clients can look the job up under its ID
+            resp['id'] = queue.add(payload_json, raw=body, priority=priority)
+        except QueueFull as e:
+            resp = {'status': str(e)}
+            return prep_response(request, resp, 503, payload_json, retry_after=e.retry_after)
 
         status_code = 202
         status = 'Build started for ref %s of repo %s' % (payload.get('ref'),
@@ -70,23 +127,47 @@ def queue(payload_json, branch_name):
             status = 'Malformed request payload: {payload}'.format(payload=payload.as_dict)
 
     # Return response
-    resp = {'status': status}
-    return prep_response(request, resp, status_code)
+    resp['status'] = status
+    return prep_response(request, resp, status_code, payload_json)
 
 
-def get_hmac(token):
+@lru_cache(maxsize=8)
+def get_verifier(tokens):
+    '''
+    Return a signature Verifier for a tuple of secret tokens, reusing it
+    across requests.
     '''
-    Check the HMAC hexadigest signature of a token (GitHub's way of creating
-    hashes for authentication).
+    return Verifier(tokens)
 
-    Arguments:
-        - token (str) -> Secret key to use for the hash.
+
+@lru_cache(maxsize=1)
+def get_rate_limiter():
+    '''
+    Return the RateLimiter for webhooks, or None if the server config doesn't
+    set a rate limit.
+    '''
+    settings = load_settings()
+
+    if not settings.get('rate_limit'):
+        return None
+
+    return RateLimiter(settings['rate_limit'], settings.get('rate_limit_burst'))
+
+
+def get_source(request):
     '''
-    token_sig = hmac_new(token.encode('utf-8'), digestmod='sha1')
-    return 'sha1' + token_sig.hexdigest()
+    Return a key for where a webhook came from: the ID of the GitHub hook that
+    sent it, or else the address of the client.
+    '''
+    hook_id = request.headers.get('X-GitHub-Hook-ID')
+
+    if hook_id:
+        return 'hook:' + hook_id
+
+    return 'addr:' + str(request.remote_addr)
 
 
-@app.route('/hooks/github/<branch_name>', methods=['POST'])
+@blueprint.route('/hooks/github/<branch_name>', methods=['POST'])
 def receive_post(branch_name):
     '''
     Receive and respond to POST requests, either denying access or queuing
@@ -96,20 +177,38 @@ def receive_post(branch_name):
         - branch_name (str) -> the branch that is being POSTed to (extracted
                                as a URL param by Flask)
     '''
-    # Validate the request
+    # Read the body once, and verify the signature against exactly those bytes
     # Docs: https://developer.github.com/webhooks/securing/#validating-payloads-from-github
-    post_sig = request.headers.get('X-Hub-Signature')
+    body = request.get_data()
+
+    # Retrieve secret tokens from the app config
+    verifier = get_verifier(tuple(current_app.config.get('TOKENS', [])))
+    verified = verifier.verify(body, request.headers)
+
+    if verified:
+        # Only count requests that authenticated, so that nobody else can use
+        # up a source's allowance
+        limiter = get_rate_limiter()
+        wait = limiter.check(get_source(request)) if limiter else 0
 
-    if post_sig:
-        # Retrieve secret tokens from the application context
-        tokens = g.get('tokens', [])
+        if wait:
+            get_queue().increment('requests_rate_limited')
+            resp = {'status': 'Too many requests; try again later'}
+            return prep_response(request, resp, 429, retry_after=math.ceil(wait))
 
-        for token in tokens:
-            if get_hmac(token) == post_sig:
-                # Payload is good; queue up work
-                payload_json = request.get_json()
-                return queue(payload_json, branch_name)
+        try:
+            payload_json = json.loads(body.decode('utf-8'))
+        except ValueError:
+            payload_json = None
 
+        if isinstance(payload_json, dict):
+            # Payload is good; queue up work
+            return queue(payload_json, branch_name, body)
+
+        status_code = 400
+        status = 'Request payload is not a JSON object'
+
+    elif verified is False:
         # None of the tokens matched
         status_code = 401
         status = 'Request signature failed to authenticate'
@@ -121,3 +220,356 @@ def receive_post(branch_name):
     # Return response
     resp = {'status': status}
     return prep_response(request, resp, status_code)
+
+
+@blueprint.route('/metrics', methods=['GET'])
+def get_metrics():
+    '''
+    Expose counters, queue depth and timing histograms for Prometheus.
+    '''
+    body = metrics.render(get_queue().get_metrics())
+
+    response = make_response(body, 200)
+    response.headers['Content-Type'] = metrics.CONTENT_TYPE
+    return response
+
+
+def require_token(name, description):
+    '''
+    Return a decorator that only lets clients with a token from the app
+    config use an endpoint. The endpoint doesn't exist when no token is set.
+
+    Args:
+        - name (str):        Key of the token in the app config.
+        - description (str): What the token is called, for error messages.
+    '''
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            token = current_app.config.get(name)
+
+            if not token:
+                abort(404)
+
+            sent = request.headers.get('Authorization', '')
+            if not hmac.compare_digest(sent.encode('utf-8'),
+                                       ('Bearer ' + token).encode('utf-8')):
+                return json_response({'status': '%s failed to authenticate' % description}, 401)
+
+            return view(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+# Builders with the `queue_token` can claim, finish and redeliver jobs
+require_queue_token = require_token('QUEUE_TOKEN', 'Queue token')
+
+# Clients with the `jobs_token` can only read job records and logs
+require_jobs_token = require_token('JOBS_TOKEN', 'Jobs token')
+
+
+@blueprint.route('/queue/jobs', methods=['POST'])
+@require_queue_token
+def add_job():
+    '''
+    Drop a job into the queue for a producer on another host.
+    '''
+    body = request.get_json(silent=True) or {}
+
+    if not isinstance(body.get('payload'), dict):
+        return json_response({'status': 'Request is missing a `payload` object'}, 400)
+
+    try:
+        priority = parse_priority(body.get('priority'))
+    except ValueError as e:
+        return json_response({'status': str(e)}, 400)
+
+    try:
+        work_id = get_queue().add(body['payload'], priority=priority)
+    except QueueFull as e:
+        return json_response({'status': str(e)}, 503, retry_after=e.retry_after)
+
+    return json_response({'id': work_id}, 201)
+
+
+@blueprint.route('/queue/jobs/batch', methods=['POST'])
+@require_queue_token
+def add_jobs():
+    '''
+    Drop a batch of jobs into the queue in one transaction, e.g. to replay a
+    backlog of webhooks. Responds with the ID of each job, or null for jobs
+    that didn't fit in the queue, along with how long to wait before sending
+    those again.
+    '''
+    body = request.get_json(silent=True) or {}
+    payloads = body.get('payloads')
+
+    if not isinstance(payloads, list) or not all(isinstance(p, dict) for p in payloads):
+        return json_response({'status': 'Request is missing a `payloads` list of objects'}, 400)
+
+    if len(payloads) > MAX_BATCH:
+        return json_response({'status': 'Batches can have at most %d jobs' % MAX_BATCH}, 400)
+
+    try:
+        priority = parse_priority(body.get('priority'))
+    except ValueError as e:
+        return json_response({'status': str(e)}, 400)
+
+    queue = get_queue()
+    work_ids = queue.add_many(payloads, priority=priority)
+    result = {'ids': work_ids}
+
+    if None in work_ids:
+        result['retry_after'] = queue.get_retry_after()
+
+    return json_response(result, 201)
+
+
+@blueprint.route('/queue/claim', methods=['POST'])
+@require_queue_token
+def claim_job():
+    '''
+    Hand the next job that can run to a builder, or respond with 204 if there
+    isn't one. The builder holds a lease on the job, and sends back the
+    attempt number when it renews or finishes it.
+    '''
+    queue = get_queue()
+    work = queue.claim()
+
+    if not work:
+        return make_response('', 204)
+
+    work_id, payload = work
+    return json_response({'id': work_id, 'payload': payload,
+                          'attempt': queue.attempts.pop(work_id, None)}, 200)
+
+
+@blueprint.route('/queue/claim/batch', methods=['POST'])
+@require_queue_token
+def claim_jobs():
+    '''
+    Hand up to `limit` jobs that can run to a builder in one transaction, as
+    a list like the responses from `/queue/claim`.
+    '''
+    body = request.get_json(silent=True) or {}
+
+    try:
+        limit = min(max(int(body.get('limit', 1)), 1), MAX_BATCH)
+    except (TypeError, ValueError):
+        return json_response({'status': '`limit` must be an integer'}, 400)
+
+    queue = get_queue()
+    jobs = [{'id': work_id, 'payload': payload, 'attempt': queue.attempts.pop(work_id, None)}
+            for work_id, payload in queue.claim_many(limit)]
+
+    return json_response({'jobs': jobs}, 200)
+
+
+@blueprint.route('/queue/pop', methods=['POST'])
+@require_queue_token
+def pop_job():
+    '''
+    Remove the oldest job from the queue and return its payload, or respond
+    with 204 if the queue is empty.
+    '''
+    payload = get_queue().pop()
+
+    if payload is None:
+        return make_response('', 204)
+
+    return json_response(payload, 200)
+
+
+@blueprint.route('/queue/jobs/<int:work_id>', methods=['GET'])
+@require_queue_token
+def get_job(work_id):
+    '''
+    Report whether a running job has been superseded by a newer push.
+    '''
+    return json_response({'id': work_id,
+                          'superseded': get_queue().is_superseded(work_id)}, 200)
+
+
+@blueprint.route('/queue/jobs/<int:work_id>/finish', methods=['POST'])
+@require_queue_token
+def finish_job(work_id):
+    '''
+    Record that a builder is done with a job. Builders retry this request if
+    they don't hear back, so finishing a job twice does nothing, and neither
+    does finishing an attempt whose lease has run out.
+    '''
+    body = request.get_json(silent=True) or {}
+    status = body.get('status', 'succeeded')
+
+    if status not in ('succeeded', 'failed', 'cancelled'):
+        return json_response({'status': 'Unknown job status: %s' % status}, 400)
+
+    # Where the job deployed to, if it got that far
+    home = body.get('home') if isinstance(body.get('home'), str) else None
+
+    queue = get_queue()
+
+    try:
+        finished = queue.finish(work_id, status, body.get('timings'),
+                                retry=bool(body.get('retry')), error=body.get('error'),
+                                attempt=body.get('attempt'), exit_code=body.get('exit_code'),
+                                home=home)
+    except (KeyError, TypeError) as e:
+        return json_response({'status': 'Malformed timings: %s' % e}, 400)
+
+    return json_response({'id': work_id, 'finished': finished}, 200)
+
+
+@blueprint.route('/queue/jobs/<int:work_id>/heartbeat', methods=['POST'])
+@require_queue_token
+def renew_job(work_id):
+    '''
+    Renew a builder's lease on a running job.
+    '''
+    body = request.get_json(silent=True) or {}
+    renewed = get_queue().heartbeat(work_id, body.get('attempt'))
+
+    return json_response({'id': work_id, 'renewed': renewed}, 200)
+
+
+@blueprint.route('/queue/dead/redeliver', methods=['POST'])
+@require_queue_token
+def redeliver_jobs():
+    '''
+    Put a batch of dead jobs back on the queue in one transaction, once
+    whatever made them fail has been fixed. Responds with the IDs of the jobs
+    that were redelivered.
+    '''
+    body = request.get_json(silent=True) or {}
+    work_ids = body.get('ids')
+
+    if not isinstance(work_ids, list) or not all(isinstance(i, int) for i in work_ids):
+        return json_response({'status': 'Request is missing an `ids` list of job IDs'}, 400)
+
+    if len(work_ids) > MAX_BATCH:
+        return json_response({'status': 'Batches can have at most %d jobs' % MAX_BATCH}, 400)
+
+    return json_response({'redelivered': get_queue().redeliver_many(work_ids)}, 200)
+
+
+@blueprint.route('/queue/wait', methods=['GET'])
+@require_queue_token
+def wait_for_job():
+    '''
+    Hold the request open until there's a job that a builder could claim, or
+    the `timeout` (in seconds, at most 30) runs out.
+    '''
+    try:
+        timeout = min(max(float(request.args.get('timeout', 0)), 0), 30)
+    except ValueError:
+        timeout = 0
+
+    queue = get_queue()
+    deadline = time.monotonic() + timeout
+
+    # Checking for work only reads an index, so polling it is cheap
+    ready = queue.has_work()
+    while not ready and time.monotonic() < deadline:
+        time.sleep(min(queue.min_wait, max(deadline - time.monotonic(), 0)))
+        ready = queue.has_work()
+
+    return json_response({'ready': ready}, 200)
+
+
+@blueprint.route('/queue/metrics', methods=['GET'])
+@require_queue_token
+def get_queue_metrics():
+    '''
+    Return a snapshot of the monitoring data for the queue, as JSON.
+    '''
+    snapshot = get_queue().get_metrics()
+
+    # JSON has no infinity
+    for histogram in snapshot['histograms'].values():
+        histogram['buckets'] = [(metrics.format_value(le), count)
+                                for le, count in histogram['buckets']]
+
+    return json_response(snapshot, 200)
+
+
+@blueprint.route('/jobs', methods=['GET'])
+@require_jobs_token
+def list_jobs():
+    '''
+    List the newest jobs, optionally for one `repo`, a page at a time. Pass
+    the `next` ID from a page as `before` to get the page after it.
+    '''
+    try:
+        before = int(request.args['before']) if 'before' in request.args else None
+        limit = min(max(int(request.args.get('limit', 50)), 1), 200)
+    except ValueError:
+        return json_response({'status': '`before` and `limit` must be integers'}, 400)
+
+    jobs = get_queue().get_jobs(repo=request.args.get('repo'), before=before, limit=limit)
+    next_page = jobs[-1]['id'] if len(jobs) == limit else None
+
+    return json_response({'jobs': jobs, 'next': next_page}, 200)
+
+
+@blueprint.route('/jobs/<int:work_id>', methods=['GET'])
+@require_jobs_token
+def get_job_record(work_id):
+    '''
+    Report the state of a job, how long each of its stages took, and where
+    to follow its log.
+    '''
+    queue = get_queue()
+    job = queue.get_job(work_id)
+
+    if not job:
+        return json_response({'status': 'No job with ID %d' % work_id}, 404)
+
+    job['log'] = url_for('.tail_job_log', work_id=work_id) if queue.get_log_file(work_id) else None
+
+    return json_response(job, 200)
+
+
+@blueprint.route('/jobs/<int:work_id>/log', methods=['GET'])
+@require_jobs_token
+def tail_job_log(work_id):
+    '''
+    Stream a job's log as server-sent events, one per line, following it
+    until the job leaves the queue. Each event's ID is the byte offset after
+    its line, so a client that reconnects with `Last-Event-ID` (or passes it
+    as `offset`) picks up where it left off.
+    '''
+    queue = get_queue()
+    log_file = queue.get_log_file(work_id)
+
+    if not queue.get_job(work_id):
+        return json_response({'status': 'No job with ID %d' % work_id}, 404)
+
+    if not log_file:
+        return json_response({'status': 'The server config doesn\'t set a `log_path`'}, 404)
+
+    try:
+        offset = int(request.headers.get('Last-Event-ID') or request.args.get('offset', 0))
+    except ValueError:
+        offset = 0
+
+    db_conn = queue.db_conn
+
+    def is_finished():
+        return get_queue(db_conn).is_finished(work_id)
+
+    def events():
+        for end, line in tail(log_file, offset, is_finished):
+            yield 'id: %d\ndata: %s\n\n' % (end, line.replace('\r', ''))
+
+        job = get_queue(db_conn).get_job(work_id)
+        yield 'event: end\ndata: %s\n\n' % json.dumps({'status': job['status'] if job else None})
+
+    response = Response(events(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+
+    # Keep proxies from holding events back
+    response.headers['X-Accel-Buffering'] = 'no'
+
+    return response
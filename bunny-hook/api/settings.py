@@ -0,0 +1,147 @@
+# settings.py -- load the server config
+import os
+
+import yaml
+
+
+# Location of the server config file
+CONFIG_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                           'config.yml')
+
+# Settings to use when the server config doesn't set them
+DEFAULTS = {
+    # Directory where repos get checked out for builds
+    'tmp': '/tmp/',
+
+    # Directory for persistent bare mirrors of each repo. When this isn't set,
+    # every repo is cloned straight into the tmp directory instead.
+    'git_path': None,
+
+    # Directory for per-job log files. When this isn't set, the output of
+    # build commands goes to stdout.
+    'log_path': None,
+
+    # Time limits (in seconds) for each build script, and for each job as a
+    # whole. Commands that run over get killed, along with their children.
+    'script_timeout': None,
+    'job_timeout': None,
+
+    # Maximum number of scripts from one stage to run at once, for repos that
+    # declare scripts that can run in parallel. Defaults to the number of CPUs.
+    'max_parallel_scripts': None,
+
+    # Directory for the outputs of build scripts, so that scripts whose
+    # inputs haven't changed can be skipped. When this isn't set, every
+    # script runs on every deploy.
+    'cache_path': None,
+
+    # Directory for compressed copies of the webhook payloads that jobs were
+    # queued from. The queue itself only keeps the parts that a deploy needs;
+    # when this isn't set, the rest is thrown away.
+    'archive_path': None,
+
+    # Limits on the number of jobs waiting in the queue, overall and for each
+    # repo. Webhooks that would go over get a 503 response.
+    'max_queue_depth': None,
+    'max_repo_depth': None,
+
+    # Webhooks per second to accept from each source (a GitHub hook, or an IP
+    # address), and how many a source can send in a burst. Webhooks that go
+    # over get a 429 response.
+    'rate_limit': None,
+    'rate_limit_burst': None,
+
+    # Shared secret for builders on other hosts. On the API server, setting
+    # it opens up the queue API under /queue; on builders, it gets sent along
+    # with `queue_url`, the base URL of that API.
+    'queue_token': None,
+    'queue_url': None,
+
+    # Shared secret for clients that look up jobs and follow their logs under
+    # /jobs. It can't touch the queue, unlike `queue_token`.
+    'jobs_token': None,
+
+    # Default wait (in seconds) to send with 503 responses, until the queue
+    # knows how long jobs take
+    'retry_after': 30,
+
+    # How long (in seconds) a builder holds a job before it goes back on the
+    # queue, unless the builder renews it. Builders renew their leases three
+    # times per lease while jobs run.
+    'lease_time': 60,
+
+    # Most times to try a job that fails to fetch its repo, or whose builder
+    # dies, before setting it aside as dead; and the delay (in seconds) before
+    # the first retry, which doubles after each attempt.
+    'max_attempts': 3,
+    'retry_backoff': 30,
+
+    # Scheduling. `priorities` maps branches (`master`) or repos and branches
+    # (`bunny-hook/master`) to a priority from -100 to 100; higher runs
+    # sooner, at `priority_aging` seconds of waiting per level, so lower ones
+    # still get their turn. `repo_weights` maps repos to their share of the
+    # builders (default 1) while several repos have work waiting; a repo that
+    # floods the queue falls at most `fair_share_window` seconds behind.
+    'priorities': {},
+    'repo_weights': {},
+    'priority_aging': 60,
+    'fair_share_window': 600,
+}
+
+
+def load_settings(config_file=CONFIG_FILE):
+    '''
+    Read the server config, filling in defaults for anything it leaves out.
+
+    Args:
+        - config_file (str): Path to the server config file.
+    '''
+    settings = dict(DEFAULTS)
+
+    if os.path.isfile(config_file):
+        with open(config_file) as cf:
+            settings.update(yaml.safe_load(cf) or {})
+
+    return check_settings(settings)
+
+
+def check_settings(settings):
+    '''
+    Turn the numbers in `priorities` and `repo_weights` into numbers, so that
+    a typo in the server config fails at startup with a ValueError, instead
+    of failing every webhook for the repos that it covers.
+
+    Args:
+        - settings (dict): Server settings, which are updated in place.
+    '''
+    for name in ('priorities', 'repo_weights'):
+        if not isinstance(settings.get(name) or {}, dict):
+            raise ValueError('`%s` must map names to numbers' % name)
+
+    priorities = {}
+
+    for key, value in (settings.get('priorities') or {}).items():
+        try:
+            if isinstance(value, (bool, float)):
+                raise TypeError
+            priorities[str(key)] = int(value)
+        except (TypeError, ValueError):
+            raise ValueError('Priority of %s must be an integer: %r' % (key, value))
+
+    weights = {}
+
+    for key, value in (settings.get('repo_weights') or {}).items():
+        try:
+            weight = float(value) if not isinstance(value, bool) else 0
+        except (TypeError, ValueError):
+            weight = 0
+
+        if not weight > 0:
+            raise ValueError('Weight of %s must be a number above zero: %r' % (key, value))
+
+        weights[str(key)] = weight
+
+    settings['priorities'] = priorities
+    settings['repo_weights'] = weights
+
+    return settings
@@ -0,0 +1,78 @@
+# signatures.py -- check that webhooks were signed with one of our tokens
+# Docs: https://docs.github.com/en/webhooks/using-webhooks/validating-webhook-deliveries
+import hmac
+
+
+# Headers that GitHub puts signatures in, strongest first, and the digest
+# that each one uses
+HEADERS = (
+    ('X-Hub-Signature-256', 'sha256'),
+    ('X-Hub-Signature', 'sha1'),
+)
+
+
+def sign(token, body, digestmod='sha256'):
+    '''
+    Return the signature header value that GitHub would send for a body.
+
+    Arguments:
+        - token (str)     -> Secret key to use for the hash.
+        - body (bytes)    -> Raw request body.
+        - digestmod (str) -> 'sha256' or 'sha1'.
+    '''
+    digest = hmac.new(token.encode('utf-8'), body, digestmod=digestmod).hexdigest()
+    return '{digestmod}={digest}'.format(digestmod=digestmod, digest=digest)
+
+
+class Verifier(object):
+    '''
+    Verify webhook signatures against a set of secret tokens.
+
+    The HMAC for each token is keyed once, up front; each request only copies
+    the keyed state and hashes the body.
+    '''
+    def __init__(self, tokens):
+        '''
+        Arguments:
+            - tokens (list) -> Secret tokens that webhooks can be signed with.
+        '''
+        self.keys = {}
+
+        for _, digestmod in HEADERS:
+            self.keys[digestmod] = [hmac.new(token.encode('utf-8'), digestmod=digestmod)
+                                   for token in tokens]
+
+    def verify(self, body, headers):
+        '''
+        Check the signature on a request. Returns True if it was signed with
+        one of the tokens, False if it wasn't, and None if it isn't signed.
+
+        Arguments:
+            - body (bytes)     -> Raw request body, exactly as it was received.
+            - headers (dict)   -> Request headers.
+        '''
+        for header, digestmod in HEADERS:
+            signature = headers.get(header)
+
+            if signature:
+                break
+        else:
+            return None
+
+        expected_prefix = digestmod + '='
+        if not signature.startswith(expected_prefix):
+            return False
+
+        signature = signature[len(expected_prefix):].encode('utf-8')
+        matched = False
+
+        for key in self.keys[digestmod]:
+            mac = key.copy()
+            mac.update(body)
+
+            # Check every token, so that the time taken doesn't depend on
+            # which one matched
+            if hmac.compare_digest(mac.hexdigest().encode('utf-8'), signature):
+                matched = True
+
+        return matched
@@ -1,44 +1,310 @@
 # worker.py -- runs work (build scripts)
 import os
+import fcntl
 import subprocess
 import logging
 import sys
+import time
+import signal
 import shutil
+import threading
+from contextlib import contextmanager
+from urllib.parse import quote
 
-import yaml
-
-from api.exceptions import WorkerException
+from api.exceptions import (WorkerException, JobCancelled, CheckoutFailed, CommandFailed,
+                            CommandTimeout)
+from api.graph import run_steps
+from api.parse_configs import Parse
 from api.payload import Payload
+from api.releases import Releases, list_files
+from api.cache import ContentCache, input_key, dependency_key
+from api.settings import DEFAULTS
 
-# Log to stdout
-logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+class CommandResult(subprocess.CompletedProcess):
+    '''
+    The result of a command run by the Worker, along with the resources that
+    it used.
+    '''
+    def __init__(self, args, returncode, wall_time, cpu_time, max_rss):
+        super().__init__(args, returncode)
+        self.wall_time = wall_time
+        self.cpu_time = cpu_time
+        self.max_rss = max_rss
 
 
 class Worker(object):
     '''
     Perform a build based on a GitHub API payload.
     '''
-    def __init__(self, payload):
+    # Lines of output longer than this (in bytes) get split up, so that a
+    # command can't make the Worker buffer an unbounded amount of output
+    max_line_length = 64 * 1024
+
+    # How long (in seconds) a command gets to exit after SIGTERM before it
+    # gets SIGKILL
+    kill_grace = 5
+
+    # How long (in seconds) to keep reading output after a command exits, in
+    # case a background process it started is still holding the pipe open
+    output_grace = 1
+
+    # How often (in seconds) to try again for a lock that another deploy
+    # holds
+    lock_poll_interval = 0.5
+
+    def __init__(self, payload, settings=None, is_cancelled=None, log_file=None):
         '''
         Initialize the Worker with attributes from the payload that are
         necessary for cloning the repo.
+
+        Args:
+            - payload (dict):           An event from the GitHub API.
+            - settings (dict):          Optional server settings, as returned
+                                        by `api.settings.load_settings`.
+            - is_cancelled (callable):  Optional function that returns True
+                                        if the deploy should stop early.
+            - log_file (str):           Optional path to a file that the
+                                        output of commands gets appended to.
+                                        By default, output goes to stdout.
         '''
         self.payload = Payload(payload)
+        self.settings = dict(DEFAULTS, **(settings or {}))
+        self.is_cancelled = is_cancelled
+        self.log_file = log_file
+
+        # Times (from `time.monotonic`) when the current job started, and
+        # when it runs out of time
+        self.started = None
+        self.deadline = None
+
+        # Resources used by each script, in the order they ran
+        self.stats = []
+
+        # Stages of the deploy and how long they took, in the order they ran
+        self.timings = []
+
+        # Directory that the repo's deploy config says to deploy to, once
+        # it has been loaded
+        self.home = None
+
+        # Outputs of build scripts from earlier deploys, the files in the
+        # checkout that they're keyed on, and the scripts that were skipped
+        # because their inputs hadn't changed
+        self.cache = None
+        self.manifest = None
+        self.skipped = []
+
+        # Directories of installed dependencies that were restored from
+        # earlier deploys, instead of being installed by the prebuild scripts
+        self.restored = []
+
+        self.output = None
+        self.output_lock = threading.Lock()
+
+        # Commands that are running right now, so that they can be stopped
+        # if a script running alongside them fails
+        self.procs = set()
+        self.procs_lock = threading.Lock()
+        self.aborted = False
 
         self.repo_name = self.payload.get_name()
         self.origin = self.payload.get_origin()
         self.branch = self.payload.get_branch()
 
-    def run_command(self, cmd):
+    def check_cancelled(self):
+        '''
+        Stop the deploy if it has been cancelled. Called between each step, so
+        that a superseded deploy doesn't run any more scripts.
+        '''
+        if self.is_cancelled and self.is_cancelled():
+            raise JobCancelled('Deploy of %s was superseded by a newer push' % self.repo_name)
+
+    @contextmanager
+    def span(self, stage, name=None):
         '''
-        Helper method that wraps `subprocess.run` to run commands and fail noisily.
+        Time a stage of the deploy, and add it to `self.timings`. The timing is
+        recorded even if the stage fails.
+
+        Args:
+            - stage (str):  Kind of stage, e.g. 'checkout' or 'build'.
+            - name (str):   Optional name for this instance of the stage, e.g.
+                            the path to a script.
+        '''
+        start = time.time()
+        started = time.monotonic()
+
+        try:
+            yield
+        finally:
+            self.timings.append({
+                'stage': stage,
+                'name': name,
+                'start': start,
+                'duration': time.monotonic() - started
+            })
+
+    @contextmanager
+    def lock(self, path):
         '''
+        Hold an exclusive lock on a lock file against other deploys on this
+        host, e.g. ones for other branches of the same repo. The file is
+        created if it doesn't exist. Waiting for the lock stops if the deploy
+        is cancelled or runs out of time.
+        '''
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+
         try:
-            return subprocess.run(cmd, check=True, universal_newlines=True)
-        except subprocess.CalledProcessError as e:
-            raise WorkerException(str(e))
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                logging.info('Waiting for another deploy to release %s...' % path)
+
+                with self.span('lock_wait', path):
+                    while True:
+                        self.check_cancelled()
+                        if self.deadline and time.monotonic() >= self.deadline:
+                            raise CommandTimeout('Timed out waiting for a lock on %s' % path)
+
+                        time.sleep(self.lock_poll_interval)
+
+                        try:
+                            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                            break
+                        except BlockingIOError:
+                            pass
 
-    def run_script(self, script_path):
+            yield
+
+        finally:
+            # Closing the file releases the lock
+            os.close(fd)
+
+    def write_output(self, line):
+        '''
+        Write a line of command output to the job's log file, or to stdout.
+        '''
+        with self.output_lock:
+            if self.log_file:
+                if not self.output:
+                    self.output = open(self.log_file, 'a')
+                self.output.write(line)
+                self.output.flush()
+            else:
+                sys.stdout.write(line)
+                sys.stdout.flush()
+
+    def stream_output(self, pipe, label=None):
+        '''
+        Copy output from a command into the log line by line, as it arrives.
+        If a label is given, it's added to the start of each line, so that
+        the output of commands running side by side can be told apart.
+        '''
+        prefix = '[%s] ' % label if label else ''
+
+        with pipe:
+            for line in iter(lambda: pipe.readline(self.max_line_length), b''):
+                self.write_output(prefix + line.decode('utf-8', errors='replace'))
+
+    def kill(self, proc, exited):
+        '''
+        Stop a command and everything it started: first politely, then not.
+        '''
+        for sig in (signal.SIGTERM, signal.SIGKILL):
+            try:
+                os.killpg(proc.pid, sig)
+            except ProcessLookupError:
+                return
+
+            if exited.wait(self.kill_grace):
+                return
+
+    def abort(self):
+        '''
+        Kill all running commands, and refuse to start any more.
+        '''
+        with self.procs_lock:
+            self.aborted = True
+            procs = list(self.procs)
+
+        for proc in procs:
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+    def run_command(self, cmd, timeout=None, label=None):
+        '''
+        Run a command and fail noisily. Its output (stdout and stderr) is
+        streamed to the log as it arrives, and it gets killed (along with
+        any processes it started) if it runs past `timeout` seconds or the
+        deadline for the job.
+
+        Returns a CommandResult recording the wall time, CPU time and peak
+        memory use (in kilobytes) of the command.
+        '''
+        if self.deadline:
+            remaining = max(self.deadline - time.monotonic(), 0)
+            timeout = remaining if timeout is None else min(timeout, remaining)
+
+        self.write_output('$ %s\n' % ' '.join(cmd))
+        start = time.monotonic()
+
+        with self.procs_lock:
+            if self.aborted:
+                raise WorkerException("Command '%s' not run, since the deploy was aborted" % cmd)
+
+            try:
+                # Start a new session, so that the command and all of its
+                # children can be killed as a group
+                proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                        start_new_session=True)
+            except OSError as e:
+                raise WorkerException(str(e))
+
+            self.procs.add(proc)
+
+        reader = threading.Thread(target=self.stream_output, args=(proc.stdout, label),
+                                  daemon=True)
+        reader.start()
+
+        # Reap the command with `wait4` so that we get its resource usage
+        exited = threading.Event()
+        result = {}
+
+        def wait():
+            _, result['status'], result['usage'] = os.wait4(proc.pid, 0)
+            exited.set()
+
+        waiter = threading.Thread(target=wait, daemon=True)
+        waiter.start()
+
+        timed_out = not exited.wait(timeout)
+        if timed_out:
+            self.kill(proc, exited)
+            exited.wait()
+
+        reader.join(self.output_grace)
+
+        with self.procs_lock:
+            self.procs.discard(proc)
+
+        proc.returncode = os.waitstatus_to_exitcode(result['status'])
+        usage = result['usage']
+
+        if timed_out:
+            raise CommandTimeout("Command '%s' timed out after %.1f seconds" % (cmd, timeout))
+
+        if proc.returncode != 0:
+            raise CommandFailed(str(subprocess.CalledProcessError(proc.returncode, cmd)),
+                                proc.returncode)
+
+        return CommandResult(cmd, proc.returncode,
+                             wall_time=time.monotonic() - start,
+                             cpu_time=usage.ru_utime + usage.ru_stime,
+                             max_rss=usage.ru_maxrss)
+
+    def run_script(self, script_path, label=None):
         '''
         Run a shell script from a file.
 
@@ -49,24 +315,31 @@ class Worker(object):
         # https://docs.python.org/3/library/stat.html#stat.S_IXOTH
         os.chmod(script_path, 0o775)
 
-        return self.run_command(['bash', script_path])
+        result = self.run_command(['bash', script_path],
+                                  timeout=self.settings.get('script_timeout'),
+                                  label=label)
 
-    def deploy(self, tmp_path=None):
-        '''
-        Run build and deployment based on the config file.
-        '''
-        logging.info('Deploying %s' % self.repo_name)
+        self.stats.append({
+            'script': script_path,
+            'wall_time': result.wall_time,
+            'cpu_time': result.cpu_time,
+            'max_rss': result.max_rss
+        })
+        logging.info('Finished {script} in {wall:.1f}s (CPU {cpu:.1f}s, peak RSS {rss} KB)'.format(
+            script=script_path, wall=result.wall_time, cpu=result.cpu_time, rss=result.max_rss))
 
-        if not tmp_path:
-            # Default to /tmp/<repo-name>
-            tmp_path = os.path.abspath(os.path.join(os.sep, 'tmp', self.repo_name))
+        return result
 
-        # If the repo exists already in the tmp path, remove it
+    def checkout(self, tmp_path):
+        '''
+        Check out the branch in the tmp path with a shallow clone of the repo.
+        '''
+        # If the repo exists already in the tmp path, update it
         if os.path.exists(tmp_path):
             logging.info('Updating work in %s...' % tmp_path)
             self.run_command(['git', '-C', tmp_path, 'fetch', '--depth=1', 'origin', self.branch])
             self.run_command(['git', '-C', tmp_path, 'checkout', self.branch])
-            self.run_command(['git', '-C', tmp_path, 'reset', '--hard', self.branch])
+            self.run_command(['git', '-C', tmp_path, 'reset', '--hard', 'origin/' + self.branch])
 
         else:
             logging.info('Cloning {origin} into {tmp_path}...'.format(origin=self.origin,
@@ -74,60 +347,334 @@ class Worker(object):
             self.run_command(['git', 'clone', '--depth=1', '--branch', self.branch, self.origin, tmp_path])
             self.run_command(['git', '-C', tmp_path, 'checkout', self.branch])
 
-        # Check for a yaml file
-        yml_file = os.path.join(tmp_path, 'deploy.yml')
-        yaml_file = os.path.join(tmp_path, 'deploy.yaml')
+    def get_mirror_path(self):
+        '''
+        Return the path to the persistent bare mirror of the repo.
+        '''
+        return os.path.abspath(os.path.join(self.settings['git_path'], self.repo_name + '.git'))
+
+    def get_home_lock(self):
+        '''
+        Return the path to the lock file for the repo's home, next to the
+        checkouts in the tmp directory, so that locking doesn't create the
+        home itself.
+        '''
+        tmp = os.path.abspath(self.settings['tmp'])
+        os.makedirs(tmp, exist_ok=True)
+        return os.path.join(tmp, quote(self.home, safe='') + '.lock')
+
+    def update_mirror(self):
+        '''
+        Bring the persistent bare mirror of the repo up to date with the
+        branch, creating the mirror if it doesn't exist yet. Returns the path
+        to the mirror.
+        '''
+        mirror_path = self.get_mirror_path()
+
+        if os.path.exists(mirror_path):
+            # Only transfer objects for the branch that's being deployed
+            logging.info('Fetching {branch} into {mirror}...'.format(branch=self.branch,
+                                                                     mirror=mirror_path))
+            refspec = '+refs/heads/{branch}:refs/heads/{branch}'.format(branch=self.branch)
+            self.run_command(['git', '-C', mirror_path, 'fetch', 'origin', refspec])
+
+        else:
+            logging.info('Mirroring {origin} into {mirror}...'.format(origin=self.origin,
+                                                                      mirror=mirror_path))
+            os.makedirs(os.path.dirname(mirror_path), exist_ok=True)
+            self.run_command(['git', 'clone', '--bare', self.origin, mirror_path])
+
+        return mirror_path
+
+    def checkout_from_mirror(self, tmp_path):
+        '''
+        Check out the pushed commit in the tmp path as a worktree of the
+        repo's persistent mirror, so that only new objects are fetched over
+        the network and the checkout is a local operation.
+        '''
+        # Prefer the exact commit from the push over the tip of the branch
+        target = self.payload.get_sha() or 'refs/heads/' + self.branch
+
+        mirror_path = self.get_mirror_path()
+        os.makedirs(os.path.dirname(mirror_path), exist_ok=True)
+
+        # Deploys of other branches share the mirror, and each of them has its
+        # own worktree
+        with self.lock(mirror_path + '.lock'):
+            self.update_mirror()
+
+            # Worktrees have a `.git` file pointing back to the mirror, rather
+            # than a `.git` directory
+            if not os.path.isfile(os.path.join(tmp_path, '.git')):
+                if os.path.exists(tmp_path):
+                    # Clear out a standalone clone from before the mirror existed
+                    shutil.rmtree(tmp_path)
+
+                logging.info('Checking out {target} into {tmp_path}...'.format(target=target,
+                                                                             tmp_path=tmp_path))
+                # Forget about worktrees whose directories have been removed
+                # (e.g. by a wiped /tmp), so that the path can be reused
+                self.run_command(['git', '-C', mirror_path, 'worktree', 'prune'])
+                self.run_command(['git', '-C', mirror_path, 'worktree', 'add', '--force',
+                                  '--detach', tmp_path, target])
+                return
+
+        logging.info('Updating work in %s...' % tmp_path)
+        self.run_command(['git', '-C', tmp_path, 'checkout', '--force', '--detach', target])
+
+    def run_stage(self, stage, steps, build_path):
+        '''
+        Run the scripts for a stage of the deploy, side by side where their
+        dependencies allow it.
+
+        Args:
+            - stage (str):      'prebuild', 'build' or 'deploy'.
+            - steps (list):     Steps for the stage, from `parse_steps`.
+            - build_path (str): Directory that script paths are relative to.
+        '''
+        description = 'deployment' if stage == 'deploy' else stage
+
+        # Only label output when scripts might run at the same time
+        parallel = any(step.needs != ({steps[i - 1].script} if i else set())
+                       for i, step in enumerate(steps))
+
+        # Deploy scripts have effects outside of the build, so they always run
+        keys = self.input_keys(steps) if self.cache and stage != 'deploy' else {}
+
+        def run(step):
+            self.check_cancelled()
+            script_path = os.path.join(build_path, step.script)
+            key = keys.get(step.script)
+
+            if key:
+                entry = self.cache.get(key)
+                if entry is not None and self.cache.restore(entry, build_path):
+                    logging.info('Skipping {stage} script {script}, since its inputs '
+                                 'haven\'t changed'.format(stage=description, script=script_path))
+                    self.skipped.append(step.script)
+                    return
+
+            logging.info('Running {stage} script {script}...'.format(stage=description,
+                                                                   script=script_path))
+            with self.span(stage, step.script):
+                if parallel:
+                    self.run_script(script_path, label=step.script)
+                else:
+                    self.run_script(script_path)
+
+            if key:
+                self.cache.put(key, build_path, step.outputs)
+
+        max_workers = self.settings.get('max_parallel_scripts') or os.cpu_count() or 1
+        run_steps(steps, run, max_workers, abort=self.abort)
+
+    def input_keys(self, steps):
+        '''
+        Return the input key of each script in a stage that declares its
+        `paths`, keyed on the script. See `api.cache.input_key`.
+        '''
+        by_script = {step.script: step for step in steps}
+        keys = {}
+
+        def key(step):
+            if step.script not in keys:
+                needs_keys = [key(by_script[need]) for need in sorted(step.needs)]
+                keys[step.script] = input_key(step, self.manifest, needs_keys)
+            return keys[step.script]
+
+        for step in steps:
+            key(step)
+
+        return keys
+
+    def restore_dependencies(self, dependencies, build_path):
+        '''
+        Put the directories of installed dependencies from earlier deploys in
+        place, for each one whose lockfiles haven't changed. Returns the
+        ones that couldn't be restored, with their keys, so that they can be
+        saved once the prebuild scripts have installed them.
+
+        Args:
+            - dependencies (list):  Dependencies, from `parse_dependencies`.
+            - build_path (str):     Directory that their paths are relative to.
+        '''
+        missed = []
+
+        for dependency in dependencies:
+            key = dependency_key(dependency, self.manifest)
+            entry = self.cache.get(key)
+
+            if entry is not None:
+                target = os.path.join(build_path, dependency.path)
+
+                with self.span('restore', dependency.path):
+                    # Start from an empty directory, so nothing from an older
+                    # install is left over
+                    if os.path.isdir(target) and not os.path.islink(target):
+                        shutil.rmtree(target)
+                    elif os.path.lexists(target):
+                        os.remove(target)
+
+                    restored = self.cache.restore(entry, build_path)
 
-        if not (os.path.isfile(yml_file) or os.path.isfile(yaml_file)):
-            raise WorkerException('Could not locate a `deploy.yml` file in your repo.')
+                if restored:
+                    logging.info('Restored {path}, since its lockfiles haven\'t '
+                                 'changed'.format(path=dependency.path))
+                    self.restored.append(dependency.path)
+                    continue
 
-        if os.path.isfile(yml_file) and os.path.isfile(yaml_file):
-            raise WorkerException('Found two config files in this repo! Delete one and try again.')
+                shutil.rmtree(target, ignore_errors=True)
+
+            missed.append((dependency, key))
+
+        return missed
+
+    def save_dependencies(self, missed, build_path):
+        '''
+        Store the directories of installed dependencies that the prebuild
+        scripts installed, for later deploys with the same lockfiles.
+
+        Args:
+            - missed (list):        Dependencies and their keys, as returned
+                                    by `restore_dependencies`.
+            - build_path (str):     Directory that their paths are relative to.
+        '''
+        for dependency, key in missed:
+            if not os.path.isdir(os.path.join(build_path, dependency.path)):
+                logging.warning('Dependencies {path} weren\'t installed by the prebuild '
+                                'scripts, so they can\'t be cached'.format(path=dependency.path))
+                continue
+
+            with self.span('save', dependency.path):
+                self.cache.put(key, build_path, [dependency.path])
+
+    def run_plan(self, plan, tmp_path):
+        '''
+        Copy the checkout into the repo's home, then run its prebuild, build
+        and deploy scripts.
+        '''
+        clone_path = plan.home
+
+        self.check_cancelled()
+
+        if plan.releases:
+            # Build a new release directory, and only swap it in once the
+            # build succeeds
+            logging.info('Creating release from {tmp_path} in {clone_path}...'.format(
+                tmp_path=tmp_path, clone_path=clone_path))
+            releases = Releases(clone_path)
+            with self.span('copy'):
+                release = releases.create(tmp_path)
+            build_path = releases.path(release)
 
-        if os.path.isfile(yml_file):
-            config_file = yml_file
         else:
-            config_file = yaml_file
-
-        # Parse the config file
-        logging.info('Loading config file from %s...' % config_file)
-        with open(config_file) as cf:
-            config = yaml.load(cf)
-
-        if not config:
-            raise WorkerException('Deployment file %s appears to be empty' % config_file)
-
-        clone_path = config.get('home')
-        prebuild_scripts = config.get('prebuild', [])
-        build_scripts = config.get('build', [])
-        deploy_scripts = config.get('deploy', [])
-
-        # Enforce required directives
-        if not clone_path:
-            raise WorkerException('Deployment file %s is missing `home` directive' % config_file)
-
-        # Move repo from tmp to the clone path
-        logging.info('Moving repo from {tmp_path} to {clone_path}...'.format(tmp_path=tmp_path,
-                                                                      clone_path=clone_path))
-        self.run_command(['rsync', '-avz', '--delete', tmp_path, clone_path])
-
-        # Run prebuild scripts, if they exist
-        for script in prebuild_scripts:
-            script_path = os.path.join(clone_path, script)
-            logging.info('Running prebuild script %s...' % script_path)
-            self.run_script(script_path)
-
-        # Run build scripts, if they exist
-        for script in build_scripts:
-            script_path = os.path.join(clone_path, script)
-            logging.info('Running build script %s...' % script_path)
-            self.run_script(script_path)
+            # Move repo from tmp to the clone path
+            logging.info('Moving repo from {tmp_path} to {clone_path}...'.format(tmp_path=tmp_path,
+                                                                          clone_path=clone_path))
+            with self.span('copy'):
+                self.run_command(['rsync', '-a', '--delete', '--exclude=.git',
+                                  os.path.join(tmp_path, ''), clone_path])
+            build_path = clone_path
+
+        missed = []
+        if self.cache and plan.dependencies:
+            missed = self.restore_dependencies(plan.dependencies, build_path)
+
+        # Run prebuild and build scripts, if they exist
+        self.run_stage('prebuild', plan.stages['prebuild'], build_path)
+
+        if missed:
+            self.save_dependencies(missed, build_path)
+
+        self.run_stage('build', plan.stages['build'], build_path)
+
+        if plan.releases:
+            with self.span('activate'):
+                releases.activate(release)
+                releases.prune(plan.keep_releases)
 
         # Run deploy scripts, if they exist
-        for script in deploy_scripts:
-            script_path = os.path.join(clone_path, script)
-            logging.info('Running deployment script %s...' % script_path)
-            self.run_script(script_path)
+        self.run_stage('deploy', plan.stages['deploy'], build_path)
+
+    def deploy(self, tmp_path=None):
+        '''
+        Run build and deployment based on the config file.
+        '''
+        self.started = time.monotonic()
+
+        job_timeout = self.settings.get('job_timeout')
+        if job_timeout:
+            self.deadline = self.started + job_timeout
+
+        try:
+            with self.span('job'):
+                return self.run_deploy(tmp_path)
+        except Exception as e:
+            # Send timings back along with the error, so that they can be
+            # recorded when the job runs in another process
+            e.timings = self.timings
+            e.home = self.home
+            raise
+        finally:
+            self.deadline = None
+
+            with self.output_lock:
+                if self.output:
+                    self.output.close()
+                    self.output = None
+
+    def run_deploy(self, tmp_path=None):
+        '''
+        Check out the repo, then run its build and deployment scripts.
+        '''
+        logging.info('Deploying %s' % self.repo_name)
+
+        if not tmp_path:
+            # Default to /tmp/<repo-name>@<branch>, so that each branch builds
+            # in its own checkout
+            work_name = '{repo}@{branch}'.format(repo=self.repo_name,
+                                                 branch=quote(self.branch, safe=''))
+            tmp_path = os.path.abspath(os.path.join(self.settings['tmp'], work_name))
+
+        self.check_cancelled()
+
+        with self.span('checkout'):
+            try:
+                if self.settings.get('git_path'):
+                    self.checkout_from_mirror(tmp_path)
+                else:
+                    self.checkout(tmp_path)
+            except WorkerException as e:
+                raise CheckoutFailed(str(e)) from e
+
+        # Load the deploy config, and check it over before running anything
+        plan = Parse(self.settings).parse(tmp_path)
+        logging.info('Loaded config file from %s' % plan.config_file)
+
+        # The repo can lower the server's time limits for its own deploys
+        job_timeout = plan.settings.get('job_timeout')
+        if job_timeout and job_timeout != self.settings.get('job_timeout'):
+            self.deadline = (self.started or time.monotonic()) + job_timeout
+        self.settings = plan.settings
+
+        clone_path = plan.home
+        self.home = os.path.abspath(clone_path)
+
+        # Scripts that declare the paths they read can be skipped when those
+        # files haven't changed since an earlier build, and dependencies
+        # don't have to be installed again until their lockfiles change
+        cache_path = self.settings.get('cache_path')
+        if cache_path and (plan.dependencies or
+                           any(step.paths is not None for stage in ('prebuild', 'build')
+                               for step in plan.stages[stage])):
+            self.cache = ContentCache(os.path.join(cache_path, self.repo_name))
+            self.manifest, _ = list_files(tmp_path)
+
+        # Deploys of other branches can build at the same time, unless they
+        # share a home. The queue doesn't hand out branches that are known to
+        # share one, so this only waits when a home has changed.
+        with self.lock(self.get_home_lock()):
+            self.run_plan(plan, tmp_path)
 
         logging.info('Finished deploying %s!' % self.repo_name)
         logging.info('---------------------')
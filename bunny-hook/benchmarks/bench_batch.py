@@ -0,0 +1,90 @@
+'''
+bench_batch.py -- measure what batching saves when importing and claiming a backlog of jobs
+'''
+import argparse
+import math
+import os
+import tempfile
+import time
+
+import env
+from api.queue import Queue
+
+
+def backlog(jobs, repos=100):
+    '''
+    Return pushes to `jobs` different branches, spread over `repos` repos, so
+    that none of them replace each other in the queue.
+    '''
+    return [{
+        'ref': 'refs/heads/branch-%d' % (i // repos),
+        'after': '%040x' % i,
+        'repository': {'name': 'bench-repo-%d' % (i % repos)},
+        'clone_url': 'https://github.com/jeancochrane/bench-repo-%d.git' % (i % repos),
+    } for i in range(jobs)]
+
+
+def bench(db_conn, payloads, batch, synchronous):
+    '''
+    Import the payloads and claim them all back, `batch` jobs per
+    transaction. Returns the seconds spent on each, and the number of
+    commits each took.
+    '''
+    queue = Queue(db_conn)
+
+    # In WAL mode, FULL syncs the log on every commit, while NORMAL only
+    # syncs it at checkpoints
+    queue.cursor.execute('PRAGMA synchronous = %s' % synchronous)
+
+    start = time.perf_counter()
+    if batch == 1:
+        for payload in payloads:
+            queue.add(payload)
+    else:
+        for i in range(0, len(payloads), batch):
+            queue.add_many(payloads[i:i + batch])
+    added = time.perf_counter() - start
+
+    start = time.perf_counter()
+    claimed = 0
+    if batch == 1:
+        while queue.claim():
+            claimed += 1
+    else:
+        work = queue.claim_many(batch)
+        while work:
+            claimed += len(work)
+            work = queue.claim_many(batch)
+    claimed_time = time.perf_counter() - start
+
+    queue.close()
+    assert claimed == len(payloads), 'Claimed %d of %d jobs' % (claimed, len(payloads))
+
+    commits = math.ceil(len(payloads) / batch)
+    return added, claimed_time, commits
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--jobs', type=int, default=10000,
+                        help='Jobs in the backlog (default: %(default)s)')
+    parser.add_argument('--batch', type=int, action='append',
+                        help='Jobs per transaction; can be given more than once '
+                             '(default: 1 and 500)')
+    args = parser.parse_args()
+
+    payloads = backlog(args.jobs)
+
+    for synchronous in ('NORMAL', 'FULL'):
+        print('synchronous = %s' % synchronous)
+
+        for batch in args.batch or [1, 500]:
+            with tempfile.TemporaryDirectory() as tmp:
+                added, claimed, commits = bench(os.path.join(tmp, 'bench.db'), payloads,
+                                                batch, synchronous)
+
+            print('  batch {batch:>5}: {commits:>6} commits | import {added:6.2f}s '
+                  '({add_rate:8.0f} jobs/s) | claim {claimed:6.2f}s '
+                  '({claim_rate:8.0f} jobs/s)'.format(
+                      batch=batch, commits=commits, added=added, claimed=claimed,
+                      add_rate=len(payloads) / added, claim_rate=len(payloads) / claimed))
@@ -0,0 +1,113 @@
+'''
+bench_consumer.py -- measure idle CPU and pickup latency of the queue consumer
+'''
+import argparse
+import os
+import statistics
+import tempfile
+import threading
+import time
+
+import env
+from api.queue import Queue
+
+
+class TimedQueue(Queue):
+    '''
+    Queue that records how long each job waited instead of deploying it.
+    '''
+    def __init__(self, db_conn, latencies, stop):
+        super().__init__(db_conn)
+        self.latencies = latencies
+        self.stop = stop
+
+    def run(self):
+        if self.stop.is_set():
+            raise SystemExit
+
+        # Queues only keep the parts of a payload that a deploy needs, so
+        # time the job from when it was added
+        work = self.claim()
+        if work:
+            work_id, _ = work
+            select = 'SELECT date_added FROM queue WHERE id = ?'
+            date_added = self.cursor.execute(select, (work_id,)).fetchone()[0]
+            self.latencies.append(time.time() - date_added)
+            self.cursor.execute('DELETE FROM queue WHERE id = ?', (work_id,))
+            return True
+
+        return False
+
+
+def spin(queue):
+    '''
+    The old consumer loop: check the queue as fast as possible.
+    '''
+    while True:
+        queue.run()
+
+
+def consume(db_conn, mode, latencies, stop):
+    queue = TimedQueue(db_conn, latencies, stop)
+    try:
+        if mode == 'spin':
+            spin(queue)
+        else:
+            queue.run_forever()
+    except SystemExit:
+        pass
+    finally:
+        queue.close()
+
+
+def bench(mode, db_conn, idle, jobs):
+    latencies = []
+    stop = threading.Event()
+
+    consumer = threading.Thread(target=consume, args=(db_conn, mode, latencies, stop))
+    consumer.start()
+
+    # Let the consumer settle into its idle state before measuring
+    time.sleep(1)
+
+    cpu_start, wall_start = time.process_time(), time.time()
+    time.sleep(idle)
+    idle_cpu = (time.process_time() - cpu_start) / (time.time() - wall_start)
+
+    producer = Queue(db_conn)
+    for _ in range(jobs):
+        producer.add({})
+        # Space jobs out so that each one arrives at an idle consumer
+        time.sleep(0.2)
+    producer.close()
+
+    time.sleep(0.5)
+    stop.set()
+    producer = Queue(db_conn)
+    producer.notify()
+    producer.close()
+    consumer.join()
+
+    return idle_cpu, latencies
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--idle', type=float, default=5,
+                        help='Seconds to measure idle CPU for (default: %(default)s)')
+    parser.add_argument('--jobs', type=int, default=20,
+                        help='Number of jobs to time (default: %(default)s)')
+    args = parser.parse_args()
+
+    for mode in ('spin', 'blocking'):
+        with tempfile.TemporaryDirectory() as tmp:
+            idle_cpu, latencies = bench(mode, os.path.join(tmp, 'bench.db'),
+                                        args.idle, args.jobs)
+
+        latencies = sorted(latencies)
+        print('{mode:>8}: idle CPU {cpu:5.1f}% | pickup latency p50 {p50:.1f}ms '
+              'max {max:.1f}ms ({n} jobs)'.format(mode=mode,
+                                                  cpu=idle_cpu * 100,
+                                                  p50=statistics.median(latencies) * 1000,
+                                                  max=latencies[-1] * 1000,
+                                                  n=len(latencies)))
@@ -0,0 +1,53 @@
+'''
+bench_enqueue.py -- measure how fast webhooks can be dropped into the queue
+'''
+import argparse
+import os
+import tempfile
+import time
+
+import env
+from api.queue import Queue, get_queue
+
+
+PAYLOAD = {
+    'ref': 'refs/heads/master',
+    'repository': {
+        'name': 'bench-repo'
+    },
+    'clone_url': 'https://github.com/jeancochrane/bench-repo.git'
+}
+
+
+def fresh(db_conn, jobs):
+    '''
+    Open a new connection for every job, like the webhook used to.
+    '''
+    for _ in range(jobs):
+        Queue(db_conn).add(PAYLOAD)
+
+
+def pooled(db_conn, jobs):
+    '''
+    Reuse one long-lived connection per thread.
+    '''
+    for _ in range(jobs):
+        get_queue(db_conn).add(PAYLOAD)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--jobs', type=int, default=5000,
+                        help='Number of jobs to enqueue (default: %(default)s)')
+    args = parser.parse_args()
+
+    for name, bench in (('fresh', fresh), ('pooled', pooled)):
+        with tempfile.TemporaryDirectory() as tmp:
+            db_conn = os.path.join(tmp, 'bench.db')
+
+            start = time.time()
+            bench(db_conn, args.jobs)
+            elapsed = time.time() - start
+
+        print('{name:>6}: {rate:8.0f} enqueues/s'.format(name=name,
+                                                        rate=args.jobs / elapsed))
@@ -0,0 +1,88 @@
+'''
+bench_ingest.py -- load test the webhook endpoint
+'''
+import argparse
+import json
+import logging
+import os
+import statistics
+import tempfile
+import time
+
+import env
+from api import create_app
+from api.queue import Queue
+from api.signatures import sign
+
+
+def make_payload(commits, branch):
+    '''
+    Build a push payload shaped like GitHub's, with a given number of commits.
+    '''
+    return {
+        'ref': 'refs/heads/%s' % branch,
+        'before': '0' * 40,
+        'after': 'f' * 40,
+        'repository': {
+            'name': 'bench-repo',
+            'full_name': 'jeancochrane/bench-repo',
+            'clone_url': 'https://github.com/jeancochrane/bench-repo.git'
+        },
+        'commits': [{
+            'id': '%040x' % i,
+            'message': 'Commit number %d\n\n%s' % (i, 'Some details. ' * 20),
+            'added': ['src/new_%d.py' % i],
+            'modified': ['src/module_%d.py' % j for j in range(10)],
+            'removed': []
+        } for i in range(commits)]
+    }
+
+
+def bench(requests, tokens, commits):
+    client = create_app({'TOKENS': tokens}).test_client()
+    latencies = []
+
+    for i in range(requests):
+        # Give each request its own branch, so that none of them coalesce
+        branch = 'branch-%d' % i
+        body = json.dumps(make_payload(commits, branch)).encode('utf-8')
+        headers = {'X-Hub-Signature-256': sign(tokens[-1], body)}
+
+        start = time.perf_counter()
+        response = client.post('/hooks/github/%s' % branch, data=body, headers=headers,
+                               content_type='application/json')
+        latencies.append(time.perf_counter() - start)
+
+        assert response.status_code == 202, response.data
+
+    return latencies
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--requests', type=int, default=2000,
+                        help='Number of webhooks to send (default: %(default)s)')
+    parser.add_argument('--tokens', type=int, default=10,
+                        help='Number of secret tokens to check against (default: %(default)s)')
+    parser.add_argument('--commits', type=int, default=20,
+                        help='Commits per push payload (default: %(default)s)')
+    args = parser.parse_args()
+
+    tokens = ['token-%d' % i for i in range(args.tokens)]
+
+    # Keep request logs out of the results; they're written off the request
+    # thread anyway
+    logging.getLogger('api.requests').setLevel(logging.WARNING)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # Point the webhook at a scratch database
+        Queue.db_conn = os.path.join(tmp, 'bench.db')
+        latencies = sorted(bench(args.requests, tokens, args.commits))
+
+    size = len(json.dumps(make_payload(args.commits, 'master')))
+    print('{n} requests ({size} KB payloads, {tokens} tokens): {rate:.0f} req/s, '
+          'p50 {p50:.2f}ms, p99 {p99:.2f}ms'.format(n=args.requests, size=size // 1024,
+                                                   tokens=args.tokens,
+                                                   rate=len(latencies) / sum(latencies),
+                                                   p50=statistics.median(latencies) * 1000,
+                                                   p99=latencies[int(len(latencies) * 0.99)] * 1000))
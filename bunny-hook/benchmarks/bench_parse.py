@@ -0,0 +1,70 @@
+'''
+bench_parse.py -- measure how long it takes to load a deploy config
+'''
+import argparse
+import os
+import tempfile
+import time
+
+import yaml
+
+import env
+from api.parse_configs import Parse
+
+
+def make_config(scripts):
+    '''
+    Write out a deploy config with `scripts` scripts in each stage.
+    '''
+    lines = ['home: /srv/bench-repo', 'releases: true']
+
+    for stage in ('prebuild', 'build', 'deploy'):
+        lines.append('%s:' % stage)
+        lines.extend('    - scripts/%s_%d.sh' % (stage, i) for i in range(scripts))
+
+    return '\n'.join(lines) + '\n'
+
+
+def full_loader(repo, runs):
+    '''
+    Parse the config with PyYAML's pure-Python full loader on every deploy,
+    like the Worker used to.
+    '''
+    for _ in range(runs):
+        with open(os.path.join(repo, 'deploy.yml')) as cf:
+            yaml.load(cf, Loader=yaml.FullLoader)
+
+
+def cached(repo, runs):
+    '''
+    Load the config through Parse, which only parses each version once.
+    '''
+    Parse._cache.clear()
+    for _ in range(runs):
+        Parse().parse(repo)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--runs', type=int, default=1000,
+                        help='Number of deploys to load the config for (default: %(default)s)')
+    parser.add_argument('--scripts', type=int, default=10,
+                        help='Scripts in each stage (default: %(default)s)')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as repo:
+        with open(os.path.join(repo, 'deploy.yml'), 'w') as cf:
+            cf.write(make_config(args.scripts))
+
+        os.makedirs(os.path.join(repo, 'scripts'))
+        for stage in ('prebuild', 'build', 'deploy'):
+            for i in range(args.scripts):
+                open(os.path.join(repo, 'scripts', '%s_%d.sh' % (stage, i)), 'w').close()
+
+        for name, bench in (('full', full_loader), ('cached', cached)):
+            start = time.perf_counter()
+            bench(repo, args.runs)
+            elapsed = time.perf_counter() - start
+
+            print('{name:>6}: {per:.3f}ms per deploy'.format(name=name,
+                                                            per=elapsed / args.runs * 1000))
@@ -0,0 +1,87 @@
+'''
+bench_payload.py -- measure how much a large push payload costs the queue
+'''
+import argparse
+import os
+import json
+import tempfile
+import time
+
+import env
+from api.queue import Queue
+
+
+def make_payload(commits, files):
+    '''
+    Build a push event shaped like the ones GitHub sends, with `commits`
+    commits that each touch `files` files.
+    '''
+    return {
+        'ref': 'refs/heads/master',
+        'before': '0' * 40,
+        'after': 'f' * 40,
+        'repository': {
+            'name': 'bench-repo',
+            'full_name': 'jeancochrane/bench-repo',
+            'clone_url': 'https://github.com/jeancochrane/bench-repo.git',
+        },
+        'commits': [{
+            'id': '%040x' % i,
+            'message': 'Commit number %d\n\nWith a longer description.' % i,
+            'author': {'name': 'Bench', 'email': 'bench@example.com'},
+            'modified': ['src/module_%d/file_%d.py' % (i, j) for j in range(files)],
+        } for i in range(commits)],
+    }
+
+
+def bench(payload, jobs, archive):
+    raw = json.dumps(payload).encode('utf-8')
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_conn = os.path.join(tmp, 'bench.db')
+        settings = {'archive_path': os.path.join(tmp, 'archive')} if archive else {}
+        queue = Queue(db_conn, settings=settings)
+        queue.coalesce = False
+
+        start = time.time()
+        for _ in range(jobs):
+            queue.add(payload, raw=raw)
+        enqueue = time.time() - start
+
+        start = time.time()
+        while queue.pop():
+            pass
+        pop = time.time() - start
+
+        queue.cursor.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        db_size = os.path.getsize(db_conn)
+        archive_size = 0
+        if archive:
+            archive_size = sum(os.path.getsize(os.path.join(settings['archive_path'], name))
+                               for name in os.listdir(settings['archive_path']))
+        queue.close()
+
+    return enqueue, pop, db_size, archive_size
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--jobs', type=int, default=500,
+                        help='Number of jobs to enqueue (default: %(default)s)')
+    parser.add_argument('--commits', type=int, default=100,
+                        help='Commits in each push (default: %(default)s)')
+    parser.add_argument('--files', type=int, default=20,
+                        help='Files changed by each commit (default: %(default)s)')
+    args = parser.parse_args()
+
+    payload = make_payload(args.commits, args.files)
+    print('payload: %d KB' % (len(json.dumps(payload)) // 1024))
+
+    for archive in (False, True):
+        enqueue, pop, db_size, archive_size = bench(payload, args.jobs, archive)
+        print('{name:>8}: {add:6.0f} enqueues/s | {pop:6.0f} pops/s | '
+              'db {db} KB | archive {archive} KB'.format(name='archive' if archive else 'compact',
+                                                         add=args.jobs / enqueue,
+                                                         pop=args.jobs / pop,
+                                                         db=db_size // 1024,
+                                                         archive=archive_size // 1024))
@@ -0,0 +1,69 @@
+'''
+bench_pool.py -- measure job throughput of the worker pool across many repos
+'''
+import argparse
+import os
+import subprocess
+import tempfile
+import time
+
+import env
+from api.queue import Queue
+from api.pool import WorkerPool
+
+
+def build(payload, **options):
+    '''
+    Stand-in for a deploy that runs a stub build script.
+    '''
+    subprocess.run(['bash', options['settings']['script']], check=True)
+    return True
+
+
+def bench(workers, repos, jobs_per_repo, script):
+    with tempfile.TemporaryDirectory() as tmp:
+        queue = Queue(os.path.join(tmp, 'bench.db'), settings={'script': script})
+
+        for branch in range(jobs_per_repo):
+            for repo in range(repos):
+                queue.add({
+                    'ref': 'refs/heads/branch-%d' % branch,
+                    'repository': {'name': 'repo-%d' % repo},
+                })
+
+        start = time.time()
+        pool = WorkerPool(queue, workers, target=build)
+        pool.run_forever(until_empty=True)
+        pool.shutdown()
+        elapsed = time.time() - start
+
+        queue.close()
+
+    return elapsed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--repos', type=int, default=8,
+                        help='Number of simulated repos (default: %(default)s)')
+    parser.add_argument('--jobs', type=int, default=4,
+                        help='Jobs per repo (default: %(default)s)')
+    parser.add_argument('--build-time', type=float, default=0.5,
+                        help='Seconds that each stub build takes (default: %(default)s)')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4, 8],
+                        help='Pool sizes to test (default: %(default)s)')
+    args = parser.parse_args()
+
+    with tempfile.NamedTemporaryFile('w', suffix='.sh') as script:
+        script.write('#!/bin/bash\nsleep %s\n' % args.build_time)
+        script.flush()
+
+        total = args.repos * args.jobs
+        for workers in args.workers:
+            elapsed = bench(workers, args.repos, args.jobs, script.name)
+            print('{workers:>3} workers: {total} jobs across {repos} repos in '
+                  '{elapsed:6.2f}s ({rate:5.2f} jobs/s)'.format(workers=workers,
+                                                               total=total,
+                                                               repos=args.repos,
+                                                               elapsed=elapsed,
+                                                               rate=total / elapsed))
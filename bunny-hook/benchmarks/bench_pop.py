@@ -0,0 +1,106 @@
+'''
+bench_pop.py -- measure how dequeue time scales with the size of the backlog
+'''
+import argparse
+import json
+import os
+import sqlite3
+import tempfile
+import time
+
+import env
+from api.queue import Queue
+
+
+PAYLOAD = json.dumps({'ref': 'refs/heads/master', 'repository': {'name': 'bench-repo'}})
+
+
+def legacy_pop(conn):
+    '''
+    The pop from before the schema had an index: two full table scans.
+    '''
+    conn.execute('BEGIN IMMEDIATE')
+    work = conn.execute('SELECT * FROM queue ORDER BY date_added LIMIT 1').fetchone()
+    if work:
+        conn.execute('DELETE FROM queue WHERE id = ?', (work[0],))
+    conn.execute('COMMIT')
+
+
+def bench_legacy(db_conn, backlog, pops):
+    conn = sqlite3.connect(db_conn, isolation_level=None)
+    conn.execute('CREATE TABLE queue (id TEXT, payload TEXT, date_added NUMERIC)')
+    conn.execute('BEGIN')
+    conn.executemany('INSERT INTO queue VALUES (?, ?, ?)',
+                     (('job-%d' % i, PAYLOAD, i) for i in range(backlog)))
+    conn.execute('COMMIT')
+
+    start = time.time()
+    for _ in range(pops):
+        legacy_pop(conn)
+    return (time.time() - start) / pops
+
+
+def bench_claim(db_conn, backlog, pops, repos=100, running=10):
+    '''
+    Claim and finish jobs from a backlog of pushes to different branches,
+    spread over `repos` repos, while `running` jobs are still being built.
+    Jobs are queued through `add_many`, so they get their repos' fair-share
+    start times, and most branches have deployed before, so the queue knows
+    their homes. The claims have to skip over jobs that a running job holds
+    back, as they would in production.
+    '''
+    queue = Queue(db_conn)
+    queue.add_many([{
+        'ref': 'refs/heads/branch-%d' % (i // repos),
+        'after': '%040x' % i,
+        'repository': {'name': 'bench-repo-%d' % (i % repos)},
+    } for i in range(backlog)])
+
+    # Every fourth branch is new, so it waits for anything else running in
+    # its repo. The others deploy to homes of their own.
+    homes = queue.cursor.execute('SELECT DISTINCT lock_key, ref FROM queue').fetchall()
+    with queue.transaction():
+        queue.cursor.executemany('INSERT INTO homes (lock_key, ref, home) VALUES (?, ?, ?)',
+                                 ((lock_key, ref, '/srv/%s/%s' % (lock_key, ref))
+                                  for lock_key, ref in homes
+                                  if int(ref.rsplit('-', 1)[1]) % 4 != 1))
+
+    # Long builds that hold their repos' new branches back for the whole run
+    queue.claim_many(running)
+
+    start = time.time()
+    for _ in range(pops):
+        work_id, _ = queue.claim()
+        queue.finish(work_id)
+    elapsed = (time.time() - start) / pops
+
+    queue.close()
+    return elapsed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--pops', type=int, default=200,
+                        help='Number of jobs to dequeue (default: %(default)s)')
+    parser.add_argument('--backlog', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help='Backlog sizes to test (default: %(default)s)')
+    parser.add_argument('--repos', type=int, default=100,
+                        help='Repos to spread the backlog over (default: %(default)s)')
+    parser.add_argument('--running', type=int, default=10,
+                        help='Jobs left running while claiming (default: %(default)s)')
+    args = parser.parse_args()
+
+    for backlog in args.backlog:
+        results = []
+
+        with tempfile.TemporaryDirectory() as tmp:
+            results.append(bench_legacy(os.path.join(tmp, 'bench.db'), backlog, args.pops))
+
+        with tempfile.TemporaryDirectory() as tmp:
+            results.append(bench_claim(os.path.join(tmp, 'bench.db'), backlog, args.pops,
+                                       repos=args.repos, running=args.running))
+
+        print('backlog {backlog:>7}: legacy pop {legacy:8.3f}ms | '
+              'claim + finish {claim:6.3f}ms'.format(backlog=backlog,
+                                                    legacy=results[0] * 1000,
+                                                    claim=results[1] * 1000))
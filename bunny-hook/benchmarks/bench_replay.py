@@ -0,0 +1,401 @@
+'''
+bench_replay.py -- replay webhook traffic through the app and a live queue consumer
+'''
+import argparse
+import glob
+import gzip
+import json
+import logging
+import os
+import random
+import shutil
+import sqlite3
+import statistics
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+
+import yaml
+
+import env
+from api import create_app
+from api.queue import Queue
+from api.signatures import sign
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Results to compare against, from a run on a reference machine
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines', 'replay.json')
+
+# Results that get worse as they go up; the others get worse as they go down
+LOWER_IS_BETTER = ('ingest_p50_ms', 'ingest_p99_ms', 'queue_wait_p50_s', 'queue_wait_p99_s',
+                   'deploy_p50_s', 'deploy_p99_s')
+
+# Token that replayed webhooks are signed with
+TOKEN = 'replay-token'
+
+# Stand-in for rsync, for hosts that don't have it. Deploys only use it to
+# copy a checkout over the repo's home directory.
+RSYNC_STUB = '''#!/bin/sh
+for arg; do src=$dest; dest=$arg; done
+mkdir -p "$dest" && cp -a "$src." "$dest"
+'''
+
+
+def synthesize(repos, branches, pushes, rate, seed=0):
+    '''
+    Make up a capture of push webhooks to a few repos and branches, arriving
+    at random at an average of `rate` per second.
+    '''
+    rng = random.Random(seed)
+    offset = 0
+    events = []
+
+    for i in range(pushes):
+        repo = 'replay-repo-%d' % rng.randrange(repos)
+        events.append({
+            'offset': offset,
+            'hook_id': repo,
+            'body': {
+                'ref': 'refs/heads/branch-%d' % rng.randrange(branches),
+                'after': '%040x' % i,
+                'repository': {'name': repo, 'full_name': 'replay/%s' % repo},
+                'pusher': {'name': 'replay'},
+                'commits': [{'id': '%040x' % i, 'message': 'Push %d' % i}],
+            },
+        })
+        offset += rng.expovariate(rate)
+
+    return events
+
+
+def load_capture(path):
+    '''
+    Read a capture of webhooks: one JSON object per line, with the `body` of
+    the webhook, its `offset` in seconds from the start of the capture, and
+    optionally the `hook_id` it came from.
+    '''
+    with open(path) as capture:
+        events = [json.loads(line) for line in capture if line.strip()]
+
+    return sorted(events, key=lambda event: event['offset'])
+
+
+def capture_from_archive(archive_path):
+    '''
+    Make a capture out of the payloads that a server archived (see the
+    `archive_path` setting), timed by when they were written.
+    '''
+    files = sorted(glob.glob(os.path.join(archive_path, '*.json.gz')), key=os.path.getmtime)
+    start = os.path.getmtime(files[0]) if files else 0
+    events = []
+
+    for archive_file in files:
+        with gzip.open(archive_file, 'rb') as f:
+            events.append({'offset': os.path.getmtime(archive_file) - start,
+                           'body': json.loads(f.read().decode('utf-8'))})
+
+    return events
+
+
+def git(*args, cwd=None):
+    identity = dict(os.environ, GIT_AUTHOR_NAME='replay', GIT_AUTHOR_EMAIL='replay@localhost',
+                    GIT_COMMITTER_NAME='replay', GIT_COMMITTER_EMAIL='replay@localhost')
+    subprocess.run(['git'] + list(args), cwd=cwd, env=identity, check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def make_repos(tmp, events, build_time):
+    '''
+    Create a local bare repo for each repo in the capture, with every branch
+    that gets pushed to and stub build and deploy scripts. Returns a dict
+    mapping each repo name to its clone URL.
+    '''
+    branches = {}
+    for event in events:
+        name = event['body']['repository']['name']
+        branch = event['body']['ref'].split('/', 2)[-1]
+        branches.setdefault(name, set()).add(branch)
+
+    urls = {}
+
+    for name, names in branches.items():
+        work = os.path.join(tmp, 'src', name)
+        os.makedirs(os.path.join(work, 'scripts'))
+
+        with open(os.path.join(work, 'deploy.yml'), 'w') as f:
+            yaml.safe_dump({'home': os.path.join(tmp, 'deployed', name),
+                            'build': ['scripts/build.sh'],
+                            'deploy': ['scripts/deploy.sh']}, f)
+
+        for script in ('build', 'deploy'):
+            with open(os.path.join(work, 'scripts', script + '.sh'), 'w') as f:
+                f.write('#!/bin/bash\nsleep %s\n' % build_time)
+
+        git('init', '-q', '-b', 'replay-base', cwd=work)
+        git('add', '.', cwd=work)
+        git('commit', '-q', '-m', 'Stub build', cwd=work)
+
+        for branch in names:
+            git('branch', branch, cwd=work)
+
+        bare = os.path.join(tmp, 'remotes', name + '.git')
+        git('clone', '-q', '--bare', work, bare)
+        urls[name] = 'file://' + bare
+
+    return urls
+
+
+def rewrite(body, urls):
+    '''
+    Point a captured payload at the local copy of its repo. The pushed
+    commit only exists upstream, so deploys build the tip of the branch.
+    '''
+    body = dict(body, clone_url=urls[body['repository']['name']])
+    body['repository'] = dict(body['repository'], clone_url=body['clone_url'])
+    body.pop('after', None)
+    return body
+
+
+def replay(client, events, urls, speed):
+    '''
+    Send the webhooks from a capture, `speed` times as fast as they were
+    recorded. Returns the latency of each request, and the status codes that
+    came back.
+    '''
+    latencies, codes = [], {}
+    start = time.perf_counter()
+
+    for event in events:
+        delay = start + event['offset'] / speed - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+
+        body = json.dumps(rewrite(event['body'], urls)).encode('utf-8')
+        branch = event['body']['ref'].split('/', 2)[-1]
+        headers = {'X-Hub-Signature-256': sign(TOKEN, body), 'X-GitHub-Event': 'push'}
+        if event.get('hook_id'):
+            headers['X-GitHub-Hook-ID'] = str(event['hook_id'])
+
+        sent = time.perf_counter()
+        response = client.post('/hooks/github/%s' % branch, data=body, headers=headers,
+                               content_type='application/json')
+        latencies.append(time.perf_counter() - sent)
+        codes[response.status_code] = codes.get(response.status_code, 0) + 1
+
+    return latencies, codes
+
+
+def start_consumer(tmp, workers, output):
+    '''
+    Start `runqueue.py` on the scratch database, with a config that keeps
+    everything under `tmp`, writing its logs to the file `output`.
+    '''
+    config_file = os.path.join(tmp, 'config.yml')
+    with open(config_file, 'w') as f:
+        yaml.safe_dump({'tmp': os.path.join(tmp, 'work'),
+                        'git_path': os.path.join(tmp, 'git'),
+                        'log_path': os.path.join(tmp, 'logs')}, f)
+
+    path = os.environ.get('PATH', '')
+    if not shutil.which('rsync'):
+        stub = os.path.join(tmp, 'bin', 'rsync')
+        os.makedirs(os.path.dirname(stub))
+        with open(stub, 'w') as f:
+            f.write(RSYNC_STUB)
+        os.chmod(stub, os.stat(stub).st_mode | stat.S_IEXEC)
+        path = os.path.dirname(stub) + os.pathsep + path
+
+    # The consumer finds `hook.db` in its working directory
+    return subprocess.Popen([sys.executable, os.path.join(ROOT, 'runqueue.py'),
+                             '--config', config_file, '--workers', str(workers)],
+                            cwd=tmp, env=dict(os.environ, PATH=path),
+                            stdout=output, stderr=subprocess.STDOUT)
+
+
+def wait_for_drain(db_conn, timeout):
+    '''
+    Wait until every job has left the queue. Returns the time that the last
+    one finished.
+    '''
+    conn = sqlite3.connect(db_conn)
+    deadline = time.time() + timeout
+
+    try:
+        while conn.execute('SELECT COUNT(*) FROM queue').fetchone()[0]:
+            if time.time() > deadline:
+                raise RuntimeError('Jobs were still queued after %d seconds' % timeout)
+            time.sleep(0.1)
+
+        return conn.execute('SELECT MAX(date_finished) FROM jobs').fetchone()[0]
+    finally:
+        conn.close()
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def collect(db_conn):
+    '''
+    Read the stage timings and outcomes of the replayed jobs from the queue
+    database.
+    '''
+    conn = sqlite3.connect(db_conn)
+
+    try:
+        timings = {}
+        for stage, duration in conn.execute('SELECT stage, duration FROM timings'):
+            timings.setdefault(stage, []).append(duration)
+
+        statuses = dict(conn.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status'))
+    finally:
+        conn.close()
+
+    return timings, statuses
+
+
+def bench(events, workers, speed, build_time, timeout):
+    with tempfile.TemporaryDirectory() as tmp:
+        urls = make_repos(tmp, events, build_time)
+
+        # Point the app and the consumer at a scratch database
+        Queue.db_conn = os.path.join(tmp, 'hook.db')
+        client = create_app({'TOKENS': [TOKEN]}).test_client()
+
+        with open(os.path.join(tmp, 'runqueue.log'), 'w') as output:
+            consumer = start_consumer(tmp, workers, output)
+
+            try:
+                start = time.time()
+                latencies, codes = replay(client, events, urls, speed)
+                finished = wait_for_drain(Queue.db_conn, timeout)
+            finally:
+                consumer.terminate()
+                consumer.wait()
+
+        timings, statuses = collect(Queue.db_conn)
+
+    jobs = sum(statuses.values())
+
+    results = {
+        'ingest_p50_ms': statistics.median(latencies) * 1000,
+        'ingest_p99_ms': percentile(latencies, 0.99) * 1000,
+        'queue_wait_p50_s': percentile(timings.get('queue_wait', []), 0.5),
+        'queue_wait_p99_s': percentile(timings.get('queue_wait', []), 0.99),
+        'deploy_p50_s': percentile(timings.get('job', []), 0.5),
+        'deploy_p99_s': percentile(timings.get('job', []), 0.99),
+        'jobs_per_s': jobs / max((finished or start) - start, 1e-6),
+    }
+
+    return results, codes, statuses
+
+
+def compare(results, baseline, tolerance):
+    '''
+    Print each result next to the baseline, and return the names of the
+    results that got worse by more than `tolerance` (a fraction).
+    '''
+    regressions = []
+
+    for name, value in results.items():
+        before = baseline.get(name)
+        if not before:
+            print('{name:>18}: {value:10.3f}'.format(name=name, value=value))
+            continue
+
+        change = (value - before) / before
+        worse = change > tolerance if name in LOWER_IS_BETTER else change < -tolerance
+        if worse:
+            regressions.append(name)
+
+        print('{name:>18}: {value:10.3f} (baseline {before:.3f}, {change:+.0%}){flag}'.format(
+            name=name, value=value, before=before, change=change,
+            flag='  <-- regression' if worse else ''))
+
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--capture',
+                        help=('Webhooks to replay, one JSON object per line with the '
+                              '`offset` (seconds) and `body` of each. Without it, a '
+                              'capture is made up from the options below'))
+    parser.add_argument('--archive',
+                        help='Replay the payloads in a server\'s `archive_path` instead')
+    parser.add_argument('--repos', type=int, default=4,
+                        help='Repos in a made-up capture (default: %(default)s)')
+    parser.add_argument('--branches', type=int, default=3,
+                        help='Branches per repo in a made-up capture (default: %(default)s)')
+    parser.add_argument('--pushes', type=int, default=60,
+                        help='Webhooks in a made-up capture (default: %(default)s)')
+    parser.add_argument('--rate', type=float, default=20,
+                        help='Webhooks per second in a made-up capture (default: %(default)s)')
+    parser.add_argument('--speed', type=float, default=1,
+                        help=('How many times faster than recorded to replay '
+                              '(default: %(default)s)'))
+    parser.add_argument('--workers', type=int, default=4,
+                        help='Jobs that the consumer runs at once (default: %(default)s)')
+    parser.add_argument('--build-time', type=float, default=0.2,
+                        help='Seconds that each stub script takes (default: %(default)s)')
+    parser.add_argument('--timeout', type=float, default=300,
+                        help='Seconds to wait for the queue to drain (default: %(default)s)')
+    parser.add_argument('--baseline', default=BASELINE,
+                        help='Results to compare against (default: %(default)s)')
+    parser.add_argument('--tolerance', type=float, default=0.5,
+                        help=('Fraction that a result can get worse by before it counts as '
+                              'a regression (default: %(default)s)'))
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='Store the results as the new baseline')
+    args = parser.parse_args()
+
+    if args.capture:
+        events = load_capture(args.capture)
+    elif args.archive:
+        events = capture_from_archive(args.archive)
+    else:
+        events = synthesize(args.repos, args.branches, args.pushes, args.rate)
+
+    # Keep request logs out of the results; they're written off the request
+    # thread anyway
+    logging.getLogger('api.requests').setLevel(logging.WARNING)
+
+    results, codes, statuses = bench(events, args.workers, args.speed, args.build_time,
+                                     args.timeout)
+
+    print('Replayed {n} webhooks ({codes}); jobs {statuses}'.format(
+        n=len(events), codes=', '.join('%d: %d' % item for item in sorted(codes.items())),
+        statuses=', '.join('%s: %d' % item for item in sorted(statuses.items()))))
+
+    params = {'capture': args.capture or args.archive, 'repos': args.repos,
+              'branches': args.branches, 'pushes': args.pushes, 'rate': args.rate,
+              'speed': args.speed, 'workers': args.workers, 'build_time': args.build_time}
+
+    baseline = {}
+    if os.path.isfile(args.baseline):
+        with open(args.baseline) as f:
+            stored = json.load(f)
+
+        if stored['params'] == params:
+            baseline = stored['results']
+        else:
+            print('Not comparing with %s, which was run with other options' % args.baseline)
+
+    regressions = compare(results, baseline, args.tolerance)
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, 'w') as f:
+            json.dump({'params': params, 'results': results}, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+    elif regressions:
+        sys.exit('Regressed: %s' % ', '.join(regressions))
@@ -0,0 +1,78 @@
+'''
+bench_startup.py -- measure how long the web and queue processes take to import
+'''
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+import env
+
+
+# Code that each kind of process runs before it can do any work
+ENTRY_POINTS = {
+    'web': "from api import create_app; create_app({'TOKENS': []})",
+    'queue': 'import runqueue; from api.queue import Queue',
+    'pool': 'import runqueue; from api.queue import Queue; from api.pool import WorkerPool',
+}
+
+# Modules that only some processes should need
+HEAVY = ('flask', 'werkzeug', 'yaml', 'api.worker', 'api.routes', 'multiprocessing')
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def import_times(code):
+    '''
+    Run code in a fresh interpreter with `-X importtime`, and return the
+    cumulative import time (in microseconds) of each top-level import.
+    '''
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=ROOT,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True,
+                            universal_newlines=True)
+    times = {}
+
+    # Lines look like `import time:  self [us] | cumulative | imported package`,
+    # with nested imports indented under the package that imported them
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+
+        _, cumulative, name = line[len('import time:'):].split('|')
+        times[name[1:].rstrip()] = int(cumulative)
+
+    return times
+
+
+def bench(code, runs):
+    totals = []
+
+    for _ in range(runs):
+        times = import_times(code)
+        totals.append(sum(us for name, us in times.items() if not name.startswith(' ')))
+
+    return statistics.median(totals), times
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--runs', type=int, default=10,
+                        help='Interpreters to start for each entry point (default: %(default)s)')
+    parser.add_argument('--top', type=int, default=5,
+                        help='Slowest top-level imports to list (default: %(default)s)')
+    args = parser.parse_args()
+
+    for name, code in ENTRY_POINTS.items():
+        total, times = bench(code, args.runs)
+        imported = set(module.strip() for module in times)
+        loaded = [module for module in HEAVY if module in imported]
+
+        print('{name:>6}: {total:6.1f}ms to import {count} modules | loads {loaded}'.format(
+            name=name, total=total / 1000, count=len(imported),
+            loaded=', '.join(loaded) or 'none of ' + ', '.join(HEAVY)))
+
+        slowest = sorted(((us, module.strip()) for module, us in times.items()
+                          if not module.startswith(' ')), reverse=True)
+        for us, module in slowest[:args.top]:
+            print('        {ms:6.1f}ms {module}'.format(ms=us / 1000, module=module))
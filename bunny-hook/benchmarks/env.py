@@ -0,0 +1,11 @@
+import sys
+import os
+
+# Append module root directory to sys.path
+sys.path.append(
+    os.path.dirname(
+        os.path.dirname(
+            os.path.abspath(__file__)
+        )
+    )
+)
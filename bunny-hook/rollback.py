@@ -0,0 +1,19 @@
+import argparse
+
+from api.releases import Releases
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Roll back a repo deployed with `releases: true`.')
+    parser.add_argument('home', help='Home directory of the repo, from its deploy.yml')
+    parser.add_argument('release', nargs='?',
+                        help='Release to activate (default: the one before the live release)')
+    args = parser.parse_args()
+
+    releases = Releases(args.home)
+
+    if args.release:
+        releases.activate(args.release)
+        print('Activated release %s' % args.release)
+    else:
+        print('Rolled back to release %s' % releases.rollback())
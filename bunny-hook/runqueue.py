@@ -1,9 +1,50 @@
+import sys
+import argparse
+import logging
+
 from api.queue import Queue
+from api.settings import load_settings, CONFIG_FILE
 
 
 if __name__ == '__main__':
-    queue = Queue()
+    parser = argparse.ArgumentParser(description='Run the build queue.')
+    parser.add_argument('--config', default=CONFIG_FILE,
+                        help='Path to the server config file (default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help=('Number of jobs to run at once. Jobs for the same '
+                              'branch always run one at a time (default: %(default)s)'))
+    parser.add_argument('--max-wait', type=float, default=Queue.max_wait,
+                        help=('Longest time (in seconds) to wait between checks '
+                              'of an idle queue (default: %(default)s)'))
+    parser.add_argument('--cancel-superseded', action='store_true',
+                        help=('Stop a running deploy early when a newer push '
+                              'arrives for the same repo and branch'))
+    parser.add_argument('--queue-url',
+                        help=('Consume the queue of an API server on another host, '
+                              'at this URL (e.g. http://hooks.example.com/queue), '
+                              'instead of the local database. Defaults to the '
+                              '`queue_url` setting'))
+    args = parser.parse_args()
+
+    # Log to stdout
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+    settings = load_settings(args.config)
+    queue_url = args.queue_url or settings.get('queue_url')
+
+    # Only import what this consumer uses
+    if queue_url:
+        from api.remote import RemoteQueue
+        queue = RemoteQueue(queue_url, settings.get('queue_token'), settings=settings)
+    else:
+        queue = Queue(settings=settings)
+
+    queue.max_wait = args.max_wait
+    queue.cancel_superseded = args.cancel_superseded
 
-    # Run the queue in an endless loop
-    while True:
-        queue.run()
+    # Run the queue in an endless loop, sleeping while there's no work
+    if args.workers > 1:
+        from api.pool import WorkerPool
+        WorkerPool(queue, args.workers).run_forever()
+    else:
+        queue.run_forever()
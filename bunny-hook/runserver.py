@@ -1,5 +1,9 @@
-from api import app
+import sys
+import logging
+
+from api import create_app
 
 
 if __name__ == '__main__':
-    app.run(debug=True)
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+    create_app().run(debug=True)
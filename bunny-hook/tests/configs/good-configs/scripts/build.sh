@@ -0,0 +1,3 @@
+#!/bin/bash
+
+echo "Test build script runs successfully!" > /dev/null
@@ -0,0 +1,3 @@
+#!/bin/bash
+
+echo "Test deploy script runs successfully!" > /dev/null
@@ -1,13 +1,18 @@
 from unittest import TestCase
-from contextlib import contextmanager
+from unittest.mock import patch
+import os
 import json
+import shutil
+import tempfile
 
-from flask import appcontext_pushed, g
 from werkzeug.datastructures import Headers
 
 import env
-import api
-from api.routes import get_hmac
+from api import create_app
+from api.queue import Queue
+from api.ratelimit import RateLimiter
+from api.settings import DEFAULTS
+from api.signatures import sign
 from test_secrets import TOKENS
 
 
@@ -18,24 +23,30 @@ class TestAPI(TestCase):
         '''
         Set up some class-wide attributes for testing.
         '''
-        api.app.testing = True
-        cls.app = api.app.test_client()
         cls.tokens = TOKENS
+        cls.app = create_app({'TESTING': True, 'TOKENS': cls.tokens}).test_client()
 
-        # Good and bad authentication credentials
-        cls.good_sig = get_hmac(cls.tokens[0])
-        cls.bad_sig = get_hmac('bogus token')
+        # Point the app at a scratch database, instead of the default one in
+        # the working directory
+        cls.tmp = tempfile.mkdtemp()
+        cls.db_patcher = patch.object(Queue, 'db_conn', os.path.join(cls.tmp, 'test.db'))
+        cls.db_patcher.start()
 
-    @contextmanager
-    def authenticate(self):
+    @classmethod
+    def tearDownClass(cls):
+        cls.db_patcher.stop()
+        shutil.rmtree(cls.tmp)
+
+    def post(self, url, post_data, token=None, header='X-Hub-Signature-256',
+             digestmod='sha256', extra_headers=None):
         '''
-        Inject fake security tokens into the app context for testing.
+        POST JSON to the app, signed with a token in the way that GitHub would.
         '''
-        def handler(sender, **kwargs):
-            g.tokens = self.tokens
+        headers = Headers(extra_headers or {})
+        headers.add(header, sign(token or self.tokens[0], post_data.encode('utf-8'), digestmod))
 
-        with appcontext_pushed.connected_to(handler, api.app):
-            yield
+        return self.app.post(url, content_type='application/json', data=post_data,
+                             headers=headers)
 
     def test_successful_request(self):
         '''
@@ -48,20 +59,14 @@ class TestAPI(TestCase):
                 }
             })
 
-        headers = Headers()
-        headers.add('X-Hub-Signature', self.good_sig)
-
-        with self.authenticate():
-            post_request = self.app.post('/hooks/github/master',
-                                         content_type='application/json',
-                                         data=post_data,
-                                         headers=headers)
+        post_request = self.post('/hooks/github/master', post_data)
 
         self.assertEqual(post_request.status_code, 202)
 
         response = json.loads(post_request.data.decode('utf-8'))
         expected = 'Build started for ref refs/head/master of repo test-repo'
         self.assertEqual(response.get('status'), expected)
+        self.assertIsInstance(response.get('id'), int)
 
     def test_authentication_failed(self):
         '''
@@ -74,14 +79,7 @@ class TestAPI(TestCase):
                 }
             })
 
-        headers = Headers()
-        headers.add('X-Hub-Signature', self.bad_sig)
-
-        with self.authenticate():
-            post_request = self.app.post('/hooks/github/master',
-                                         content_type='application/json',
-                                         data=post_data,
-                                         headers=headers)
+        post_request = self.post('/hooks/github/master', post_data, token='bogus token')
 
         self.assertEqual(post_request.status_code, 401)
 
@@ -96,14 +94,7 @@ class TestAPI(TestCase):
         '''
         post_data = json.dumps({'ref': 'refs/heads/master'})
 
-        headers = Headers()
-        headers.add('X-Hub-Signature', self.good_sig)
-
-        with self.authenticate():
-            post_request = self.app.post('/hooks/github/deploy',
-                                         content_type='application/json',
-                                         data=post_data,
-                                         headers=headers)
+        post_request = self.post('/hooks/github/deploy', post_data)
 
         self.assertEqual(post_request.status_code, 400)
 
@@ -117,17 +108,232 @@ class TestAPI(TestCase):
         '''
         post_data = json.dumps({'test': 'test'})
 
-        headers = Headers()
-        headers.add('X-Hub-Signature', self.good_sig)
-
-        with self.authenticate():
-            post_request = self.app.post('/hooks/github/deploy',
-                                         content_type='application/json',
-                                         data=post_data,
-                                         headers=headers)
+        post_request = self.post('/hooks/github/deploy', post_data)
 
         self.assertEqual(post_request.status_code, 400)
 
         response = json.loads(post_request.data.decode('utf-8'))
         expected = "Malformed request payload: {'test': 'test'}"
         self.assertEqual(response.get('status'), expected)
+
+    def test_sha1_signature(self):
+        '''
+        Test a request signed with the older SHA-1 signature header.
+        '''
+        post_data = json.dumps({
+                'ref': 'refs/head/master',
+                'repository': {
+                    'name': 'test-repo'
+                }
+            })
+
+        post_request = self.post('/hooks/github/master', post_data,
+                                 header='X-Hub-Signature', digestmod='sha1')
+        self.assertEqual(post_request.status_code, 202)
+
+    def test_signature_covers_body(self):
+        '''
+        Test that a signature for one body doesn't authenticate another.
+        '''
+        headers = Headers()
+        headers.add('X-Hub-Signature-256', sign(self.tokens[0], b'{}'))
+
+        post_request = self.app.post('/hooks/github/master',
+                                     content_type='application/json',
+                                     data=json.dumps({'ref': 'refs/head/master'}),
+                                     headers=headers)
+
+        self.assertEqual(post_request.status_code, 401)
+
+    def test_no_signature(self):
+        '''
+        Test a request without a signature header.
+        '''
+        post_request = self.app.post('/hooks/github/master',
+                                     content_type='application/json',
+                                     data=json.dumps({'ref': 'refs/head/master'}))
+
+        self.assertEqual(post_request.status_code, 400)
+
+        response = json.loads(post_request.data.decode('utf-8'))
+        self.assertEqual(response.get('status'), 'Authentication signature not found')
+
+    def test_metrics(self):
+        '''
+        Test that monitoring data is exposed in the Prometheus format.
+        '''
+        response = self.app.get('/metrics')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.content_type.startswith('text/plain'))
+        self.assertIn('bunny_hook_queue_depth{status="pending"}', response.data.decode('utf-8'))
+
+    def test_rate_limit(self):
+        '''
+        Test that a source that sends too many webhooks is told to slow down.
+        '''
+        post_data = json.dumps({'ref': 'refs/heads/master'})
+        limiter = RateLimiter(0.1, burst=1)
+
+        with patch('api.routes.get_rate_limiter', return_value=limiter):
+            first = self.post('/hooks/github/deploy', post_data)
+            second = self.post('/hooks/github/deploy', post_data)
+
+        self.assertEqual(first.status_code, 400)
+        self.assertEqual(second.status_code, 429)
+        self.assertEqual(second.headers['Retry-After'], '10')
+
+    def test_queue_full(self):
+        '''
+        Test that webhooks are turned away while the queue is full.
+        '''
+        post_data = json.dumps({
+                'ref': 'refs/heads/master',
+                'repository': {
+                    'name': 'full-repo'
+                }
+            })
+
+        with patch.object(Queue, 'check_depth', return_value='Queue is full'):
+            post_request = self.post('/hooks/github/master', post_data)
+
+        self.assertEqual(post_request.status_code, 503)
+        self.assertEqual(post_request.headers['Retry-After'], str(Queue.retry_after))
+
+        response = json.loads(post_request.data.decode('utf-8'))
+        self.assertEqual(response.get('status'), 'Queue is full')
+
+    def test_priority_header(self):
+        '''
+        Test that senders can set the priority of a job with a header.
+        '''
+        post_data = json.dumps({
+                'ref': 'refs/heads/master',
+                'repository': {
+                    'name': 'urgent-repo'
+                }
+            })
+
+        with patch.object(Queue, 'add', return_value=1) as add:
+            post_request = self.post('/hooks/github/master', post_data,
+                                     extra_headers={'X-Hook-Priority': '50'})
+            self.assertEqual(post_request.status_code, 202)
+            self.assertEqual(add.call_args[1]['priority'], 50)
+
+            for priority in ('high', '101'):
+                post_request = self.post('/hooks/github/master', post_data,
+                                         extra_headers={'X-Hook-Priority': priority})
+                self.assertEqual(post_request.status_code, 400)
+
+            self.assertEqual(add.call_count, 1)
+
+
+class TestJobs(TestCase):
+    '''
+    Test looking up jobs and following their logs.
+    '''
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+
+        # Point the app at a scratch database
+        db_patcher = patch.object(Queue, 'db_conn', os.path.join(self.tmp, 'test.db'))
+        db_patcher.start()
+        self.addCleanup(db_patcher.stop)
+
+        settings = dict(DEFAULTS, log_path=os.path.join(self.tmp, 'logs'))
+        settings_patcher = patch('api.queue.load_settings', return_value=settings)
+        settings_patcher.start()
+        self.addCleanup(settings_patcher.stop)
+
+        self.app = create_app({'TESTING': True, 'TOKENS': [], 'QUEUE_TOKEN': 'queue-secret',
+                               'JOBS_TOKEN': 'jobs-secret'}).test_client()
+        self.headers = {'Authorization': 'Bearer jobs-secret'}
+
+        self.queue = Queue(settings=settings)
+        self.addCleanup(self.queue.close)
+
+    def add(self, repo, status='succeeded'):
+        work_id = self.queue.add({'ref': 'refs/heads/master', 'after': 'abc%s' % repo,
+                                  'repository': {'name': repo}})
+        if status:
+            self.queue.claim()
+            self.queue.finish(work_id, status, [{'stage': 'build', 'duration': 1.0}])
+
+        return work_id
+
+    def get(self, url, **kwargs):
+        return self.app.get(url, headers=dict(self.headers, **kwargs))
+
+    def test_get_job(self):
+        work_id = self.add('repo-a', 'failed')
+
+        response = self.get('/jobs/%d' % work_id)
+        self.assertEqual(response.status_code, 200)
+
+        job = json.loads(response.data.decode('utf-8'))
+        self.assertEqual(job['status'], 'failed')
+        self.assertEqual(job['repo'], 'repo-a')
+        self.assertEqual(job['sha'], 'abcrepo-a')
+        self.assertEqual([timing['stage'] for timing in job['timings']], ['queue_wait', 'build'])
+
+        self.assertEqual(self.get('/jobs/%d' % (work_id + 1)).status_code, 404)
+
+    def test_jobs_need_token(self):
+        work_id = self.add('repo-a')
+        self.assertEqual(self.app.get('/jobs/%d' % work_id).status_code, 401)
+
+    def test_jobs_token_is_read_only(self):
+        work_id = self.add('repo-a')
+
+        # The builders' token doesn't give access to jobs, and the jobs token
+        # doesn't give access to the queue
+        queue_headers = {'Authorization': 'Bearer queue-secret'}
+        self.assertEqual(self.app.get('/jobs/%d' % work_id, headers=queue_headers).status_code,
+                         401)
+        self.assertEqual(self.app.post('/queue/claim', headers=self.headers).status_code, 401)
+
+    def test_jobs_need_jobs_token_setting(self):
+        app = create_app({'TESTING': True, 'TOKENS': [],
+                          'QUEUE_TOKEN': 'queue-secret'}).test_client()
+        work_id = self.add('repo-a')
+
+        self.assertEqual(app.get('/jobs/%d' % work_id, headers=self.headers).status_code, 404)
+
+    def test_list_jobs_by_page(self):
+        ids = [self.add('repo-a'), self.add('repo-b'), self.add('repo-a'),
+               self.add('repo-a', status=None)]
+
+        response = self.get('/jobs?repo=repo-a&limit=2')
+        page = json.loads(response.data.decode('utf-8'))
+
+        # Jobs still in the queue are listed along with finished ones
+        self.assertEqual([job['id'] for job in page['jobs']], [ids[3], ids[2]])
+        self.assertEqual(page['jobs'][0]['status'], 'pending')
+
+        response = self.get('/jobs?repo=repo-a&limit=2&before=%d' % page['next'])
+        page = json.loads(response.data.decode('utf-8'))
+        self.assertEqual([job['id'] for job in page['jobs']], [ids[0]])
+        self.assertIsNone(page['next'])
+
+        self.assertEqual(self.get('/jobs?before=abc').status_code, 400)
+
+    def test_tail_log(self):
+        work_id = self.add('repo-a')
+
+        log_file = self.queue.get_log_file(work_id)
+        os.makedirs(os.path.dirname(log_file))
+        with open(log_file, 'w') as f:
+            f.write('$ bash build.sh\nbuilt\n')
+
+        job = json.loads(self.get('/jobs/%d' % work_id).data.decode('utf-8'))
+        response = self.get(job['log'])
+        self.assertEqual(response.content_type, 'text/event-stream; charset=utf-8')
+        self.assertEqual(response.data.decode('utf-8'),
+                         'id: 16\ndata: $ bash build.sh\n\n'
+                         'id: 22\ndata: built\n\n'
+                         'event: end\ndata: {"status": "succeeded"}\n\n')
+
+        # Reconnecting picks up after the last event
+        response = self.get(job['log'], **{'Last-Event-ID': '16'})
+        self.assertTrue(response.data.decode('utf-8').startswith('id: 22\ndata: built\n\n'))
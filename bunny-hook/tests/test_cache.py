@@ -0,0 +1,136 @@
+import os
+import shutil
+import tempfile
+import threading
+from unittest import TestCase
+
+import env
+from api.cache import ContentCache, input_key, dependency_key
+from api.graph import Step
+from api.parse_configs import Dependency
+
+
+class TestCache(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.cache = ContentCache(os.path.join(self.tmp, 'cache'))
+        self.manifest = {
+            'build.sh': ['100755', 'a' * 40],
+            'src/app.js': ['100644', 'b' * 40],
+            'src/lib/util.js': ['100644', 'c' * 40],
+            'README.md': ['100644', 'd' * 40],
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, path, contents):
+        path = os.path.join(self.tmp, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(contents)
+
+    def test_input_key(self):
+        step = Step('build.sh', [], paths=['src/*'])
+        key = input_key(step, self.manifest)
+
+        # Files that don't match the paths don't count
+        readme = dict(self.manifest, **{'README.md': ['100644', 'e' * 40]})
+        self.assertEqual(input_key(step, readme), key)
+
+        # Files in subdirectories do, and so does the script itself
+        util = dict(self.manifest, **{'src/lib/util.js': ['100644', 'e' * 40]})
+        self.assertNotEqual(input_key(step, util), key)
+
+        script = dict(self.manifest, **{'build.sh': ['100755', 'e' * 40]})
+        self.assertNotEqual(input_key(step, script), key)
+
+        # So do the scripts that it needs
+        self.assertNotEqual(input_key(step, self.manifest, ['other']), key)
+
+    def test_input_key_needs_paths(self):
+        self.assertIsNone(input_key(Step('build.sh', []), self.manifest))
+        self.assertIsNone(input_key(Step('build.sh', [], paths=[]), self.manifest, [None]))
+
+    def test_dependency_key(self):
+        venv = Dependency('venv', ['requirements*.txt'])
+        manifest = dict(self.manifest, **{'requirements.txt': ['100644', 'f' * 40]})
+        key = dependency_key(venv, manifest)
+
+        # Only the lockfiles count
+        app = dict(manifest, **{'src/app.js': ['100644', 'e' * 40]})
+        self.assertEqual(dependency_key(venv, app), key)
+
+        dev = dict(manifest, **{'requirements-dev.txt': ['100644', 'e' * 40]})
+        self.assertNotEqual(dependency_key(venv, dev), key)
+
+        # The same lockfiles install different directories
+        self.assertNotEqual(dependency_key(Dependency('env', ['requirements*.txt']), manifest),
+                            key)
+
+    def test_put_and_restore_symlinks(self):
+        self.write('build/venv/lib/python/site.py', 'site')
+        os.symlink('lib', os.path.join(self.tmp, 'build/venv/lib64'))
+        os.symlink('/usr/bin/python3', os.path.join(self.tmp, 'build/venv/python'))
+
+        entry = self.cache.put('key', os.path.join(self.tmp, 'build'), ['venv'])
+        self.assertEqual(entry['venv/lib64'], ['link', 'lib'])
+        self.assertEqual(entry['venv/python'], ['link', '/usr/bin/python3'])
+
+        dest = os.path.join(self.tmp, 'release')
+        self.assertTrue(self.cache.restore(entry, dest))
+
+        self.assertEqual(os.readlink(os.path.join(dest, 'venv/lib64')), 'lib')
+        with open(os.path.join(dest, 'venv/lib64/python/site.py')) as f:
+            self.assertEqual(f.read(), 'site')
+
+    def test_put_and_restore(self):
+        self.write('build/dist/app.min.js', 'minified')
+        self.write('build/version.txt', 'v1')
+        os.chmod(os.path.join(self.tmp, 'build/version.txt'), 0o600)
+
+        entry = self.cache.put('key', os.path.join(self.tmp, 'build'), ['dist', '*.txt'])
+        self.assertEqual(sorted(entry), ['dist/app.min.js', 'version.txt'])
+        self.assertEqual(self.cache.get('key'), entry)
+        self.assertIsNone(self.cache.get('other'))
+
+        dest = os.path.join(self.tmp, 'release')
+        self.assertTrue(self.cache.restore(entry, dest))
+
+        with open(os.path.join(dest, 'dist', 'app.min.js')) as f:
+            self.assertEqual(f.read(), 'minified')
+        self.assertEqual(os.stat(os.path.join(dest, 'version.txt')).st_mode & 0o777, 0o600)
+
+    def test_put_from_parallel_scripts(self):
+        # Scripts running side by side in one worker store the same outputs
+        self.write('build/bundle.js', 'x' * (4 * 1024 * 1024))
+        source = os.path.join(self.tmp, 'build')
+        start = threading.Barrier(8)
+        errors = []
+
+        def put():
+            start.wait()
+            try:
+                self.cache.put('key', source, ['bundle.js'])
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=put) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+
+        dest = os.path.join(self.tmp, 'release')
+        self.assertTrue(self.cache.restore(self.cache.get('key'), dest))
+        self.assertEqual(os.path.getsize(os.path.join(dest, 'bundle.js')), 4 * 1024 * 1024)
+
+    def test_restore_missing_object(self):
+        self.write('build/out.txt', 'output')
+        entry = self.cache.put('key', os.path.join(self.tmp, 'build'), ['out.txt'])
+
+        shutil.rmtree(self.cache.objects_path)
+        self.assertFalse(self.cache.restore(entry, os.path.join(self.tmp, 'release')))
@@ -0,0 +1,87 @@
+import threading
+from unittest import TestCase
+
+import env
+from api.graph import parse_steps, run_steps
+from api.exceptions import WorkerException
+
+
+class TestGraph(TestCase):
+
+    def test_plain_list_runs_in_order(self):
+        steps = parse_steps(['a.sh', 'b.sh', 'c.sh'])
+
+        self.assertEqual([step.script for step in steps], ['a.sh', 'b.sh', 'c.sh'])
+        self.assertEqual([step.needs for step in steps], [set(), {'a.sh'}, {'b.sh'}])
+
+    def test_parallel_group(self):
+        steps = parse_steps(['deps.sh', {'parallel': ['assets.sh', 'docs.sh']}, 'package.sh'])
+        needs = {step.script: step.needs for step in steps}
+
+        self.assertEqual(needs['assets.sh'], {'deps.sh'})
+        self.assertEqual(needs['docs.sh'], {'deps.sh'})
+        self.assertEqual(needs['package.sh'], {'assets.sh', 'docs.sh'})
+
+    def test_explicit_needs(self):
+        steps = parse_steps(['a.sh', 'b.sh', {'script': 'c.sh', 'needs': 'a.sh'},
+                             {'script': 'd.sh', 'needs': []}])
+        needs = {step.script: step.needs for step in steps}
+
+        self.assertEqual(needs['c.sh'], {'a.sh'})
+        self.assertEqual(needs['d.sh'], set())
+
+    def test_paths_and_outputs(self):
+        steps = parse_steps(['a.sh', {'script': 'b.sh', 'paths': 'src/*',
+                                      'outputs': ['dist/', 'build.txt']}])
+
+        self.assertIsNone(steps[0].paths)
+        self.assertEqual(steps[1].paths, ['src/*'])
+        self.assertEqual(steps[1].outputs, ['dist/', 'build.txt'])
+
+        with self.assertRaises(WorkerException):
+            parse_steps([{'script': 'a.sh', 'paths': {'src': True}}])
+
+    def test_bad_graphs(self):
+        bad_entries = [
+            [{'script': 'a.sh', 'needs': ['missing.sh']}],
+            ['a.sh', 'a.sh'],
+            [{'script': 'a.sh', 'needs': ['b.sh']}, {'script': 'b.sh', 'needs': ['a.sh']}],
+            [{'unknown': 'a.sh'}],
+        ]
+
+        for entries in bad_entries:
+            with self.assertRaises(WorkerException):
+                parse_steps(entries)
+
+    def test_run_steps_in_parallel(self):
+        steps = parse_steps([{'parallel': ['a.sh', 'b.sh', 'c.sh']}, 'd.sh'])
+        barrier = threading.Barrier(3, timeout=5)
+        order = []
+
+        def run(step):
+            if step.script != 'd.sh':
+                # Only passes if all three scripts are running at once
+                barrier.wait()
+            order.append(step.script)
+
+        run_steps(steps, run, max_workers=3)
+        self.assertEqual(order[-1], 'd.sh')
+        self.assertEqual(len(order), 4)
+
+    def test_run_steps_fails_fast(self):
+        steps = parse_steps(['fail.sh', 'never.sh', {'script': 'slow.sh', 'needs': []}])
+        ran = []
+        aborted = threading.Event()
+
+        def run(step):
+            ran.append(step.script)
+            if step.script == 'fail.sh':
+                raise WorkerException('Build failed')
+            if step.script == 'slow.sh':
+                aborted.wait(5)
+
+        with self.assertRaises(WorkerException):
+            run_steps(steps, run, max_workers=2, abort=aborted.set)
+
+        self.assertTrue(aborted.is_set())
+        self.assertNotIn('never.sh', ran)
@@ -0,0 +1,135 @@
+import os
+import json
+import logging
+import tempfile
+from unittest import TestCase
+
+import env
+from api import create_app
+from api.logs import RequestLogger, RequestRecord, tail
+
+
+class ListHandler(logging.Handler):
+    '''
+    Collect formatted log messages.
+    '''
+    def __init__(self):
+        super().__init__()
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(self.format(record))
+
+
+class TestLogs(TestCase):
+
+    def setUp(self):
+        self.app = create_app({'TOKENS': []})
+        self.handler = ListHandler()
+        self.logger = RequestLogger('test.requests.%s' % self.id(),
+                                    handlers=[self.handler])
+
+    def tearDown(self):
+        self.logger.stop()
+
+    def log(self, status_code, payload=None):
+        with self.app.test_request_context('/hooks/github/master', method='POST',
+                                           headers={'X-GitHub-Event': 'push',
+                                                    'Authorization': 'secret'}):
+            from flask import request
+            self.logger.log(request, {'status': 'ok'}, status_code, payload)
+
+        # Stopping the listener flushes any records it has waiting
+        self.logger.stop()
+        return [json.loads(message) for message in self.handler.messages]
+
+    def test_log_request(self):
+        records = self.log(202, {'ref': 'refs/heads/master'})
+
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0]['status_code'], 202)
+        self.assertEqual(records[0]['path'], '/hooks/github/master')
+        self.assertEqual(records[0]['headers'], {'X-GitHub-Event': 'push'})
+
+        # Payloads are only logged at the DEBUG level
+        self.assertNotIn('payload', records[0])
+
+    def test_truncate_payload(self):
+        self.logger.logger.setLevel(logging.DEBUG)
+        self.logger.max_payload_chars = 20
+
+        payload = {'commits': ['a' * 100]}
+        records = self.log(202, payload)
+        more = len(json.dumps(payload)) - 20
+
+        self.assertTrue(records[0]['payload'].startswith('{"commits": ["aaaaaa'))
+        self.assertTrue(records[0]['payload'].endswith('(%d more characters)' % more))
+
+    def test_sample_errors(self):
+        self.logger.sample_rate = 0
+        self.assertEqual(self.log(401), [])
+
+        self.logger.sample_rate = 1
+        records = self.log(401)
+        self.assertEqual(records[0]['status_code'], 401)
+        self.assertEqual(records[0]['sample_rate'], 1)
+
+    def test_format_lazily(self):
+        formatted = []
+
+        class Record(RequestRecord):
+            def __str__(self):
+                formatted.append(True)
+                return super().__str__()
+
+        self.logger.start()
+        self.logger.logger.setLevel(logging.WARNING)
+        self.logger.logger.info('%s', Record({}))
+        self.logger.stop()
+
+        self.assertEqual(formatted, [])
+        self.assertEqual(self.handler.messages, [])
+
+
+class TestTail(TestCase):
+
+    def setUp(self):
+        fd, self.log_file = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.log_file)
+
+    def test_tail_from_offset(self):
+        with open(self.log_file, 'w') as f:
+            f.write('one\ntwo\nthree')
+
+        lines = list(tail(self.log_file))
+        self.assertEqual(lines, [(4, 'one'), (8, 'two'), (13, 'three')])
+
+        # Clients resume from the last offset they saw
+        self.assertEqual(list(tail(self.log_file, offset=4)), [(8, 'two'), (13, 'three')])
+
+    def test_tail_follows_until_finished(self):
+        with open(self.log_file, 'w') as f:
+            f.write('one\ntw')
+
+        checks = []
+
+        def is_finished():
+            # Finish the log while it's being followed
+            checks.append(True)
+            if len(checks) == 2:
+                with open(self.log_file, 'a') as f:
+                    f.write('o\nthree\n')
+            return len(checks) > 2
+
+        lines = list(tail(self.log_file, is_finished=is_finished, poll_interval=0))
+        self.assertEqual([line for _, line in lines], ['one', 'two', 'three'])
+
+    def test_tail_splits_long_lines(self):
+        with open(self.log_file, 'w') as f:
+            f.write('x' * 10 + '\n')
+
+        lines = [line for _, line in tail(self.log_file, max_line_length=4)]
+        self.assertEqual(lines, ['xxxx', 'xxxx', 'xx'])
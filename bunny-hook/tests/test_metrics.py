@@ -0,0 +1,31 @@
+from unittest import TestCase
+
+import env
+from api import metrics
+
+
+class TestMetrics(TestCase):
+
+    def test_render(self):
+        snapshot = {
+            'depth': {'pending': 3},
+            'counters': {'jobs_enqueued': 5},
+            'histograms': {
+                'build': {
+                    'sum': 7.5,
+                    'count': 2,
+                    'buckets': [(1, 0), (5, 1), (float('inf'), 2)]
+                }
+            }
+        }
+
+        lines = metrics.render(snapshot).splitlines()
+
+        self.assertIn('bunny_hook_queue_depth{status="pending"} 3', lines)
+        self.assertIn('bunny_hook_queue_depth{status="running"} 0', lines)
+        self.assertIn('bunny_hook_jobs_enqueued_total 5', lines)
+        self.assertIn('bunny_hook_jobs_failed_total 0', lines)
+        self.assertIn('bunny_hook_stage_duration_seconds_bucket{stage="build",le="5"} 1', lines)
+        self.assertIn('bunny_hook_stage_duration_seconds_bucket{stage="build",le="+Inf"} 2', lines)
+        self.assertIn('bunny_hook_stage_duration_seconds_sum{stage="build"} 7.5', lines)
+        self.assertIn('bunny_hook_stage_duration_seconds_count{stage="build"} 2', lines)
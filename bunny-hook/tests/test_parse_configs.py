@@ -0,0 +1,132 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+import env
+from api.parse_configs import Parse, blob_sha
+from api.exceptions import WorkerException
+
+
+class TestParse(TestCase):
+
+    def setUp(self):
+        self.repo = tempfile.mkdtemp()
+        self.write('scripts/build.sh', '#!/bin/bash\n')
+        self.write('scripts/deploy.sh', '#!/bin/bash\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.repo)
+
+    def write(self, path, contents):
+        path = os.path.join(self.repo, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(contents)
+
+    def test_blob_sha(self):
+        # Same as `git hash-object` for a file containing "hello\n"
+        self.assertEqual(blob_sha(b'hello\n'), 'ce013625030ba8dba906f756967f9e9ca394464a')
+
+    def test_parse(self):
+        self.write('deploy.yml', 'home: /srv/app\n'
+                                 'releases: true\n'
+                                 'build:\n'
+                                 '  - scripts/build.sh\n'
+                                 'deploy:\n'
+                                 '  - scripts/deploy.sh\n')
+
+        plan = Parse({'script_timeout': 60}).parse(self.repo)
+
+        self.assertEqual(plan.home, '/srv/app')
+        self.assertTrue(plan.releases)
+        self.assertEqual(plan.stages['prebuild'], [])
+        self.assertEqual(plan.scripts(), ['scripts/build.sh', 'scripts/deploy.sh'])
+        self.assertEqual(plan.settings['script_timeout'], 60)
+
+    def test_parse_caches_on_contents(self):
+        self.write('deploy.yml', 'home: /srv/cached\n')
+        first = Parse().parse(self.repo)
+        second = Parse().parse(self.repo)
+
+        self.assertIs(first.stages, second.stages)
+
+        self.write('deploy.yml', 'home: /srv/changed\n')
+        self.assertEqual(Parse().parse(self.repo).home, '/srv/changed')
+
+    def test_parse_rejects_unsafe_tags(self):
+        self.write('deploy.yml', 'home: !!python/object/apply:os.getcwd []\n')
+
+        with self.assertRaises(WorkerException) as e:
+            Parse().parse(self.repo)
+
+        self.assertIn('Could not parse', str(e.exception))
+
+    def test_parse_checks_scripts(self):
+        self.write('deploy.yml', 'home: /srv/app\n'
+                                 'build:\n'
+                                 '  - scripts/build.sh\n'
+                                 '  - scripts/missing.sh\n')
+
+        with self.assertRaises(WorkerException) as e:
+            Parse().parse(self.repo)
+
+        self.assertIn("lists scripts that don't exist: scripts/missing.sh", str(e.exception))
+
+    def test_parse_rejects_scripts_outside_repo(self):
+        self.write('deploy.yml', 'home: /srv/app\n'
+                                 'build:\n'
+                                 '  - ../../etc/passwd\n')
+
+        with self.assertRaises(WorkerException) as e:
+            Parse().parse(self.repo)
+
+        self.assertIn('outside of the repo', str(e.exception))
+
+    def test_parse_dependencies(self):
+        self.write('deploy.yml', 'home: /srv/app\n'
+                                 'dependencies:\n'
+                                 '  - path: venv/\n'
+                                 '    lockfiles: requirements*.txt\n'
+                                 '  - path: web/node_modules\n'
+                                 '    lockfiles: [web/package-lock.json]\n')
+
+        dependencies = Parse().parse(self.repo).dependencies
+
+        self.assertEqual([(dep.path, dep.lockfiles) for dep in dependencies],
+                         [('venv', ['requirements*.txt']),
+                          ('web/node_modules', ['web/package-lock.json'])])
+
+    def test_parse_rejects_bad_dependencies(self):
+        for entry, message in (('{path: ../venv, lockfiles: [a.txt]}', 'inside of the repo'),
+                               ('{path: venv}', 'must list their `lockfiles`'),
+                               ('venv', 'Unrecognized dependencies entry')):
+            self.write('deploy.yml', 'home: /srv/%s\n'
+                                     'dependencies:\n'
+                                     '  - %s\n' % (self.id(), entry))
+
+            with self.assertRaises(WorkerException) as e:
+                Parse().parse(self.repo)
+
+            self.assertIn(message, str(e.exception))
+
+    def test_repo_lowers_limits(self):
+        self.write('deploy.yml', 'home: /srv/app\n'
+                                 'script_timeout: 10\n'
+                                 'job_timeout: 7200\n')
+
+        plan = Parse({'script_timeout': 60, 'job_timeout': 3600}).parse(self.repo)
+
+        self.assertEqual(plan.settings['script_timeout'], 10)
+        self.assertEqual(plan.settings['job_timeout'], 3600)
+
+    def test_parse_rejects_bad_counts(self):
+        for directive in ('script_timeout: "10"', 'job_timeout: 0', 'keep_releases: 0',
+                          'keep_releases: -1', 'max_parallel_scripts: 1.5',
+                          'keep_releases: yes'):
+            self.write('deploy.yml', 'home: /srv/app\n%s\n' % directive)
+
+            with self.assertRaises(WorkerException) as e:
+                Parse({'script_timeout': 60, 'job_timeout': 3600}).parse(self.repo)
+
+            self.assertIn('must be a whole number above zero', str(e.exception))
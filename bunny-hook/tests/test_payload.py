@@ -39,3 +39,12 @@ class TestPayload(TestCase):
     def test_payload_get_name(self):
         self.assertEqual(self.payload.get_name(), 'bunny-hook')
 
+    def test_payload_get_origin_from_repository(self):
+        payload = Payload({'repository': {'clone_url': 'https://example.com/repo.git'}})
+        self.assertEqual(payload.get_origin(), 'https://example.com/repo.git')
+
+    def test_payload_project(self):
+        payload = Payload(dict(self.json, after='abc', commits=[{'id': 'abc'}],
+                               pusher={'name': 'jeancochrane'}))
+
+        self.assertEqual(payload.project(), dict(self.json, after='abc'))
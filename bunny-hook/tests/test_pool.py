@@ -0,0 +1,260 @@
+import os
+import json
+import time
+import signal
+import shutil
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+from concurrent.futures.process import BrokenProcessPool
+
+import env
+from api.queue import Queue
+from api.pool import WorkerPool
+from api.exceptions import QueueException
+
+
+def record(payload, home=None, **options):
+    '''
+    Stand-in for a deploy that records when it started and stopped. Each
+    branch deploys to its own home, unless one is given.
+    '''
+    start = time.time()
+    time.sleep(0.1)
+
+    with open(os.path.join(options['settings']['tmp'], 'jobs.log'), 'a') as log:
+        log.write(json.dumps([payload['repository']['name'], start, time.time()]) + '\n')
+
+    return {'timings': [], 'home': home or '/srv/%s/%s' % (payload['repository']['name'],
+                                                            payload['ref'].split('/')[-1])}
+
+
+def record_shared_home(payload, **options):
+    return record(payload, home='/srv/%s' % payload['repository']['name'], **options)
+
+
+def record_slowly(payload, **options):
+    time.sleep(1)
+    return record(payload, **options)
+
+
+def fail(payload, **options):
+    raise Exception('Build failed')
+
+
+def die(*args, **options):
+    '''
+    Stand-in for a build that gets its worker process killed.
+    '''
+    os.kill(os.getpid(), signal.SIGKILL)
+
+
+def die_once(payload, **options):
+    marker = os.path.join(options['settings']['tmp'], 'died')
+
+    if not os.path.exists(marker):
+        open(marker, 'w').close()
+        die()
+
+    return record(payload, **options)
+
+
+class TestWorkerPool(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.log = os.path.join(self.tmp, 'jobs.log')
+        self.queue = Queue(os.path.join(self.tmp, 'test.db'), settings={'tmp': self.tmp})
+
+    def tearDown(self):
+        self.queue.close()
+        shutil.rmtree(self.tmp)
+
+    def add_jobs(self, repos, jobs_per_repo, same_ref=False):
+        # Keep every push to a ref, rather than only the newest one
+        self.queue.coalesce = not same_ref
+
+        for branch in range(jobs_per_repo):
+            for repo in repos:
+                self.queue.add({
+                    'ref': 'refs/heads/branch-%d' % (0 if same_ref else branch),
+                    'repository': {'name': repo},
+                })
+
+    def read_log(self):
+        with open(self.log) as log:
+            return [json.loads(line) for line in log]
+
+    def test_pool_runs_repos_concurrently(self):
+        self.add_jobs(['repo-a', 'repo-b', 'repo-c'], 1)
+
+        pool = WorkerPool(self.queue, 3, target=record)
+        pool.run_forever(until_empty=True)
+        pool.shutdown()
+
+        jobs = self.read_log()
+        self.assertEqual(len(jobs), 3)
+
+        # All three jobs should have started before any of them finished
+        self.assertLess(max(start for _, start, _ in jobs),
+                        min(end for _, _, end in jobs))
+
+    def deploy_twice(self, target):
+        '''
+        Deploy three branches of a repo, then push to them again and return
+        the log of the second round, once the queue knows their homes.
+        '''
+        pool = WorkerPool(self.queue, 3, target=target)
+
+        for _ in range(2):
+            if os.path.exists(self.log):
+                os.remove(self.log)
+            self.add_jobs(['repo-a'], 3)
+            pool.run_forever(until_empty=True)
+
+        pool.shutdown()
+        return self.read_log()
+
+    def test_pool_runs_branches_concurrently(self):
+        jobs = self.deploy_twice(record)
+
+        self.assertEqual(len(jobs), 3)
+        self.assertLess(max(start for _, start, _ in jobs),
+                        min(end for _, _, end in jobs))
+
+    def test_pool_serializes_branches_that_share_a_home(self):
+        jobs = self.deploy_twice(record_shared_home)
+
+        self.assertEqual(len(jobs), 3)
+        intervals = sorted((start, end) for _, start, end in jobs)
+        for (_, end), (start, _) in zip(intervals, intervals[1:]):
+            self.assertLessEqual(end, start)
+
+    def test_pool_serializes_jobs_for_one_ref(self):
+        self.add_jobs(['repo-a', 'repo-b'], 3, same_ref=True)
+
+        pool = WorkerPool(self.queue, 4, target=record)
+        pool.run_forever(until_empty=True)
+        pool.shutdown()
+
+        jobs = self.read_log()
+        self.assertEqual(len(jobs), 6)
+
+        for repo in ('repo-a', 'repo-b'):
+            intervals = sorted((start, end) for name, start, end in jobs if name == repo)
+            for (_, end), (start, _) in zip(intervals, intervals[1:]):
+                self.assertLessEqual(end, start)
+
+    def test_pool_survives_failed_jobs(self):
+        self.add_jobs(['repo-a', 'repo-b'], 1)
+
+        pool = WorkerPool(self.queue, 2, target=fail)
+        with self.assertLogs(level='ERROR') as logs:
+            pool.run_forever(until_empty=True)
+        pool.shutdown()
+
+        self.assertEqual(len(logs.output), 2)
+        self.assertIsNone(self.queue.claim())
+
+    def test_pool_restarts_after_a_worker_dies(self):
+        self.queue.retry_backoff = 0
+        self.add_jobs(['repo-a'], 1)
+
+        pool = WorkerPool(self.queue, 2, target=die_once)
+        with self.assertLogs(level='WARNING'):
+            pool.run_forever(until_empty=True)
+        pool.shutdown()
+
+        # The job whose worker was killed ran again on a fresh pool
+        self.assertEqual(len(self.read_log()), 1)
+        job = self.queue.get_job(1)
+        self.assertEqual((job['status'], job['attempts']), ('succeeded', 2))
+
+    def test_pool_restarts_before_starting_jobs(self):
+        pool = WorkerPool(self.queue, 2, target=record)
+
+        # Break the pool while it's idle
+        with self.assertRaises(BrokenProcessPool):
+            pool.executor.submit(die).result()
+
+        self.add_jobs(['repo-a', 'repo-b'], 1)
+        with self.assertLogs(level='WARNING'):
+            self.assertEqual(pool.fill(), 2)
+        pool.run_forever(until_empty=True)
+        pool.shutdown()
+
+        self.assertEqual(len(self.read_log()), 2)
+
+    def test_pool_puts_back_jobs_it_cannot_start(self):
+        self.add_jobs(['repo-a', 'repo-b'], 1)
+        pool = WorkerPool(self.queue, 2, target=record)
+
+        with patch.object(pool, 'submit', side_effect=BrokenProcessPool('gone')):
+            with self.assertRaises(BrokenProcessPool):
+                pool.fill()
+        pool.shutdown()
+
+        # Neither job is left leased with nothing running it
+        jobs = self.queue.cursor.execute('SELECT status, last_error FROM queue').fetchall()
+        self.assertEqual(jobs, [('pending', 'Could not start job: gone')] * 2)
+
+    def test_pool_keeps_results_until_the_queue_takes_them(self):
+        self.add_jobs(['repo-a'], 1)
+        pool = WorkerPool(self.queue, 2, target=record)
+        finish = self.queue.finish
+
+        def finish_once_up(*args, **kwargs):
+            # The first report fails, as if a remote queue were down
+            if mock_finish.call_count == 1:
+                raise QueueException('Connection refused')
+            return finish(*args, **kwargs)
+
+        with patch.object(self.queue, 'finish', side_effect=finish_once_up) as mock_finish:
+            with self.assertLogs(level='WARNING'):
+                pool.run_forever(until_empty=True)
+        pool.shutdown()
+
+        self.assertEqual(mock_finish.call_count, 2)
+        self.assertEqual(self.queue.get_job(1)['status'], 'succeeded')
+
+    def test_pool_survives_failed_lease_renewals(self):
+        self.add_jobs(['repo-a', 'repo-b'], 1)
+        pool = WorkerPool(self.queue, 2, target=record)
+        pool.fill()
+
+        error = QueueException('Connection refused')
+        with patch.object(self.queue, 'heartbeat', side_effect=error) as mock_heartbeat:
+            with self.assertLogs(level='WARNING'):
+                pool.heartbeat()
+
+        # The queue wasn't asked again about the other job once it was down,
+        # and the leases get another try before they're next due
+        self.assertEqual(mock_heartbeat.call_count, 1)
+        self.assertLess(pool.next_heartbeat - time.monotonic(), self.queue.lease_time / 3)
+
+        pool.run_forever(until_empty=True)
+        pool.shutdown()
+        self.assertEqual(len(self.read_log()), 2)
+
+    def test_pool_renews_leases_shorter_than_its_wait(self):
+        self.queue.lease_time = 0.3
+        self.queue.max_wait = 5
+        self.add_jobs(['repo-a'], 1)
+
+        renewals = []
+        heartbeat = self.queue.heartbeat
+
+        def record_renewal(work_id):
+            renewals.append(time.monotonic())
+            return heartbeat(work_id)
+
+        # The job outlasts its lease several times over, while the pool's
+        # backoff grows well past it
+        pool = WorkerPool(self.queue, 2, target=record_slowly)
+        with patch.object(self.queue, 'heartbeat', side_effect=record_renewal):
+            pool.run_forever(until_empty=True)
+        pool.shutdown()
+
+        gaps = [later - earlier for earlier, later in zip(renewals, renewals[1:])]
+        self.assertLess(max(gaps), self.queue.lease_time)
+        self.assertEqual(self.queue.get_job(1)['attempts'], 1)
@@ -1,10 +1,18 @@
 import os
+import sys
+import json
+import shutil
+import socket
 import sqlite3
+import subprocess
+import time
 from unittest import TestCase
 from unittest.mock import patch
 
 import env
-from api.queue import Queue
+from api.queue import Queue, get_queue
+from api.payload import Payload
+from api.exceptions import QueueFull, QueueException, WorkerException, CheckoutFailed
 
 
 class TestQueue(TestCase):
@@ -24,10 +32,28 @@ class TestQueue(TestCase):
 
     @classmethod
     def tearDownClass(cls):
-        os.remove('test.db')
+        cls.queue.close()
+
+        for suffix in ('', '-wal', '-shm', '.sock.lock'):
+            if os.path.exists(cls.db_conn + suffix):
+                os.remove(cls.db_conn + suffix)
 
     def tearDown(self):
         self.queue.cursor.execute('DELETE FROM queue')
+        self.queue.cursor.execute('DELETE FROM dead_letter')
+        self.queue.cursor.execute('DELETE FROM counters')
+        self.queue.cursor.execute('DELETE FROM jobs')
+        self.queue.cursor.execute('DELETE FROM repo_clocks')
+        self.queue.cursor.execute('DELETE FROM homes')
+
+    def deploy_apart(self, *refs, repo='bunny-hook'):
+        '''
+        Record that branches of a repo deploy to homes of their own, so that
+        the queue lets them run alongside each other.
+        '''
+        for ref in refs:
+            self.queue.cursor.execute('INSERT INTO homes (lock_key, ref, home) VALUES (?, ?, ?)',
+                                      (repo, ref, '/srv/%s/%s' % (repo, ref)))
 
     def test_queue_created(self):
         create_table = '''
@@ -58,6 +84,72 @@ class TestQueue(TestCase):
     def test_queue_pop_no_work(self):
         self.assertIsNone(self.queue.pop())
 
+    def test_queue_pop_follows_claim_order(self):
+        first_id = self.queue.add(self.payload)
+        urgent = {'ref': 'refs/head/master', 'repository': {'name': 'urgent-repo'}}
+        urgent_id = self.queue.add(urgent, priority=10)
+
+        # Jobs waiting to be retried stay put
+        self.queue.cursor.execute('UPDATE queue SET available_at = ? WHERE id = ?',
+                                  (time.time() + 60, first_id))
+        self.assertEqual(self.queue.pop_many(5), [urgent])
+        self.assertIsNone(self.queue.pop())
+
+        # Popped jobs are remembered
+        job = self.queue.get_job(urgent_id)
+        self.assertEqual((job['status'], job['attempts']), ('popped', 1))
+        self.assertEqual(self.queue.get_metrics()['counters']['jobs_popped'], 1)
+
+    def test_queue_add_many(self):
+        self.deploy_apart(*['refs/heads/branch-%d' % i for i in range(3)])
+        payloads = [dict(self.payload, ref='refs/heads/branch-%d' % i) for i in range(3)]
+        payloads.append(dict(self.payload, ref='refs/heads/branch-0', after='abc'))
+
+        # A later push to the same ref in the batch replaces the earlier one
+        work_ids = self.queue.add_many(payloads)
+        self.assertEqual(work_ids[3], work_ids[0])
+        self.assertEqual(len(set(work_ids)), 3)
+
+        counters = self.queue.get_metrics()['counters']
+        self.assertEqual((counters['jobs_enqueued'], counters['jobs_coalesced']), (3, 1))
+
+        # Jobs are handed out oldest first
+        self.assertEqual(self.queue.pop_many(2), [payloads[3], payloads[1]])
+        self.assertEqual(self.queue.pop_many(2), [payloads[2]])
+
+    def test_queue_add_many_when_full(self):
+        queue = Queue(self.db_conn, settings={'max_repo_depth': 2})
+        payloads = [dict(self.payload, ref='refs/heads/branch-%d' % i) for i in range(3)]
+
+        try:
+            work_ids = queue.add_many(payloads)
+            self.assertIsNotNone(work_ids[1])
+            self.assertIsNone(work_ids[2])
+            self.assertEqual(queue.get_metrics()['counters']['jobs_rejected'], 1)
+        finally:
+            queue.close()
+
+    def test_queue_claim_many(self):
+        self.deploy_apart('refs/head/master', 'refs/heads/other')
+        self.queue.coalesce = False
+
+        try:
+            first_id, second_id, other_id = self.queue.add_many([
+                self.payload,
+                self.payload,
+                dict(self.payload, ref='refs/heads/other'),
+            ])
+        finally:
+            self.queue.coalesce = True
+
+        # Jobs in a batch still hold their ref against each other
+        claimed = self.queue.claim_many(5)
+        self.assertEqual([work_id for work_id, _ in claimed], [first_id, other_id])
+        self.assertEqual(self.queue.attempts[first_id], 1)
+
+        self.queue.finish(first_id)
+        self.assertEqual(self.queue.claim_many(5), [(second_id, self.payload)])
+
     def test_queue_add_commits_to_database(self):
         work_id = self.queue.add(self.payload)
 
@@ -70,7 +162,7 @@ class TestQueue(TestCase):
         self.assertIsNotNone(work)
         self.assertEqual(work, self.payload)
 
-    @patch('api.queue.Worker.deploy')
+    @patch('api.worker.Worker.deploy')
     def test_queue_run(self, mock_deploy):
         self.queue.add(self.payload)
 
@@ -78,10 +170,630 @@ class TestQueue(TestCase):
         queue = self.queue.cursor.execute('SELECT * FROM queue').fetchall()
         self.assertTrue(len(queue) > 0)
 
-        self.queue.run()
+        self.assertTrue(self.queue.run())
 
         # Check that `Worker.deploy` was called, and work was removed from the
         # queue
         self.assertTrue(mock_deploy.called)
         self.assertIsNone(self.queue.pop())
 
+    @patch('api.worker.Worker.deploy', side_effect=CheckoutFailed('Could not reach GitHub'))
+    def test_queue_run_retries_failed_checkout(self, mock_deploy):
+        work_id = self.queue.add(self.payload)
+
+        self.assertTrue(self.queue.run())
+
+        # The job is back on the queue, waiting to be retried
+        select = 'SELECT status, attempts, last_error FROM queue WHERE id = ?'
+        self.assertEqual(self.queue.cursor.execute(select, (work_id,)).fetchone(),
+                         ('pending', 1, 'Could not reach GitHub'))
+
+    @patch('api.worker.Worker.deploy', side_effect=WorkerException('build.sh failed'))
+    def test_queue_run_drops_failed_build(self, mock_deploy):
+        self.queue.add(self.payload)
+
+        self.assertTrue(self.queue.run())
+        self.assertEqual(self.queue.get_metrics()['counters']['jobs_failed'], 1)
+        self.assertIsNone(self.queue.pop())
+
+    @patch('api.worker.Worker.deploy')
+    def test_queue_run_keeps_result_until_reported(self, mock_deploy):
+        work_id = self.queue.add(self.payload)
+        finish = self.queue.finish
+
+        def finish_once_up(*args, **kwargs):
+            # The first report fails, as if a remote queue were down
+            if mock_finish.call_count == 1:
+                raise QueueException('Connection refused')
+            return finish(*args, **kwargs)
+
+        with patch.object(self.queue, 'finish', side_effect=finish_once_up) as mock_finish:
+            with self.assertLogs(level='WARNING'):
+                self.assertTrue(self.queue.run())
+
+        self.assertEqual(mock_finish.call_count, 2)
+        self.assertEqual(self.queue.get_job(work_id)['status'], 'succeeded')
+
+    def test_queue_imports_lazily(self):
+        # Producers in the API server shouldn't load the build worker, and
+        # consumers shouldn't load Flask
+        code = ('import sys, api.queue; '
+                'print([name for name in ("flask", "api.worker") if name in sys.modules])')
+        root = os.path.dirname(os.path.dirname(os.path.abspath(env.__file__)))
+        output = subprocess.check_output([sys.executable, '-c', code], cwd=root)
+        self.assertEqual(output.strip(), b'[]')
+
+    def test_queue_run_no_work(self):
+        self.assertFalse(self.queue.run())
+
+    def test_queue_wait_wakes_on_add(self):
+        consumer = Queue(self.db_conn)
+        consumer.listen()
+
+        try:
+            # Add work from a separate producer connection
+            Queue(self.db_conn).add(self.payload)
+
+            start = time.time()
+            self.assertTrue(consumer.wait(5))
+            self.assertLess(time.time() - start, 1)
+        finally:
+            consumer.close()
+
+    def test_queue_wait_times_out(self):
+        consumer = Queue(self.db_conn)
+        consumer.listen()
+
+        try:
+            self.assertFalse(consumer.wait(0.01))
+        finally:
+            consumer.close()
+
+    def test_queue_second_listener_polls(self):
+        consumer = Queue(self.db_conn)
+        consumer.listen()
+        second = Queue(self.db_conn)
+
+        try:
+            # The second consumer doesn't take over the first one's socket
+            with self.assertLogs(level='WARNING'):
+                second.listen()
+            self.assertIsNone(second.listener)
+
+            Queue(self.db_conn).add(self.payload)
+            self.assertTrue(consumer.wait(5))
+
+            # Once the first consumer is gone, the next one can listen
+            consumer.close()
+            second.listen()
+            self.assertIsNotNone(second.listener)
+        finally:
+            consumer.close()
+            second.close()
+
+    def test_queue_listen_replaces_stale_socket(self):
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        stale.bind(self.queue.sock_path)
+        stale.close()
+
+        consumer = Queue(self.db_conn)
+        consumer.listen()
+
+        try:
+            self.assertIsNotNone(consumer.listener)
+            Queue(self.db_conn).add(self.payload)
+            self.assertTrue(consumer.wait(5))
+        finally:
+            consumer.close()
+
+    def test_queue_wait_without_listener(self):
+        self.assertFalse(self.queue.wait(0.01))
+
+    def test_queue_uses_wal(self):
+        mode = self.queue.cursor.execute('PRAGMA journal_mode').fetchone()[0]
+        self.assertEqual(mode, 'wal')
+
+    def test_get_queue_reuses_connection(self):
+        queue = get_queue(self.db_conn)
+        self.assertIs(get_queue(self.db_conn), queue)
+
+        queue.add(self.payload)
+        self.assertEqual(self.queue.pop(), self.payload)
+
+    def test_queue_claim(self):
+        first_id = self.queue.add(self.payload)
+        self.queue.add({'ref': 'refs/head/other'})
+
+        work_id, payload = self.queue.claim()
+        self.assertEqual(work_id, first_id)
+        self.assertEqual(payload, self.payload)
+
+        # Claimed work stays in the queue, but can't be claimed again
+        status = self.queue.cursor.execute('''
+            SELECT status FROM queue WHERE id = ?
+        ''', (work_id,)).fetchone()[0]
+        self.assertEqual(status, 'running')
+
+        second_id, payload = self.queue.claim()
+        self.assertNotEqual(second_id, work_id)
+        self.assertIsNone(self.queue.claim())
+
+        self.queue.finish(work_id)
+        count = self.queue.cursor.execute('''
+            SELECT COUNT(*) FROM queue WHERE id = ?
+        ''', (work_id,)).fetchone()[0]
+        self.assertEqual(count, 0)
+
+    def test_queue_claim_uses_index(self):
+        plan = self.queue.cursor.execute('''
+            EXPLAIN QUERY PLAN
+             SELECT id FROM queue
+              WHERE status = 'pending'
+           ORDER BY date_added, id
+              LIMIT 1
+        ''').fetchall()
+
+        self.assertIn('queue_claim', str(plan))
+        self.assertNotIn('TEMP B-TREE', str(plan))
+
+    def test_queue_migrates_legacy_database(self):
+        db_conn = 'legacy.db'
+        conn = sqlite3.connect(db_conn)
+        conn.execute('''
+            CREATE TABLE queue
+                (id TEXT, payload TEXT, date_added NUMERIC)
+        ''')
+        payload = {
+            'ref': 'refs/heads/master',
+            'after': 'abc',
+            'commits': [{'id': 'abc', 'modified': ['README.md']}],
+            'repository': {
+                'name': 'bunny-hook',
+                'clone_url': 'https://github.com/jeancochrane/bunny-hook.git',
+            },
+        }
+        conn.executemany('''
+            INSERT INTO queue (id, payload, date_added) VALUES (?, ?, ?)
+        ''', [('b', json.dumps(dict(payload, after='def')), 2),
+              ('a', json.dumps(payload), 1)])
+        conn.commit()
+        conn.close()
+
+        job = Payload(payload).project()
+
+        try:
+            legacy_queue = Queue(db_conn)
+            self.assertEqual(legacy_queue.pop(), job)
+            self.assertEqual(legacy_queue.pop(), dict(job, after='def'))
+            self.assertIsNone(legacy_queue.pop())
+            legacy_queue.close()
+        finally:
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(db_conn + suffix):
+                    os.remove(db_conn + suffix)
+
+    def test_queue_add_stores_projection(self):
+        payload = dict(self.payload, after='abc', commits=[{'id': 'abc'}] * 100)
+        work_id = self.queue.add(payload)
+
+        select = 'SELECT payload FROM queue WHERE id = ?'
+        stored = self.queue.cursor.execute(select, (work_id,)).fetchone()[0]
+
+        self.assertEqual(json.loads(stored), dict(self.payload, after='abc'))
+        self.assertIsNone(self.queue.get_archived(work_id))
+
+    def test_queue_add_archives_payload(self):
+        archive_path = 'test-archive'
+        queue = Queue(self.db_conn, settings={'archive_path': archive_path})
+        raw = json.dumps(dict(self.payload, commits=[])).encode('utf-8')
+
+        try:
+            work_id = queue.add(json.loads(raw), raw=raw)
+            self.assertEqual(queue.get_archived(work_id), json.loads(raw))
+            self.assertEqual(queue.pop(), self.payload)
+        finally:
+            queue.close()
+            shutil.rmtree(archive_path, ignore_errors=True)
+
+    def test_queue_add_limits_depth(self):
+        queue = Queue(self.db_conn, settings={'max_queue_depth': 2, 'max_repo_depth': 1})
+
+        try:
+            queue.add(self.payload)
+
+            # Another push to the same ref replaces the waiting job
+            queue.add(dict(self.payload, after='abc'))
+
+            with self.assertRaises(QueueFull) as cm:
+                queue.add(dict(self.payload, ref='refs/head/other'))
+            self.assertIn('bunny-hook', str(cm.exception))
+            self.assertEqual(cm.exception.retry_after, Queue.retry_after)
+
+            queue.add({'ref': 'refs/head/master', 'repository': {'name': 'other-repo'}})
+
+            with self.assertRaises(QueueFull):
+                queue.add({'ref': 'refs/head/master', 'repository': {'name': 'third-repo'}})
+
+            self.assertEqual(queue.get_metrics()['depth'], {'pending': 2})
+            self.assertEqual(queue.get_metrics()['counters']['jobs_rejected'], 2)
+        finally:
+            queue.close()
+            self.queue.cursor.execute('DELETE FROM counters')
+
+    def test_queue_retry_after_uses_job_duration(self):
+        with self.queue.transaction():
+            self.queue.observe('job', 10)
+            self.queue.observe('job', 20.5)
+
+        try:
+            self.assertEqual(self.queue.get_retry_after(), 16)
+        finally:
+            self.queue.cursor.execute('DELETE FROM histogram_buckets')
+            self.queue.cursor.execute('DELETE FROM histogram_totals')
+
+    def test_queue_claim_skips_running_refs(self):
+        other_repo = {
+            'ref': 'refs/head/master',
+            'repository': {
+                'name': 'other-repo'
+            }
+        }
+
+        first_id = self.queue.add(self.payload)
+        other_id = self.queue.add(other_repo)
+        other_branch_id = self.queue.add(dict(self.payload, ref='refs/head/other'))
+
+        self.assertEqual(self.queue.claim()[0], first_id)
+        self.assertEqual(self.queue.claim()[0], other_id)
+
+        # Other branches of the repo wait while they might share its home...
+        self.assertIsNone(self.queue.claim())
+
+        # ...but once they're known not to, they build alongside it...
+        self.deploy_apart('refs/head/master', 'refs/head/other')
+        self.assertEqual(self.queue.claim()[0], other_branch_id)
+
+        # ...but a newer push to the same branch has to wait for it
+        next_id = self.queue.add(dict(self.payload, after='abc'))
+        self.assertIsNone(self.queue.claim())
+
+        self.queue.finish(first_id)
+        self.assertEqual(self.queue.claim()[0], next_id)
+
+    def test_queue_priority_jumps_ahead(self):
+        self.deploy_apart('refs/head/master', 'refs/head/other', 'refs/head/hotfix',
+                          'refs/head/urgent')
+        first_id = self.queue.add(self.payload)
+        other_id = self.queue.add(dict(self.payload, ref='refs/head/other'))
+
+        hotfix = dict(self.payload, ref='refs/head/hotfix')
+        with patch.object(self.queue, 'priorities', {'bunny-hook/hotfix': 10}):
+            hotfix_id = self.queue.add(hotfix)
+        urgent_id = self.queue.add(dict(self.payload, ref='refs/head/urgent'), priority=20)
+
+        order = [self.queue.claim()[0] for _ in range(4)]
+        self.assertEqual(order, [urgent_id, hotfix_id, first_id, other_id])
+
+        priorities = self.queue.cursor.execute('''
+            SELECT priority FROM queue ORDER BY id
+        ''').fetchall()
+        self.assertEqual(priorities, [(0,), (0,), (10,), (20,)])
+
+    def test_queue_priority_is_bounded_by_aging(self):
+        self.deploy_apart('refs/head/master', 'refs/head/urgent')
+        # With no credit for waiting, priority only breaks ties
+        with patch.object(self.queue, 'priority_aging', 0):
+            first_id = self.queue.add(self.payload)
+            time.sleep(0.01)
+            urgent_id = self.queue.add(dict(self.payload, ref='refs/head/urgent'),
+                                       priority=Queue.max_priority * 2)
+
+        self.assertEqual(self.queue.claim()[0], first_id)
+        self.assertEqual(self.queue.claim()[0], urgent_id)
+
+        # Priorities are capped at `max_priority`
+        priority = self.queue.cursor.execute('''
+            SELECT priority FROM queue WHERE id = ?
+        ''', (urgent_id,)).fetchone()[0]
+        self.assertEqual(priority, Queue.max_priority)
+
+    def test_queue_coalesced_job_keeps_its_place(self):
+        first_id = self.queue.add(self.payload)
+        other_id = self.queue.add({'ref': 'refs/head/master',
+                                   'repository': {'name': 'other-repo'}})
+
+        # A newer push replaces the waiting job without sending it to the back
+        self.assertEqual(self.queue.add(dict(self.payload, after='abc')), first_id)
+        self.assertEqual(self.queue.claim()[0], first_id)
+        self.queue.finish(first_id)
+
+        # ...and a more urgent one moves it up
+        third_id = self.queue.add({'ref': 'refs/head/master',
+                                   'repository': {'name': 'third-repo'}})
+        self.queue.add({'ref': 'refs/head/master', 'repository': {'name': 'third-repo'},
+                        'after': 'abc'}, priority=1)
+        self.assertEqual(self.queue.claim()[0], third_id)
+        self.assertEqual(self.queue.claim()[0], other_id)
+
+    def test_queue_fair_share(self):
+        self.deploy_apart(*['refs/head/branch-%d' % i for i in range(3)])
+        busy = [self.queue.add(dict(self.payload, ref='refs/head/branch-%d' % i))
+                for i in range(3)]
+        quiet_id = self.queue.add({'ref': 'refs/head/master',
+                                   'repository': {'name': 'quiet-repo'}})
+
+        # The quiet repo doesn't wait behind every branch of the busy one
+        order = [self.queue.claim()[0] for _ in range(4)]
+        self.assertEqual(order, [busy[0], quiet_id, busy[1], busy[2]])
+
+    def test_queue_fair_share_uses_weights(self):
+        refs = ['refs/head/branch-%d' % i for i in range(4)]
+        self.deploy_apart(*refs)
+        self.deploy_apart(*refs[:2], repo='other-repo')
+        weights = {'bunny-hook': 2}
+        with patch.object(self.queue, 'repo_weights', weights):
+            busy = [self.queue.add(dict(self.payload, ref='refs/head/branch-%d' % i))
+                    for i in range(4)]
+            other = [self.queue.add({'ref': 'refs/head/branch-%d' % i,
+                                     'repository': {'name': 'other-repo'}})
+                     for i in range(2)]
+
+        # The busy repo gets two builds for every one of the other repo's
+        order = [self.queue.claim()[0] for _ in range(6)]
+        self.assertEqual(order, [busy[0], other[0], busy[1], busy[2], other[1], busy[3]])
+
+    def test_queue_fair_share_window(self):
+        self.deploy_apart(*['refs/head/branch-%d' % i for i in range(3)])
+        with patch.object(self.queue, 'fair_share_window', 0):
+            busy = [self.queue.add(dict(self.payload, ref='refs/head/branch-%d' % i))
+                    for i in range(3)]
+            time.sleep(0.01)
+            quiet_id = self.queue.add({'ref': 'refs/head/master',
+                                       'repository': {'name': 'quiet-repo'}})
+
+        # A repo can fall so far behind, and no further
+        order = [self.queue.claim()[0] for _ in range(4)]
+        self.assertEqual(order, busy + [quiet_id])
+
+    def test_queue_claim_uses_schedule_index(self):
+        plan = self.queue.cursor.execute('''
+            EXPLAIN QUERY PLAN
+             SELECT id FROM queue
+              WHERE status = 'pending'
+           ORDER BY vtime, id
+              LIMIT 1
+        ''').fetchall()
+
+        self.assertIn('queue_schedule', str(plan))
+        self.assertNotIn('TEMP B-TREE', str(plan))
+
+    def test_queue_finish_records_home(self):
+        work_id = self.queue.add(self.payload)
+        self.queue.claim()
+        self.queue.finish(work_id, home='/srv/bunny-hook')
+
+        other_id = self.queue.add(dict(self.payload, ref='refs/head/other'))
+        self.queue.claim()
+        self.queue.finish(other_id, 'failed', home='/srv/bunny-hook')
+
+        homes = self.queue.cursor.execute('''
+            SELECT ref, home FROM homes WHERE lock_key = 'bunny-hook' ORDER BY ref
+        ''').fetchall()
+        self.assertEqual(homes, [('refs/head/master', '/srv/bunny-hook'),
+                                 ('refs/head/other', '/srv/bunny-hook')])
+
+        # Branches that share a home take turns
+        self.queue.add(self.payload)
+        self.queue.add(dict(self.payload, ref='refs/head/other'))
+        self.assertIsNotNone(self.queue.claim())
+        self.assertIsNone(self.queue.claim())
+
+    def test_queue_expired_lease_is_redelivered(self):
+        work_id = self.queue.add(self.payload)
+        self.queue.claim()
+
+        # The consumer renews its lease while the job runs
+        self.assertTrue(self.queue.heartbeat(work_id))
+        self.assertIsNone(self.queue.claim())
+
+        # The consumer dies, and its lease runs out
+        self.queue.cursor.execute('UPDATE queue SET lease_expires = 0')
+        self.assertEqual(self.queue.claim()[0], work_id)
+        self.assertEqual(self.queue.get_metrics()['counters']['leases_expired'], 1)
+
+    def test_queue_finish_ignores_lost_lease(self):
+        work_id = self.queue.add(self.payload)
+        self.queue.claim()
+        lease = self.queue.lease(work_id)
+
+        # Another consumer claims the job after the lease runs out
+        self.queue.cursor.execute('UPDATE queue SET lease_expires = 0, available_at = 0')
+        other = Queue(self.db_conn)
+        try:
+            self.assertEqual(other.claim()[0], work_id)
+
+            # The first consumer can neither renew nor finish the job
+            self.assertFalse(lease())
+            self.assertFalse(self.queue.finish(work_id, 'succeeded', attempt=1))
+            self.assertTrue(other.finish(work_id, 'succeeded'))
+        finally:
+            other.close()
+
+    def test_queue_retry_backs_off(self):
+        work_id = self.queue.add(self.payload)
+        self.queue.claim()
+
+        before = time.time()
+        self.assertTrue(self.queue.finish(work_id, 'failed', retry=True, error='fetch failed'))
+
+        # The job waits out its backoff before it can be claimed again
+        self.assertIsNone(self.queue.claim())
+        select = 'SELECT status, available_at, last_error FROM queue WHERE id = ?'
+        status, available_at, last_error = self.queue.cursor.execute(select,
+                                                                     (work_id,)).fetchone()
+        self.assertEqual(status, 'pending')
+        self.assertGreaterEqual(available_at, before + Queue.retry_backoff)
+        self.assertEqual(last_error, 'fetch failed')
+
+        self.queue.cursor.execute('UPDATE queue SET available_at = 0')
+        self.assertEqual(self.queue.claim()[0], work_id)
+        self.assertEqual(self.queue.get_metrics()['counters']['jobs_retried'], 1)
+
+    def test_queue_dead_letter(self):
+        work_id = self.queue.add(self.payload)
+
+        for attempt in range(Queue.max_attempts):
+            self.queue.cursor.execute('UPDATE queue SET available_at = 0')
+            self.assertEqual(self.queue.claim()[0], work_id)
+            self.queue.finish(work_id, 'failed', retry=True, error='fetch failed')
+
+        # The job is set aside once it has used up its attempts
+        self.assertIsNone(self.queue.claim())
+        dead = self.queue.get_dead_letters()
+        self.assertEqual([job['id'] for job in dead], [work_id])
+        self.assertEqual(dead[0]['attempts'], Queue.max_attempts)
+        self.assertEqual(dead[0]['last_error'], 'fetch failed')
+        self.assertEqual(dead[0]['payload'], self.payload)
+
+        metrics = self.queue.get_metrics()
+        self.assertEqual(metrics['counters']['jobs_dead'], 1)
+        self.assertEqual(metrics['depth'], {'dead': 1})
+
+        # Redelivering it starts the attempts over
+        self.assertEqual(self.queue.redeliver_many([work_id, work_id + 1]), [work_id])
+        self.assertFalse(self.queue.redeliver(work_id))
+        self.assertEqual(self.queue.claim()[0], work_id)
+        self.assertEqual(self.queue.get_dead_letters(), [])
+
+    def kill(self, payload):
+        '''
+        Add a job and use up its attempts, and return its ID.
+        '''
+        work_id = self.queue.add(payload)
+        self.queue.claim()
+
+        with self.queue.transaction():
+            self.queue.reschedule(work_id, Queue.max_attempts, 'fetch failed', time.time())
+
+        return work_id
+
+    def test_queue_redeliver_gives_way_to_newer_push(self):
+        dead_id = self.kill(dict(self.payload, after='abc'))
+        pending_id = self.queue.add(dict(self.payload, after='def'))
+
+        # The dead job folds into the newer job for its ref
+        self.assertEqual(self.queue.redeliver_many([dead_id]), [dead_id])
+        self.assertEqual(self.queue.get_dead_letters(), [])
+        self.assertEqual(self.queue.pop_many(5), [dict(self.payload, after='def')])
+
+        job = self.queue.get_job(dead_id)
+        self.assertEqual((job['status'], job['error']),
+                         ('cancelled', 'Superseded by job %d' % pending_id))
+
+    def test_queue_redeliver_respects_depth(self):
+        dead_id = self.kill(self.payload)
+        queue = Queue(self.db_conn, settings={'max_repo_depth': 1})
+
+        try:
+            queue.add(dict(self.payload, ref='refs/head/other'))
+
+            # The repo is full, so the job stays dead
+            with self.assertLogs(level='WARNING'):
+                self.assertEqual(queue.redeliver_many([dead_id]), [])
+            self.assertEqual([job['id'] for job in queue.get_dead_letters()], [dead_id])
+        finally:
+            queue.close()
+
+    def test_queue_keeps_job_history(self):
+        work_id = self.queue.add(dict(self.payload, after='abc'))
+        self.assertEqual(self.queue.get_job(work_id)['status'], 'pending')
+        self.assertFalse(self.queue.is_finished(work_id))
+
+        self.queue.claim()
+        self.queue.finish(work_id, 'failed', [{'stage': 'build', 'duration': 2.0}],
+                          error='build.sh exited with 2', exit_code=2)
+        self.assertTrue(self.queue.is_finished(work_id))
+
+        job = self.queue.get_job(work_id)
+        self.assertEqual((job['status'], job['repo'], job['ref'], job['sha']),
+                         ('failed', 'bunny-hook', 'refs/head/master', 'abc'))
+        self.assertEqual((job['exit_code'], job['error'], job['attempts']),
+                         (2, 'build.sh exited with 2', 1))
+        self.assertIsNotNone(job['date_finished'])
+        self.assertEqual([timing['stage'] for timing in job['timings']], ['queue_wait', 'build'])
+
+        self.assertEqual([job['id'] for job in self.queue.get_jobs(repo='bunny-hook')],
+                         [work_id])
+        self.assertEqual(self.queue.get_jobs(repo='bunny-hook', before=work_id), [])
+
+    def test_queue_failed_scripts_are_not_retried(self):
+        work_id = self.queue.add(self.payload)
+        self.queue.claim()
+
+        self.queue.finish(work_id, 'failed', error='build.sh exited with 1')
+        self.assertEqual(self.queue.get_metrics()['depth'], {})
+
+    def test_queue_add_coalesces_pending_pushes(self):
+        first_id = self.queue.add(dict(self.payload, after='abc'))
+        second_id = self.queue.add(dict(self.payload, after='def'))
+        self.assertEqual(first_id, second_id)
+
+        # Only the newest push is left in the queue
+        self.assertEqual(self.queue.pop(), dict(self.payload, after='def'))
+        self.assertIsNone(self.queue.pop())
+
+    def test_queue_add_without_coalescing(self):
+        self.queue.coalesce = False
+
+        try:
+            first_id = self.queue.add(self.payload)
+            second_id = self.queue.add(self.payload)
+        finally:
+            del self.queue.coalesce
+
+        self.assertNotEqual(first_id, second_id)
+
+    def test_queue_add_supersedes_running_job(self):
+        self.queue.add(self.payload)
+        work_id, _ = self.queue.claim()
+        self.assertFalse(self.queue.is_superseded(work_id))
+
+        # A push to a different ref doesn't supersede the running job
+        self.queue.add(dict(self.payload, ref='refs/head/other'))
+        self.assertFalse(self.queue.is_superseded(work_id))
+
+        self.queue.add(self.payload)
+        self.assertTrue(self.queue.is_superseded(work_id))
+
+    def test_queue_worker_options(self):
+        work_id = self.queue.add(self.payload)
+        self.assertNotIn('is_cancelled', self.queue.worker_options(work_id))
+
+        self.queue.cancel_superseded = True
+
+        try:
+            is_cancelled = self.queue.worker_options(work_id)['is_cancelled']
+        finally:
+            del self.queue.cancel_superseded
+
+        self.assertFalse(is_cancelled())
+
+    def test_queue_finish_records_metrics(self):
+        self.queue.add(self.payload)
+        work_id, _ = self.queue.claim()
+
+        timings = [{'stage': 'build', 'name': 'scripts/build.sh', 'start': 0, 'duration': 2}]
+        self.queue.finish(work_id, 'failed', timings)
+
+        stages = self.queue.cursor.execute('''
+            SELECT stage FROM timings WHERE job_id = ?
+        ''', (work_id,)).fetchall()
+        self.assertEqual(stages, [('queue_wait',), ('build',)])
+
+        metrics = self.queue.get_metrics()
+        self.assertGreaterEqual(metrics['counters']['jobs_failed'], 1)
+
+        build = metrics['histograms']['build']
+        buckets = dict(build['buckets'])
+        self.assertEqual(buckets[1], 0)
+        self.assertEqual(buckets[5], build['count'])
@@ -0,0 +1,41 @@
+from unittest import TestCase
+from unittest.mock import patch
+
+import env
+from api.ratelimit import RateLimiter
+
+
+class TestRateLimiter(TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        patcher = patch('api.ratelimit.time.monotonic', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_burst(self):
+        limiter = RateLimiter(1, burst=3)
+
+        self.assertEqual([limiter.check('a') for _ in range(3)], [0, 0, 0])
+        self.assertAlmostEqual(limiter.check('a'), 1)
+
+        # Other sources have their own buckets
+        self.assertEqual(limiter.check('b'), 0)
+
+    def test_refill(self):
+        limiter = RateLimiter(2, burst=1)
+
+        self.assertEqual(limiter.check('a'), 0)
+        self.assertAlmostEqual(limiter.check('a'), 0.5)
+
+        self.now += 0.5
+        self.assertEqual(limiter.check('a'), 0)
+
+    def test_forget_sources(self):
+        limiter = RateLimiter(1, burst=1)
+        limiter.max_sources = 2
+
+        for source in ('a', 'b', 'c'):
+            limiter.check(source)
+
+        self.assertEqual(list(limiter.buckets), ['b', 'c'])
@@ -0,0 +1,96 @@
+import os
+import shutil
+import tempfile
+import subprocess
+from unittest import TestCase
+import logging
+
+import env
+from api.releases import Releases
+from api.exceptions import WorkerException
+
+
+class TestReleases(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.source = os.path.join(self.tmp, 'source')
+        self.releases = Releases(os.path.join(self.tmp, 'home'))
+
+        self.git('init', self.source)
+
+        # Suppress stdout logging
+        logging.disable(logging.INFO)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def git(self, *args):
+        cmd = ['git', '-c', 'user.name=test', '-c', 'user.email=test@example.com']
+        subprocess.run(cmd + list(args), check=True, stdout=subprocess.DEVNULL)
+
+    def commit(self, files):
+        for filename, contents in files.items():
+            path = os.path.join(self.source, filename)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as f:
+                f.write(contents)
+
+        self.git('-C', self.source, 'add', '--all')
+        self.git('-C', self.source, 'commit', '-m', 'Update')
+
+    def deploy(self, files):
+        self.commit(files)
+        name = self.releases.create(self.source)
+        self.releases.activate(name)
+        return name
+
+    def read_current(self, filename):
+        with open(os.path.join(self.releases.current_path, filename)) as f:
+            return f.read()
+
+    def test_create_and_activate(self):
+        name = self.deploy({'index.html': 'v1', 'static/app.js': 'app'})
+
+        self.assertEqual(self.releases.current(), name)
+        self.assertEqual(self.read_current('index.html'), 'v1')
+        self.assertEqual(self.read_current('static/app.js'), 'app')
+
+        # Only tracked files make it into the release
+        self.assertFalse(os.path.exists(os.path.join(self.releases.path(name), '.git')))
+
+    def test_unchanged_files_are_hardlinked(self):
+        first = self.deploy({'index.html': 'v1', 'static/app.js': 'app'})
+        second = self.deploy({'index.html': 'v2'})
+
+        def inode(name, filename):
+            return os.stat(os.path.join(self.releases.path(name), filename)).st_ino
+
+        self.assertEqual(inode(first, 'static/app.js'), inode(second, 'static/app.js'))
+        self.assertNotEqual(inode(first, 'index.html'), inode(second, 'index.html'))
+        self.assertEqual(self.read_current('index.html'), 'v2')
+
+    def test_rollback(self):
+        first = self.deploy({'index.html': 'v1'})
+        self.deploy({'index.html': 'v2'})
+
+        self.assertEqual(self.releases.rollback(), first)
+        self.assertEqual(self.read_current('index.html'), 'v1')
+
+        with self.assertRaises(WorkerException):
+            self.releases.rollback()
+
+    def test_prune(self):
+        names = [self.deploy({'index.html': 'v%d' % version}) for version in range(4)]
+
+        self.releases.prune(2)
+        self.assertEqual(self.releases.list(), names[2:])
+        self.assertEqual(self.read_current('index.html'), 'v3')
+
+    def test_redeploy_live_release(self):
+        first = self.deploy({'index.html': 'v1'})
+        second = self.releases.create(self.source)
+
+        self.assertNotEqual(first, second)
+        self.assertTrue(second.startswith(first))
+        self.assertEqual(self.releases.current(), first)
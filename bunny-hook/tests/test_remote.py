@@ -0,0 +1,182 @@
+import os
+import time
+import shutil
+import logging
+import tempfile
+import threading
+from unittest import TestCase
+from unittest.mock import patch
+
+from werkzeug.serving import make_server
+
+import env
+from api import create_app
+from api.queue import Queue
+from api.remote import RemoteQueue
+from api.exceptions import QueueException
+
+
+class TestRemoteQueue(TestCase):
+    '''
+    Test consuming a queue over HTTP, from an API server running in a thread.
+    '''
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+        # Point the server at a scratch database
+        db_patcher = patch.object(Queue, 'db_conn', os.path.join(self.tmp, 'test.db'))
+        db_patcher.start()
+        self.addCleanup(db_patcher.stop)
+
+        # Keep the server's request logs out of the test output
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)
+
+        app = create_app({'TOKENS': [], 'QUEUE_TOKEN': 'queue-secret'})
+        self.server = make_server('127.0.0.1', 0, app, threaded=True)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+        self.url = 'http://127.0.0.1:%d/queue' % self.server.server_port
+        self.queue = RemoteQueue(self.url, 'queue-secret')
+        self.local = Queue()
+
+        self.payload = {
+            'ref': 'refs/heads/master',
+            'repository': {
+                'name': 'bunny-hook'
+            },
+            'clone_url': 'https://github.com/jeancochrane/bunny-hook.git'
+        }
+
+    def tearDown(self):
+        self.queue.close()
+        self.local.close()
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+        shutil.rmtree(self.tmp)
+
+    def test_add_claim_finish(self):
+        work_id = self.queue.add(self.payload)
+
+        self.assertEqual(self.queue.claim(), (work_id, self.payload))
+        self.assertIsNone(self.queue.claim())
+
+        self.queue.finish(work_id, 'succeeded', [{'stage': 'build', 'duration': 1.5}],
+                          home='/srv/bunny-hook')
+
+        # Finishing twice, as a retry would, only counts once
+        self.queue.finish(work_id, 'succeeded')
+
+        metrics = self.queue.get_metrics()
+        self.assertEqual(metrics['counters']['jobs_succeeded'], 1)
+        self.assertEqual(metrics['histograms']['build']['count'], 1)
+        self.assertEqual(metrics['depth'], {})
+
+        # The server learns where the branch deploys to
+        homes = self.local.cursor.execute('SELECT home FROM homes').fetchall()
+        self.assertEqual(homes, [('/srv/bunny-hook',)])
+
+    def test_batches(self):
+        payloads = [dict(self.payload, repository={'name': 'repo-%d' % i}) for i in range(3)]
+        work_ids = self.queue.add_many(payloads)
+
+        self.assertEqual(self.queue.claim_many(2), list(zip(work_ids[:2], payloads[:2])))
+        self.assertEqual(self.queue.attempts[work_ids[0]], 1)
+        self.assertEqual(self.queue.claim_many(2), [(work_ids[2], payloads[2])])
+        self.assertEqual(self.queue.claim_many(2), [])
+
+        # Dead jobs can be sent back in a batch too
+        with self.local.transaction():
+            self.local.reschedule(work_ids[0], Queue.max_attempts, 'fetch failed', time.time())
+
+        _, result = self.queue.request('POST', '/dead/redeliver', {'ids': [work_ids[0], 999]})
+        self.assertEqual(result, {'redelivered': [work_ids[0]]})
+
+        with self.assertRaises(QueueException):
+            self.queue.request('POST', '/dead/redeliver', {'ids': 'all'})
+
+    def test_heartbeat_and_retry(self):
+        work_id = self.queue.add(self.payload)
+        self.queue.claim()
+
+        self.assertTrue(self.queue.heartbeat(work_id))
+        self.assertTrue(self.queue.lease(work_id)())
+
+        self.assertTrue(self.queue.finish(work_id, 'failed', retry=True, error='fetch failed'))
+        self.assertFalse(self.queue.heartbeat(work_id))
+
+        select = 'SELECT status, last_error FROM queue WHERE id = ?'
+        self.assertEqual(self.local.cursor.execute(select, (work_id,)).fetchone(),
+                         ('pending', 'fetch failed'))
+
+    def test_consumers_never_share_jobs(self):
+        for branch in range(20):
+            self.local.add(dict(self.payload, ref='refs/heads/branch-%d' % branch,
+                                repository={'name': 'repo-%d' % branch}))
+
+        claimed = []
+
+        def consume():
+            queue = RemoteQueue(self.url, 'queue-secret')
+            while True:
+                work = queue.claim()
+                if not work:
+                    break
+                claimed.append(work[0])
+            queue.close()
+
+        consumers = [threading.Thread(target=consume) for _ in range(4)]
+        for consumer in consumers:
+            consumer.start()
+        for consumer in consumers:
+            consumer.join()
+
+        self.assertEqual(len(claimed), 20)
+        self.assertEqual(len(set(claimed)), 20)
+
+    def test_bad_token(self):
+        queue = RemoteQueue(self.url, 'bogus')
+
+        with self.assertRaises(QueueException) as e:
+            queue.add(self.payload)
+
+        self.assertIn('401', str(e.exception))
+        queue.close()
+
+    def test_wait(self):
+        self.assertFalse(self.queue.wait(0.2))
+
+        def add():
+            producer = Queue()
+            producer.add(self.payload)
+            producer.close()
+
+        timer = threading.Timer(0.2, add)
+        timer.start()
+        self.assertTrue(self.queue.wait(5))
+        timer.join()
+
+        # Local wakeups cut the wait short too
+        self.queue.claim()
+        self.queue.notify()
+        self.assertTrue(self.queue.wait(5))
+
+    def test_cancellation(self):
+        work_id = self.queue.add(self.payload)
+        self.queue.claim()
+
+        is_cancelled = self.queue.cancellation(work_id)
+        self.assertFalse(is_cancelled())
+
+        self.local.add(dict(self.payload, after='abc'))
+        self.assertTrue(is_cancelled())
+
+    @patch('api.worker.Worker.deploy')
+    def test_run(self, mock_deploy):
+        self.local.add(self.payload)
+
+        self.assertTrue(self.queue.run())
+        self.assertTrue(mock_deploy.called)
+        self.assertEqual(self.local.get_metrics()['counters']['jobs_succeeded'], 1)
+        self.assertFalse(self.queue.run())
@@ -0,0 +1,48 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+import env
+from api.settings import DEFAULTS, load_settings
+
+
+class TestSettings(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.config_file = os.path.join(self.tmp, 'config.yml')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def load(self, config):
+        with open(self.config_file, 'w') as cf:
+            cf.write(config)
+
+        return load_settings(self.config_file)
+
+    def test_load_settings_fills_in_defaults(self):
+        settings = self.load('tmp: /var/tmp/\n')
+
+        self.assertEqual(settings['tmp'], '/var/tmp/')
+        self.assertEqual(settings['lease_time'], DEFAULTS['lease_time'])
+
+    def test_load_settings_coerces_priorities(self):
+        settings = self.load('priorities:\n'
+                             '  master: "10"\n'
+                             '  bunny-hook/staging: -10\n'
+                             'repo_weights:\n'
+                             '  bunny-hook: "2"\n')
+
+        self.assertEqual(settings['priorities'], {'master': 10, 'bunny-hook/staging': -10})
+        self.assertEqual(settings['repo_weights'], {'bunny-hook': 2.0})
+
+    def test_load_settings_rejects_bad_priorities(self):
+        for config in ('priorities:\n  master: high\n',
+                       'priorities:\n  master: 1.5\n',
+                       'priorities: [master]\n',
+                       'repo_weights:\n  bunny-hook: 0\n',
+                       'repo_weights:\n  bunny-hook: heavy\n'):
+            with self.assertRaises(ValueError):
+                self.load(config)
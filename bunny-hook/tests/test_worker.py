@@ -1,10 +1,14 @@
 import os
+import time
+import shutil
+import tempfile
+import subprocess
 from unittest import TestCase, main
 import logging
 
 import env
 from api.worker import Worker
-from api.exceptions import WorkerException
+from api.exceptions import WorkerException, JobCancelled, CommandTimeout
 from decorators import mock_subprocess
 
 
@@ -19,6 +23,7 @@ class TestWorker(TestCase):
             'clone_url': 'https://github.com/jeancochrane/bunny-hook.git'
         }
 
+        self.payload = payload
         self.worker = Worker(payload)
 
         # Suppress stdout logging
@@ -48,6 +53,37 @@ class TestWorker(TestCase):
         cmd = self.worker.run_command(['echo'])
         self.assertEqual(cmd.returncode, 0)
 
+    def test_run_command_streams_to_log_file(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            self.worker.log_file = os.path.join(tmp, 'job.log')
+
+            result = self.worker.run_command(['bash', '-c', 'echo out; echo err >&2'])
+            self.assertEqual(result.returncode, 0)
+            self.assertGreaterEqual(result.wall_time, 0)
+            self.assertGreater(result.max_rss, 0)
+
+            self.worker.output.close()
+            with open(self.worker.log_file) as log:
+                lines = log.read().splitlines()
+
+        self.assertEqual(lines[1:], ['out', 'err'])
+
+    def test_run_command_times_out(self):
+        start = time.monotonic()
+
+        # The command starts a child that would outlive it, if the whole
+        # process group weren't killed
+        with self.assertRaises(CommandTimeout):
+            self.worker.run_command(['bash', '-c', 'sleep 30 & sleep 30'], timeout=0.2)
+
+        self.assertLess(time.monotonic() - start, 5)
+
+    def test_run_command_job_deadline(self):
+        self.worker.deadline = time.monotonic() + 0.2
+
+        with self.assertRaises(CommandTimeout):
+            self.worker.run_command(['sleep', '30'], timeout=60)
+
     def test_run_command_errors(self):
         with self.assertRaises(WorkerException) as e:
             self.worker.run_command(['bash', 'exit', '1'])
@@ -57,11 +93,42 @@ class TestWorker(TestCase):
         cmd = self.worker.run_script(script)
         self.assertEqual(cmd.returncode, 0)
 
+        self.assertEqual(len(self.worker.stats), 1)
+        self.assertEqual(self.worker.stats[0]['script'], script)
+
     def test_run_script_errors(self):
         script = self.path_to('scripts/fail.sh')
         with self.assertRaises(WorkerException) as e:
             self.worker.run_script(script)
 
+    def test_lock_waits_for_other_deploys(self):
+        tmp = tempfile.mkdtemp()
+        lock_file = os.path.join(tmp, 'home.lock')
+        other = Worker(self.payload)
+        other.lock_poll_interval = 0.01
+
+        try:
+            with self.worker.lock(lock_file):
+                # Another deploy to the same home waits until it runs out of time
+                other.deadline = time.monotonic() + 0.05
+                with self.assertRaises(CommandTimeout):
+                    with other.lock(lock_file):
+                        pass
+
+                self.assertEqual([timing['stage'] for timing in other.timings], ['lock_wait'])
+
+                other.deadline = None
+                other.is_cancelled = lambda: True
+                with self.assertRaises(JobCancelled):
+                    with other.lock(lock_file):
+                        pass
+
+            # Once the lock is free, it's taken straight away
+            with other.lock(lock_file):
+                pass
+        finally:
+            shutil.rmtree(tmp)
+
     @mock_subprocess
     def test_deploy_without_commands(self):
         '''
@@ -72,6 +139,15 @@ class TestWorker(TestCase):
         deployed = self.worker.deploy(tmp_path=good_config)
         self.assertTrue(deployed)
 
+        stages = [timing['stage'] for timing in self.worker.timings]
+        self.assertEqual(stages, ['checkout', 'copy', 'build', 'deploy', 'job'])
+
+        # The home is locked with a file in the tmp directory, so that
+        # locking it doesn't create it
+        self.assertEqual(self.worker.home, '/jean/bunny-hook')
+        lock_file = self.worker.get_home_lock()
+        self.assertEqual(os.path.dirname(lock_file), os.path.abspath(self.worker.settings['tmp']))
+
     @mock_subprocess
     def test_empty_config_file(self):
         '''
@@ -120,3 +196,254 @@ class TestWorker(TestCase):
 
         expected_msg = 'is missing `home` directive'
         self.assertIn(expected_msg, str(e.exception))
+
+    @mock_subprocess
+    def test_missing_script_fails_before_copy(self):
+        '''
+        Test that a script missing from the repo fails the deploy before the
+        repo gets copied anywhere.
+        '''
+        with tempfile.TemporaryDirectory() as repo:
+            with open(os.path.join(repo, 'deploy.yml'), 'w') as cf:
+                cf.write('home: /srv/test\nbuild:\n  - scripts/missing.sh\n')
+
+            with self.assertRaises(WorkerException) as e:
+                self.worker.deploy(tmp_path=repo)
+
+        self.assertIn('scripts/missing.sh', str(e.exception))
+        self.assertFalse(any(call.args[0][0] == 'rsync'
+                             for call in self.worker.run_command.call_args_list))
+
+    @mock_subprocess
+    def test_deploy_cancelled(self):
+        '''
+        Test that a cancelled deploy stops before running any commands.
+        '''
+        self.worker.is_cancelled = lambda: True
+
+        good_config = self.path_to('configs/good-configs')
+        with self.assertRaises(JobCancelled):
+            self.worker.deploy(tmp_path=good_config)
+
+        self.assertFalse(self.worker.run_command.called)
+
+
+class TestWorkerMirror(TestCase):
+    '''
+    Test checking out repos from a persistent mirror, using a local repo in
+    place of GitHub.
+    '''
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.origin = os.path.join(self.tmp, 'origin')
+        self.tmp_path = os.path.join(self.tmp, 'work')
+
+        self.git('init', '--initial-branch=master', self.origin)
+        self.commit('deploy.yml', 'home: /srv/test-repo\n')
+
+        self.settings = {'git_path': os.path.join(self.tmp, 'mirrors')}
+
+        logging.disable(logging.INFO)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def git(self, *args):
+        cmd = ['git', '-c', 'user.name=test', '-c', 'user.email=test@example.com']
+        return subprocess.run(cmd + list(args), check=True, stdout=subprocess.PIPE,
+                              universal_newlines=True).stdout.strip()
+
+    def commit(self, filename, contents):
+        with open(os.path.join(self.origin, filename), 'w') as f:
+            f.write(contents)
+
+        self.git('-C', self.origin, 'add', filename)
+        self.git('-C', self.origin, 'commit', '-m', 'Update %s' % filename)
+        return self.git('-C', self.origin, 'rev-parse', 'HEAD')
+
+    def worker(self, sha, branch='master'):
+        payload = {
+            'ref': 'refs/heads/' + branch,
+            'after': sha,
+            'repository': {
+                'name': 'test-repo'
+            },
+            'clone_url': self.origin
+        }
+        return Worker(payload, settings=self.settings)
+
+    def read(self, filename):
+        with open(os.path.join(self.tmp_path, filename)) as f:
+            return f.read()
+
+    def test_checkout_from_mirror(self):
+        sha = self.commit('app.txt', 'version 1')
+        self.worker(sha).checkout_from_mirror(self.tmp_path)
+
+        self.assertTrue(os.path.isdir(os.path.join(self.tmp, 'mirrors', 'test-repo.git')))
+        self.assertEqual(self.read('app.txt'), 'version 1')
+
+        # A second push only needs a fetch into the mirror
+        sha = self.commit('app.txt', 'version 2')
+        self.worker(sha).checkout_from_mirror(self.tmp_path)
+
+        self.assertEqual(self.read('app.txt'), 'version 2')
+
+    def test_checkout_from_mirror_after_tmp_is_wiped(self):
+        sha = self.commit('app.txt', 'version 1')
+        self.worker(sha).checkout_from_mirror(self.tmp_path)
+
+        shutil.rmtree(self.tmp_path)
+
+        self.worker(sha).checkout_from_mirror(self.tmp_path)
+        self.assertEqual(self.read('app.txt'), 'version 1')
+
+    def test_checkout_from_mirror_replaces_old_clone(self):
+        self.git('clone', self.origin, self.tmp_path)
+
+        sha = self.commit('app.txt', 'version 1')
+        self.worker(sha).checkout_from_mirror(self.tmp_path)
+
+        self.assertTrue(os.path.isfile(os.path.join(self.tmp_path, '.git')))
+        self.assertEqual(self.read('app.txt'), 'version 1')
+
+    def test_checkout_branches_side_by_side(self):
+        master = self.commit('app.txt', 'production')
+        self.git('-C', self.origin, 'checkout', '-b', 'staging')
+        staging = self.commit('app.txt', 'staging')
+
+        production_path = os.path.join(self.tmp, 'work@master')
+        staging_path = os.path.join(self.tmp, 'work@staging')
+        self.worker(master).checkout_from_mirror(production_path)
+        self.worker(staging, 'staging').checkout_from_mirror(staging_path)
+
+        # Each branch keeps its own worktree of the one mirror
+        for path, contents in ((production_path, 'production'), (staging_path, 'staging')):
+            with open(os.path.join(path, 'app.txt')) as f:
+                self.assertEqual(f.read(), contents)
+
+        self.assertEqual(sorted(os.listdir(self.settings['git_path'])),
+                         ['test-repo.git', 'test-repo.git.lock'])
+
+    def test_deploy_release(self):
+        home = os.path.join(self.tmp, 'home')
+        self.commit('deploy.yml', 'home: %s\nreleases: true\nbuild:\n  - build.sh\n' % home)
+        sha = self.commit('build.sh', 'echo built > "$(dirname "$0")/build.txt"\n')
+
+        self.assertTrue(self.worker(sha).deploy(tmp_path=self.tmp_path))
+
+        current = os.path.join(home, 'current')
+        self.assertEqual(os.readlink(current), os.path.join('releases', sha))
+
+        with open(os.path.join(current, 'build.txt')) as f:
+            self.assertEqual(f.read(), 'built\n')
+
+    def test_deploy_skips_unchanged_scripts(self):
+        home = os.path.join(self.tmp, 'home')
+        runs = os.path.join(self.tmp, 'runs.txt')
+        config = '''
+home: %s
+releases: true
+build:
+  - script: build.sh
+    paths: [src/*]
+    outputs: [dist]
+''' % home
+        self.settings['cache_path'] = os.path.join(self.tmp, 'cache')
+        self.commit('deploy.yml', config)
+        self.commit('build.sh', 'echo run >> %s\n'
+                                'mkdir -p "$(dirname "$0")/dist"\n'
+                                'cat "$(dirname "$0")/src/app.txt" > "$(dirname "$0")/dist/app.txt"\n'
+                                % runs)
+        os.makedirs(os.path.join(self.origin, 'src'))
+        sha = self.commit('src/app.txt', 'version 1')
+        self.assertTrue(self.worker(sha).deploy(tmp_path=self.tmp_path))
+
+        # Only the README changes, so the build is restored from the cache
+        sha = self.commit('README.md', 'docs')
+        worker = self.worker(sha)
+        self.assertTrue(worker.deploy(tmp_path=self.tmp_path))
+        self.assertEqual(worker.skipped, ['build.sh'])
+
+        with open(os.path.join(home, 'current', 'dist', 'app.txt')) as f:
+            self.assertEqual(f.read(), 'version 1')
+
+        # A change to the inputs runs the build again
+        sha = self.commit('src/app.txt', 'version 2')
+        worker = self.worker(sha)
+        self.assertTrue(worker.deploy(tmp_path=self.tmp_path))
+        self.assertEqual(worker.skipped, [])
+
+        with open(os.path.join(home, 'current', 'dist', 'app.txt')) as f:
+            self.assertEqual(f.read(), 'version 2')
+
+        with open(runs) as f:
+            self.assertEqual(f.read(), 'run\nrun\n')
+
+    def test_deploy_restores_dependencies(self):
+        home = os.path.join(self.tmp, 'home')
+        runs = os.path.join(self.tmp, 'runs.txt')
+        config = '''
+home: %s
+releases: true
+dependencies:
+  - path: deps
+    lockfiles: [requirements.txt]
+prebuild:
+  - install.sh
+''' % home
+        self.settings['cache_path'] = os.path.join(self.tmp, 'cache')
+        self.commit('deploy.yml', config)
+        self.commit('install.sh', 'cd "$(dirname "$0")"\n'
+                                  '[ -d deps ] && exit 0\n'
+                                  'echo install >> %s\n'
+                                  'mkdir deps && cp requirements.txt deps/installed.txt\n'
+                                  'ln -s installed.txt deps/current\n' % runs)
+        sha = self.commit('requirements.txt', 'flask==1.0')
+        self.assertTrue(self.worker(sha).deploy(tmp_path=self.tmp_path))
+
+        # The lockfile hasn't changed, so the install is restored
+        sha = self.commit('README.md', 'docs')
+        worker = self.worker(sha)
+        self.assertTrue(worker.deploy(tmp_path=self.tmp_path))
+        self.assertEqual(worker.restored, ['deps'])
+
+        with open(os.path.join(home, 'current', 'deps', 'current')) as f:
+            self.assertEqual(f.read(), 'flask==1.0')
+
+        # A new lockfile installs from scratch
+        sha = self.commit('requirements.txt', 'flask==2.0')
+        worker = self.worker(sha)
+        self.assertTrue(worker.deploy(tmp_path=self.tmp_path))
+        self.assertEqual(worker.restored, [])
+
+        with open(os.path.join(home, 'current', 'deps', 'current')) as f:
+            self.assertEqual(f.read(), 'flask==2.0')
+
+        with open(runs) as f:
+            self.assertEqual(f.read(), 'install\ninstall\n')
+
+    def test_deploy_parallel_scripts_fail_fast(self):
+        home = os.path.join(self.tmp, 'home')
+        config = '''
+home: %s
+releases: true
+build:
+  - parallel:
+    - fail.sh
+    - slow.sh
+  - never.sh
+''' % home
+        self.commit('deploy.yml', config)
+        self.commit('fail.sh', 'exit 1\n')
+        self.commit('slow.sh', 'sleep 30\n')
+        sha = self.commit('never.sh', 'touch "$(dirname "$0")/never.txt"\n')
+
+        start = time.monotonic()
+        with self.assertRaises(WorkerException):
+            self.worker(sha).deploy(tmp_path=self.tmp_path)
+
+        # The slow script was killed, and the script after the group never ran
+        self.assertLess(time.monotonic() - start, 10)
+        self.assertFalse(os.path.exists(os.path.join(home, 'releases', sha, 'never.txt')))
+        self.assertFalse(os.path.exists(os.path.join(home, 'current')))